@@ -1,8 +1,19 @@
 from ai.services.index_manager import FAISSIndexManager
+from ai.services.index_client import ShardedIndexClient
+from ai.services.ingest_queue import IngestQueue
+from ai.services.answer_cache import AnswerCache
 import config
 
-index_manager = FAISSIndexManager(
-    embedding_model_name=config.EMBEDDING_MODEL_NAME,
-    index_data_dir=config.INDEX_DATA_DIR
-)
+if config.INDEX_SERVER_NODES:
+    index_manager = ShardedIndexClient(config.INDEX_SERVER_NODES)
+else:
+    index_manager = FAISSIndexManager(
+        embedding_model_name=config.EMBEDDING_MODEL_NAME,
+        index_data_dir=config.INDEX_DATA_DIR
+    )
 index_manager.load_from_disk()
+
+# Upload được ingest ở nền bởi một số worker cố định
+ingest_queue = IngestQueue()
+# Câu trả lời đã sinh của từng chat, xóa khi chat đổi tập file
+answer_cache = AnswerCache()
@@ -0,0 +1,147 @@
+"""
+Thu gọn một INDEX_DATA_DIR khi web app / index server đã dừng: chỉ giữ các dòng vector còn
+document trỏ tới (đánh số lại vector_row, bỏ hash không còn dùng trong content_vectors) và
+dựng lại index của các chat còn vector đã xóa, rồi ghi thành snapshot mới.
+
+    python -m ai.compact_index --data-dir index_data
+
+Dữ liệu mới được ghi vào <data-dir>.compacting rồi đổi chỗ với thư mục cũ, thư mục cũ được
+giữ lại dưới tên <data-dir>.old để xóa sau khi đã kiểm tra. Không chạy khi còn process
+nào mở thư mục này.
+"""
+import os
+import json
+import shutil
+import sqlite3
+import logging
+import argparse
+import numpy as np
+import faiss
+from ai.services.index_store import IndexStore
+from ai.services import index_factory
+
+logger = logging.getLogger("doc_retrieval_api.compact_index")
+
+# Số dòng vector chép mỗi lần, để không phải đọc cả vectors.f32 vào RAM
+COPY_BATCH_ROWS = 65536
+
+
+def open_store(data_dir: str):
+    """Mở store với model / dtype ghi trong header (không cần cấu hình embedding)"""
+    with open(os.path.join(data_dir, IndexStore.HEADER_FILE), "r", encoding="utf-8") as f:
+        header = json.load(f)
+    return IndexStore(
+        data_dir, header.get("model", IndexStore.LEGACY_EMBEDDING_MODEL),
+        vector_dtype=header.get("dtype", "float32")
+    )
+
+
+def _rebuild_chat_index(index, vectors, int_ids):
+    """Dựng lại index chỉ với các id còn sống, giữ loại index / codec đang dùng"""
+    try:
+        return index_factory.build_index(vectors, int_ids, *index_factory.index_spec(index))
+    except Exception as e:
+        # Vd. PQ không còn đủ vector để train: dùng loại index theo số vector hiện tại
+        logger.warning(f"Could not rebuild index as {index_factory.index_spec(index)}: {e}")
+        return index_factory.build_index(vectors, int_ids)
+
+
+def compact(data_dir: str, target_dir: str):
+    """Ghi bản thu gọn của data_dir vào target_dir, trả về (số dòng cũ, số dòng mới)"""
+    store = open_store(data_dir)
+    try:
+        # Gộp WAL vào snapshot để metadata.db và vectors.f32 là toàn bộ dữ liệu
+        store.checkpoint({})
+        documents, indexes, _ = store.load_snapshot()
+        old_rows, dimension, dtype = store.row_count, store.dimension, store.dtype
+        generation = store.generation + 1
+
+        os.makedirs(os.path.join(target_dir, IndexStore.CHAT_INDEX_DIR))
+        shutil.copy2(store.header_path, os.path.join(target_dir, IndexStore.HEADER_FILE))
+        conn = sqlite3.connect(os.path.join(target_dir, IndexStore.METADATA_FILE))
+        with conn:
+            store.conn.backup(conn)
+
+        # Dòng vector còn document trỏ tới, theo thứ tự cũ
+        live_rows = np.unique(np.array([row for _, row, _ in documents], dtype=np.int64))
+        new_row = {int(old): new for new, old in enumerate(live_rows)}
+        vectors_path = os.path.join(target_dir, IndexStore.VECTORS_FILE)
+        with open(vectors_path, "wb") as f:
+            if len(live_rows):
+                source = np.memmap(store.vectors_path, dtype=dtype, mode="r", shape=(old_rows, dimension))
+                for start in range(0, len(live_rows), COPY_BATCH_ROWS):
+                    f.write(np.ascontiguousarray(source[live_rows[start:start + COPY_BATCH_ROWS]]).tobytes())
+                del source
+            f.flush()
+            os.fsync(f.fileno())
+        vectors = np.memmap(vectors_path, dtype=dtype, mode="r", shape=(len(live_rows), dimension)) \
+            if len(live_rows) else None
+
+        chat_int_ids = {}
+        for int_id, row, doc in documents:
+            chat_int_ids.setdefault(doc.chat_id, []).append((int_id, new_row[row]))
+
+        # Index của chat: chép nguyên nếu không có id đã xóa / thiếu, không thì dựng lại.
+        # Chat chưa có index được FAISSIndexManager dựng lúc nạp như bình thường
+        chat_files = {}
+        for chat_id, index in indexes.items():
+            if chat_id not in chat_int_ids:
+                continue
+            int_ids, rows = zip(*sorted(chat_int_ids[chat_id]))
+            int_ids = np.array(int_ids, dtype=np.int64)
+            if set(faiss.vector_to_array(index.id_map).tolist()) != set(int_ids.tolist()):
+                index = _rebuild_chat_index(index, np.asarray(vectors[list(rows)], dtype=np.float32), int_ids)
+            chat_files[chat_id] = IndexStore.chat_index_file_name(chat_id, generation)
+            faiss.write_index(index, os.path.join(target_dir, IndexStore.CHAT_INDEX_DIR, chat_files[chat_id]))
+
+        with conn:
+            conn.execute("CREATE TEMP TABLE row_map (old INTEGER PRIMARY KEY, new INTEGER NOT NULL)")
+            conn.executemany("INSERT INTO row_map VALUES (?, ?)", new_row.items())
+            conn.execute("DELETE FROM content_vectors WHERE vector_row NOT IN (SELECT old FROM row_map)")
+            conn.execute(
+                "UPDATE content_vectors SET vector_row = (SELECT new FROM row_map WHERE old = vector_row)"
+            )
+            conn.execute("UPDATE documents SET vector_row = (SELECT new FROM row_map WHERE old = vector_row)")
+            conn.execute("DELETE FROM chat_indexes")
+            conn.execute("DELETE FROM chat_index_files")
+            conn.executemany("INSERT INTO chat_index_files VALUES (?, ?)", chat_files.items())
+            conn.execute("INSERT OR REPLACE INTO store_meta VALUES ('row_count', ?)", (str(len(live_rows)),))
+            conn.execute("INSERT OR REPLACE INTO store_meta VALUES ('generation', ?)", (str(generation),))
+        conn.execute("VACUUM")
+        conn.close()
+        del vectors
+    finally:
+        store.close()
+
+    # Mở thử bản mới (tạo luôn WAL rỗng của generation mới)
+    open_store(target_dir).close()
+    return old_rows, len(live_rows)
+
+
+def compact_in_place(data_dir: str):
+    """Thu gọn data_dir rồi đổi chỗ; trả về (số dòng cũ, số dòng mới, thư mục cũ)"""
+    data_dir = os.path.abspath(data_dir)
+    target_dir, old_dir = data_dir + ".compacting", data_dir + ".old"
+    if os.path.exists(old_dir):
+        raise FileExistsError(f"{old_dir} already exists, remove it first")
+    shutil.rmtree(target_dir, ignore_errors=True)
+    try:
+        old_rows, new_rows = compact(data_dir, target_dir)
+    except Exception:
+        shutil.rmtree(target_dir, ignore_errors=True)
+        raise
+    os.rename(data_dir, old_dir)
+    os.rename(target_dir, data_dir)
+    return old_rows, new_rows, old_dir
+
+
+if __name__ == "__main__":
+    from ai.utils.logging_config import setup_logging
+
+    parser = argparse.ArgumentParser(description="Drop unreferenced vector rows from a stopped index data directory")
+    parser.add_argument("--data-dir", required=True, help="INDEX_DATA_DIR of the stopped app or index server")
+    args = parser.parse_args()
+
+    setup_logging()
+    old_rows, new_rows, old_dir = compact_in_place(args.data_dir)
+    print(f"Compacted {args.data_dir}: {old_rows} -> {new_rows} vector rows; old data kept in {old_dir}")
@@ -3,15 +3,16 @@ import uuid
 import os
 from fastapi import APIRouter, File, UploadFile, HTTPException, Form, Depends, Query
 from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
 from typing import List, Optional
 import config
 # Import services
 from ai.services.llm_services import LLMService
 from ai.utils.logging_config import setup_logging
 from ai.schemas import QueryRequest, QueryResponse, DocumentResponse, Document
-from ai.services.text_processor import TextProcessor
+from ai.services.text_processor import TextProcessor, TextChunker
 import logging
-from ai.ai_init import index_manager
+from ai.ai_init import index_manager, answer_cache
 # Initialize logger
 logger = logging.getLogger("doc_retrieval_api.routes")
 
@@ -25,14 +26,16 @@ llm_service = LLMService(
     temperature=config.LLM_TEMPERATURE,
     max_tokens=config.LLM_MAX_TOKENS,
     timeout=config.LLM_TIMEOUT,
-    max_retries=config.LLM_MAX_RETRIES
+    max_retries=config.LLM_MAX_RETRIES,
+    max_concurrency=config.LLM_MAX_CONCURRENCY,
+    deadline=config.LLM_DEADLINE
 )
 
 # Document upload function
 async def upload_document_handler(
     file_id_save: str,
-    chunk_size: int = 500,
-    overlap: int =100,
+    chunk_size: int = config.DEFAULT_CHUNK_SIZE,
+    overlap: int = config.DEFAULT_OVERLAP,
     chat_id: str = ""
 ):
     """Upload document and process to add to index"""
@@ -49,102 +52,126 @@ async def upload_document_handler(
     #     )
     
     # try:
-    # Read file content
-    # file_content = await file.read()
-    
-    # Extract text
-    with open("uploaded_files/" + file_id_save, "rb") as f:
-        file_content = f.read()
-    text = TextProcessor.extract_text(file_content, file_id_save.split(".")[-1])
+    # Tách text / embed chạy trong thread pool (PDF trong process pool) để event loop
+    # vẫn phục vụ request khác trong lúc ingest
+    return await run_in_threadpool(ingest_file, file_id_save, chunk_size, overlap, chat_id, start_time)
 
-    # text = TextProcessor.extract_text_from_txt(file_content)
-    
-    if not text:
-        raise HTTPException(
-            status_code=400,
-            detail="Could not extract text from file"
-        )
-    
-    # Split text into chunks
-    chunks = TextProcessor.chunk_text(text, chunk_size, overlap)
-    
-    # Create description
+    # except HTTPException as e:
+    #     print(e)
+    #     raise e
+    # except Exception as e:
+    #     logger.error(f"Error processing file: {str(e)}")
+    #     print(e)
+    #     raise HTTPException(
+    #         status_code=500,
+    #         detail=f"Error processing file: {str(e)}"
+    #     )
 
-    description = llm_service.create_description_short_for_file(chunks[0], chunks[-1])
 
-    if not chunks:
-        raise HTTPException(
-            status_code=400,
-            detail="Could not create chunks from text"
-        )
-    
-    # Create metadata
+def ingest_file(file_id_save: str, chunk_size: int = config.DEFAULT_CHUNK_SIZE,
+                overlap: int = config.DEFAULT_OVERLAP, chat_id: str = "",
+                start_time: float = None, progress=None, content_hash: str = None):
+    """
+    Tách text, chunk, embed và ghi index cho một file đã lưu trong uploaded_files.
+    progress(chunks_embedded, chunks_total) được gọi sau mỗi batch; chunks_total là None
+    cho tới khi tách text xong. content_hash (sha256 tính lúc lưu file) là key của cache
+    text đã tách, không có thì được tính lại từ file.
+    """
+    start_time = start_time or time.time()
+    # Đọc file theo từng trang / đoạn, chunk xong đến đâu embed theo batch đến đó,
+    # nên bộ nhớ không phụ thuộc kích thước file
+    chunker = TextChunker(chunk_size, overlap, config.CHUNK_UNIT)
     metadata = {
         "chunk_size": chunk_size,
         "overlap": overlap,
-        "chunk_count": len(chunks),
-        "original_size": len(text)
+        "chunk_unit": config.CHUNK_UNIT
     }
-    
-    # Add each chunk to index
+    first_chunk = last_chunk = None
+    chunk_count = 0
     added_count = 0
-    for i, chunk in enumerate(chunks):
-        doc_id = f"{uuid.uuid4()}"
-        doc = Document(
-            id=doc_id,
-            content=chunk,
-            source=file_id_save,
-            metadata={
-                **metadata,
-                "chunk_index": i,
-                "chunk_total": len(chunks)
-            },
-            chat_id=chat_id
+    docs = []
+    try:
+        pieces = TextProcessor.iter_file_text(
+            "uploaded_files/" + file_id_save, file_id_save.split(".")[-1], content_hash
         )
-        
-        if index_manager.add_document(doc):
-            added_count += 1
-    
+        for chunk in chunker.chunks(pieces):
+            if first_chunk is None:
+                first_chunk = chunk.text
+            last_chunk = chunk.text
+            docs.append(Document(
+                id=f"{uuid.uuid4()}",
+                content=chunk.text,
+                source=file_id_save,
+                metadata={
+                    **metadata,
+                    "chunk_index": chunk_count,
+                    # Vị trí của chunk trong text tách từ file, để hiển thị đoạn trích
+                    "char_start": chunk.start,
+                    "char_end": chunk.end
+                },
+                chat_id=chat_id
+            ))
+            chunk_count += 1
+            if len(docs) >= config.UPLOAD_CHUNK_BATCH:
+                added_count += index_manager.add_documents(docs)
+                docs = []
+                if progress:
+                    progress(added_count, None)
+        # Tách text xong thì đã biết tổng số chunk, còn batch cuối đang embed
+        if progress:
+            progress(added_count, chunk_count)
+        if docs:
+            added_count += index_manager.add_documents(docs)
+            if progress:
+                progress(added_count, chunk_count)
+    except Exception:
+        # Không để lại một phần file trong index
+        index_manager.delete_file(file_id_save)
+        raise
+
+    if not chunk_count:
+        raise HTTPException(
+            status_code=400,
+            detail="Could not extract text from file"
+        )
+
+    # Create description
+    description = llm_service.create_description_short_for_file(first_chunk, last_chunk)
+
     processing_time = time.time() - start_time
     
     return {
             "file_name": file_id_save,
             "chunks_added": added_count,
-            "total_chunks": len(chunks),
+            "total_chunks": chunk_count,
+            "original_size": chunker.text_length,
             "processing_time_seconds": processing_time,
             "chat_id": chat_id
         }, description
 
-    # except HTTPException as e:
-    #     print(e)
-    #     raise e
-    # except Exception as e:
-    #     logger.error(f"Error processing file: {str(e)}")
-    #     print(e)
-    #     raise HTTPException(
-    #         status_code=500,
-    #         detail=f"Error processing file: {str(e)}"
-    #     )
-
 # Query documents function
 async def query_documents_handler(chat_all_infor: dict, chat_id: str, top_k: int = 10, threshold: float = 0.5):
     # print(chat_all_infor)
     """Query documents and generate answer"""
     """
         Step1: Rewrite the query to create 2 more questions
+        Step2: Return the cached answer if the rewritten question was answered on the same files
+        Step3: Search all of them in one batch, fuse the results with reciprocal-rank fusion
     """
-
-    question_format =  llm_service.create_question_template(chat_all_infor)
-
     start_time = time.time()
+    # LLM được gọi async, embed query + search FAISS chạy trong thread pool: event loop
+    # không bị chặn trong lúc chờ, các chat khác vẫn được phục vụ
+    queries = await llm_service.acreate_query_variants(chat_all_infor, config.QUERY_VARIANT_COUNT)
+    question_format = queries[0]
 
-    
-
+    cache_key, cached = await _cached_answer(chat_all_infor, chat_id, question_format)
+    if cached:
+        return {**cached, "processing_time": time.time() - start_time, "chat_id": chat_id}
 
-    
     try:
-        retrieved_docs = index_manager.search(
-            query=question_format,
+        retrieved_docs = await run_in_threadpool(
+            index_manager.search_many,
+            queries=queries,
             chat_id=chat_id,
             top_k=top_k,
             threshold=threshold
@@ -159,25 +186,22 @@ async def query_documents_handler(chat_all_infor: dict, chat_id: str, top_k: int
                 "chat_id": chat_id
             }        
         # Generate answer
-        answer = llm_service.generate_answer(question_format, retrieved_docs)
-        
-        # Convert results to response format
-        retrieved_doc_responses = []
-        for doc, score in retrieved_docs:
-            retrieved_doc_responses.append(
-                DocumentResponse(
-                    id=doc.id,
-                    content=doc.content,
-                    source=doc.source,
-                    metadata=doc.metadata,
-                    score=float(score),
-                    chat_id=doc.chat_id
-                )
-            )
+        try:
+            answer = await llm_service.agenerate_answer(question_format, retrieved_docs, raise_errors=True)
+        except Exception as e:
+            # Câu trả lời lỗi không được cache
+            answer = llm_service.answer_error(e)
+        else:
+            answer_cache.put(*cache_key, {
+                "query": question_format,
+                "answer": answer,
+                "retrieved_documents": _document_responses(retrieved_docs)
+            })
+
         return {
             "query": question_format,
             "answer": answer,
-            "retrieved_documents": retrieved_doc_responses,
+            "retrieved_documents": _document_responses(retrieved_docs),
             "processing_time": time.time() - start_time,
             "chat_id": chat_id
         }
@@ -190,10 +214,89 @@ async def query_documents_handler(chat_all_infor: dict, chat_id: str, top_k: int
             detail=f"Error processing query: {str(e)}"
         )
 
+
+async def _cached_answer(chat_all_infor: dict, chat_id: str, question: str):
+    """
+    Key cache của câu hỏi cuối (chat, tập file, embedding câu hỏi đã viết lại) và câu trả lời
+    đã cache nếu có. Câu hỏi viết lại đã mang ngữ cảnh hội thoại, nên các câu nối tiếp như
+    "tại sao?" sau hai câu trả lời khác nhau không trùng key.
+    """
+    files_key = answer_cache.files_key(chat_all_infor.get("files", []))
+    has_context = chat_all_infor.get("summary") or len(chat_all_infor["messages"]) > 1
+    if answer_cache.max_size <= 0 or (has_context and question == llm_service.latest_query(chat_all_infor)):
+        # LLM không viết lại được câu hỏi: câu gốc có thể phụ thuộc hội thoại trước, không dùng cache
+        return (chat_id, files_key, None), None
+    embedding = await run_in_threadpool(index_manager.get_embedding, question)
+    cache_key = (chat_id, files_key, embedding)
+    return cache_key, answer_cache.get(*cache_key)
+
+
+def _document_responses(retrieved_docs):
+    """Convert results to response format"""
+    return [
+        DocumentResponse(
+            id=doc.id,
+            content=doc.content,
+            source=doc.source,
+            metadata=doc.metadata,
+            score=float(score),
+            chat_id=doc.chat_id
+        )
+        for doc, score in retrieved_docs
+    ]
+
+
+# Streaming query function
+async def stream_query_documents_handler(chat_all_infor: dict, chat_id: str, top_k: int = 10, threshold: float = 0.5):
+    """
+    Giống query_documents_handler nhưng yield (event, data) ngay khi có: "retrieved" (câu hỏi
+    viết lại + các đoạn tìm được) rồi "token" cho từng phần câu trả lời LLM đang sinh.
+    Lỗi của LLM giữa chừng được raise cho nơi gọi.
+    """
+    queries = await llm_service.acreate_query_variants(chat_all_infor, config.QUERY_VARIANT_COUNT)
+    question_format = queries[0]
+
+    cache_key, cached = await _cached_answer(chat_all_infor, chat_id, question_format)
+    if cached:
+        yield "retrieved", {
+            "query": cached["query"],
+            "retrieved_documents": cached["retrieved_documents"],
+            "chat_id": chat_id
+        }
+        yield "token", {"content": cached["answer"]}
+        return
+
+    retrieved_docs = await run_in_threadpool(
+        index_manager.search_many,
+        queries=queries,
+        chat_id=chat_id,
+        top_k=top_k,
+        threshold=threshold
+    )
+    yield "retrieved", {
+        "query": question_format,
+        "retrieved_documents": _document_responses(retrieved_docs),
+        "chat_id": chat_id
+    }
+
+    if not retrieved_docs:
+        yield "token", {"content": "No relevant information found in documents."}
+        return
+
+    answer = []
+    async for token in llm_service.astream_answer(question_format, retrieved_docs):
+        answer.append(token)
+        yield "token", {"content": token}
+    answer_cache.put(*cache_key, {
+        "query": question_format,
+        "answer": "".join(answer),
+        "retrieved_documents": _document_responses(retrieved_docs)
+    })
+
 # Delete document function
 async def delete_document_handler(doc_id: str):
     """Delete document from index"""
-    if index_manager.delete_document(doc_id):
+    if await run_in_threadpool(index_manager.delete_document, doc_id):
         return {"status": "success", "message": f"Deleted document {doc_id}"}
     else:
         raise HTTPException(
@@ -204,7 +307,7 @@ async def delete_document_handler(doc_id: str):
 # Delete chat documents function
 async def delete_chat_documents_handler(chat_id: str):
     """Delete all documents associated with a chat session"""
-    deleted_count = index_manager.delete_chat_documents(chat_id)
+    deleted_count = await run_in_threadpool(index_manager.delete_chat_documents, chat_id)
     if deleted_count > 0:
         return {
             "status": "success", 
@@ -219,12 +322,12 @@ async def delete_chat_documents_handler(chat_id: str):
 # Get statistics function
 async def get_statistics_handler(chat_id: Optional[str] = Query(None)):
     """Get statistics about documents in the system, optionally filtered by chat_id"""
-    return index_manager.get_statistics(chat_id=chat_id)
+    return await run_in_threadpool(index_manager.get_statistics, chat_id=chat_id)
 
 # Get chat documents function
 async def get_chat_documents_handler(chat_id: str):
     """Get all documents associated with a specific chat session"""
-    documents = index_manager.get_chat_documents(chat_id)
+    documents = await run_in_threadpool(index_manager.get_chat_documents, chat_id)
     
     if not documents:
         return {"documents": [], "count": 0}
@@ -0,0 +1,133 @@
+"""
+Index server: phục vụ API của FAISSIndexManager qua HTTP để web app (ShardedIndexClient)
+chia các chat ra nhiều process / máy.
+
+    python -m ai.index_server --port 8101 --data-dir index_data/shard0
+"""
+import base64
+import argparse
+import numpy as np
+from fastapi import FastAPI, HTTPException
+from typing import Optional
+from ai.schemas import (
+    Document, AddDocumentsRequest, ImportDocumentsRequest, SearchRequest, SearchManyRequest,
+    EmbedQueryRequest
+)
+
+
+def encode_vectors(vectors: np.ndarray):
+    return base64.b64encode(np.ascontiguousarray(vectors, dtype=np.float32).tobytes()).decode("ascii")
+
+
+def decode_vectors(data: str, count: int):
+    vectors = np.frombuffer(base64.b64decode(data), dtype=np.float32)
+    return vectors.reshape(count, -1) if count else vectors.reshape(0, 0)
+
+
+def _search_results(results):
+    return {
+        "results": [
+            {"document": doc.to_dict(), "similarity": float(similarity)} for doc, similarity in results
+        ]
+    }
+
+
+def create_index_server(index_manager):
+    app = FastAPI()
+
+    @app.get("/health")
+    def health():
+        return {"status": "ok"}
+
+    @app.post("/documents")
+    def add_documents(request: AddDocumentsRequest):
+        documents = [Document.from_dict(data) for data in request.documents]
+        return {"added": index_manager.add_documents(documents)}
+
+    @app.post("/documents/import")
+    def import_documents(request: ImportDocumentsRequest):
+        documents = [Document.from_dict(data) for data in request.documents]
+        vectors = decode_vectors(request.vectors, len(documents))
+        return {"added": index_manager.import_documents(documents, vectors)}
+
+    @app.post("/search")
+    def search(request: SearchRequest):
+        return _search_results(index_manager.search(
+            request.query, request.chat_id, request.top_k, request.threshold
+        ))
+
+    @app.post("/search_many")
+    def search_many(request: SearchManyRequest):
+        return _search_results(index_manager.search_many(
+            request.queries, request.chat_id, request.top_k, request.threshold
+        ))
+
+    @app.post("/search_ranked")
+    def search_ranked(request: SearchManyRequest):
+        """Kết quả của từng biến thể, chưa gộp RRF (client gộp kết quả của nhiều shard)"""
+        ranked_lists = index_manager.search_ranked(
+            request.queries, request.chat_id, request.top_k, request.threshold
+        )
+        return {"results": [_search_results(ranked)["results"] for ranked in ranked_lists]}
+
+    @app.post("/embeddings/query")
+    def embed_query(request: EmbedQueryRequest):
+        embedding = index_manager.get_embedding(request.query)
+        if embedding is None:
+            raise HTTPException(status_code=502, detail="Could not embed query")
+        return {"embedding": encode_vectors(embedding)}
+
+    @app.delete("/files")
+    def delete_file(file_name: str):
+        return {"deleted": index_manager.delete_file(file_name)}
+
+    @app.delete("/documents/{doc_id}")
+    def delete_document(doc_id: str):
+        return {"deleted": index_manager.delete_document(doc_id)}
+
+    @app.delete("/chats/{chat_id}/documents")
+    def delete_chat_documents(chat_id: str):
+        return {"deleted": index_manager.delete_chat_documents(chat_id)}
+
+    @app.get("/statistics")
+    def get_statistics(chat_id: Optional[str] = None):
+        return index_manager.get_statistics(chat_id=chat_id)
+
+    @app.get("/chats")
+    def list_chats():
+        return {"chat_ids": index_manager.list_chats()}
+
+    @app.get("/chats/{chat_id}/documents")
+    def get_chat_documents(chat_id: str):
+        documents = index_manager.get_chat_documents(chat_id)
+        return {"documents": [doc.to_dict() for doc in documents.values()]}
+
+    @app.get("/chats/{chat_id}/export")
+    def export_chat(chat_id: str):
+        documents, vectors = index_manager.export_chat(chat_id)
+        if not documents:
+            raise HTTPException(status_code=404, detail=f"Chat {chat_id} has no documents")
+        return {"documents": [doc.to_dict() for doc in documents], "vectors": encode_vectors(vectors)}
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+    import config
+    from ai.utils.logging_config import setup_logging
+    from ai.services.index_manager import FAISSIndexManager
+
+    parser = argparse.ArgumentParser(description="Run a standalone FAISS index server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8101)
+    parser.add_argument("--data-dir", default=config.INDEX_DATA_DIR)
+    args = parser.parse_args()
+
+    setup_logging()
+    manager = FAISSIndexManager(
+        embedding_model_name=config.EMBEDDING_MODEL_NAME,
+        index_data_dir=args.data_dir
+    )
+    manager.load_from_disk()
+    uvicorn.run(create_index_server(manager), host=args.host, port=args.port)
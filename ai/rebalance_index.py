@@ -0,0 +1,45 @@
+"""
+Đổi tập index server của web app: chuyển các chat đổi chủ từ vòng hash của danh sách node cũ
+sang vòng hash của danh sách node mới (copy cả vector, không embed lại).
+
+    python -m ai.rebalance_index --old http://127.0.0.1:8101,http://127.0.0.1:8102 \\
+        --new http://127.0.0.1:8101,http://127.0.0.1:8102,http://127.0.0.1:8103
+
+Mỗi worker web giữ vòng hash riêng dựng từ INDEX_SERVER_NODES lúc khởi động, nên thứ tự là:
+1. Chạy các index server mới (node bị bỏ vẫn phải chạy cho tới khi xong bước 3).
+2. Tạm dừng upload / xóa file rồi chạy lệnh này; search vẫn chạy nhưng có thể thiếu các chat
+   đã được chuyển cho tới bước 3.
+3. Đặt INDEX_SERVER_NODES bằng danh sách mới và khởi động lại web app.
+4. Chạy lại lệnh với cùng tham số: các chat được ghi vào shard cũ giữa bước 2 và 3 được chuyển
+   nốt, chat đã nằm đúng shard và document đã có trên shard mới được bỏ qua.
+"""
+import argparse
+from ai.services.index_client import ShardedIndexClient
+
+
+def parse_nodes(value: str):
+    return [node.strip() for node in value.split(",") if node.strip()]
+
+
+def rebalance(old_nodes, new_nodes):
+    """Chuyển chat từ vòng hash old_nodes sang new_nodes, trả về số chat đã chuyển"""
+    client = ShardedIndexClient(old_nodes)
+    try:
+        return client.set_nodes(new_nodes)
+    finally:
+        for http_client in client.clients.values():
+            http_client.close()
+        client.executor.shutdown()
+
+
+if __name__ == "__main__":
+    from ai.utils.logging_config import setup_logging
+
+    parser = argparse.ArgumentParser(description="Move chats between index servers after the node list changes")
+    parser.add_argument("--old", required=True, type=parse_nodes, help="Current INDEX_SERVER_NODES (comma separated)")
+    parser.add_argument("--new", required=True, type=parse_nodes, help="New INDEX_SERVER_NODES (comma separated)")
+    args = parser.parse_args()
+
+    setup_logging()
+    moved = rebalance(args.old, args.new)
+    print(f"Moved {moved} chats; set INDEX_SERVER_NODES={','.join(args.new)} and restart the web app")
@@ -10,7 +10,28 @@ class Document:
         self.metadata = metadata
         self.chat_id = chat_id  
         self.created_at = datetime.now().isoformat()
-        self.embedding = None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "content": self.content,
+            "source": self.source,
+            "metadata": self.metadata,
+            "chat_id": self.chat_id,
+            "created_at": self.created_at
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        doc = cls(
+            id=data["id"],
+            content=data["content"],
+            source=data["source"],
+            metadata=data["metadata"],
+            chat_id=data.get("chat_id")
+        )
+        doc.created_at = data.get("created_at", doc.created_at)
+        return doc
 
 # Pydantic models for API
 class QueryRequest(BaseModel):
@@ -36,4 +57,28 @@ class QueryResponse(BaseModel):
 
 class DocumentStatistics(BaseModel):
     document_count: int
-    file_types: dict
\ No newline at end of file
+    file_types: dict
+
+# Pydantic models for index server (ai/index_server.py)
+class AddDocumentsRequest(BaseModel):
+    documents: List[Dict[str, Any]]
+
+class ImportDocumentsRequest(BaseModel):
+    documents: List[Dict[str, Any]]
+    # Vector float32 của các document, mã hóa base64
+    vectors: str
+
+class SearchRequest(BaseModel):
+    query: str
+    chat_id: Optional[str] = None
+    top_k: int = 3
+    threshold: float = 0.5
+
+class SearchManyRequest(BaseModel):
+    queries: List[str]
+    chat_id: Optional[str] = None
+    top_k: int = 3
+    threshold: float = 0.5
+
+class EmbedQueryRequest(BaseModel):
+    query: str
@@ -0,0 +1,130 @@
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+import config
+
+
+class AnswerCache:
+    """
+    Cache câu trả lời theo chat: với LLM_TEMPERATURE = 0, cùng câu hỏi trên cùng tập file cho
+    cùng câu trả lời, nên câu hỏi có embedding đủ gần (cosine >= threshold) với một câu đã
+    trả lời trên đúng tập file hiện tại của chat được trả lại ngay, không gọi LLM.
+    Giới hạn tổng số câu (LRU), số câu mỗi chat và thời gian sống (TTL).
+    """
+
+    def __init__(self, max_size: int = None, threshold: float = None, ttl_seconds: float = None,
+                 max_per_chat: int = None):
+        self.max_size = config.ANSWER_CACHE_SIZE if max_size is None else max_size
+        self.threshold = threshold or config.ANSWER_CACHE_THRESHOLD
+        self.ttl_seconds = ttl_seconds or config.ANSWER_CACHE_TTL
+        self.max_per_chat = max_per_chat or config.ANSWER_CACHE_PER_CHAT
+        # entry id -> (chat_id, files_key, vector, value, expires_at), thứ tự LRU
+        self._entries = OrderedDict()
+        # chat_id -> các entry id của chat, cũ trước
+        self._chat_entries = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    @staticmethod
+    def files_key(files):
+        """Key của tập file trong chat (id nếu có, không thì tên file)"""
+        return tuple(sorted(str(file.get("id") or file.get("file_name")) for file in files))
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, entry_id):
+        chat_id = self._entries.pop(entry_id)[0]
+        entry_ids = self._chat_entries[chat_id]
+        entry_ids.pop(entry_id)
+        if not entry_ids:
+            del self._chat_entries[chat_id]
+
+    def _best_match(self, chat_id, files_key, vector):
+        """Entry gần nhất trên đúng tập file và similarity; bỏ các entry hết hạn trên đường đi"""
+        now = time.monotonic()
+        best_id, best_similarity = None, self.threshold
+        for entry_id in list(self._chat_entries.get(chat_id, ())):
+            _, entry_files_key, entry_vector, _, expires_at = self._entries[entry_id]
+            if expires_at < now:
+                self._remove(entry_id)
+                continue
+            if entry_files_key != files_key:
+                continue
+            similarity = float(np.dot(entry_vector, vector))
+            if similarity >= best_similarity:
+                best_id, best_similarity = entry_id, similarity
+        return best_id
+
+    def get(self, chat_id: str, files_key, embedding):
+        if self.max_size <= 0 or embedding is None:
+            return None
+        vector = self._normalize(embedding)
+        with self._lock:
+            entry_id = self._best_match(chat_id, files_key, vector)
+            if entry_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            return self._entries[entry_id][3]
+
+    def put(self, chat_id: str, files_key, embedding, value):
+        if self.max_size <= 0 or embedding is None:
+            return
+        vector = self._normalize(embedding)
+        with self._lock:
+            # Câu gần như trùng thì thay, câu trên tập file cũ của chat không còn dùng được
+            duplicate = self._best_match(chat_id, files_key, vector)
+            for entry_id in list(self._chat_entries.get(chat_id, ())):
+                if entry_id == duplicate or self._entries[entry_id][1] != files_key:
+                    self._remove(entry_id)
+
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (chat_id, files_key, vector, value, time.monotonic() + self.ttl_seconds)
+            chat_entries = self._chat_entries.setdefault(chat_id, OrderedDict())
+            chat_entries[entry_id] = None
+
+            while len(chat_entries) > self.max_per_chat:
+                self._remove(next(iter(chat_entries)))
+                self.evictions += 1
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_chat(self, chat_id: str):
+        """Xóa các câu trả lời của chat (khi chat có file mới hoặc bị xóa file)"""
+        with self._lock:
+            entry_ids = list(self._chat_entries.get(chat_id, ()))
+            for entry_id in entry_ids:
+                self._remove(entry_id)
+            self.invalidations += len(entry_ids)
+            return len(entry_ids)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._chat_entries.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "chats": len(self._chat_entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions
+            }
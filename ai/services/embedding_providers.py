@@ -0,0 +1,108 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import config
+
+logger = logging.getLogger("doc_retrieval_api.embedding_providers")
+
+
+class EmbeddingProvider:
+    """Interface chung cho các backend embedding, luôn trả về np.ndarray float32"""
+
+    model_name = None
+
+    def embed_query(self, text: str) -> np.ndarray:
+        raise NotImplementedError
+
+    def embed_documents(self, texts) -> np.ndarray:
+        raise NotImplementedError
+
+    def embed_queries(self, texts) -> np.ndarray:
+        """Embed nhiều query trong một lần gọi; mặc định gọi lần lượt embed_query"""
+        return np.array([self.embed_query(text) for text in texts], dtype=np.float32)
+
+
+class GoogleEmbeddingProvider(EmbeddingProvider):
+    """Gọi API GoogleGenerativeAIEmbeddings (cần GOOGLE_API_KEY và mạng)"""
+
+    def __init__(self, model_name: str):
+        from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+        self.model_name = model_name
+        self.model = GoogleGenerativeAIEmbeddings(model=model_name)
+
+    def embed_query(self, text: str):
+        return np.array(self.model.embed_query(text), dtype=np.float32)
+
+    def embed_documents(self, texts):
+        return np.array(self.model.embed_documents(texts), dtype=np.float32)
+
+    def embed_queries(self, texts):
+        # Một request batch nhưng vẫn dùng task type của query như embed_query
+        return np.array(
+            self.model.embed_documents(texts, task_type="retrieval_query"), dtype=np.float32
+        )
+
+
+class SentenceTransformerProvider(EmbeddingProvider):
+    """
+    Chạy model sentence-transformers ngay trên CPU của máy, không cần mạng.
+    Các batch được encode trong một pool worker riêng; số thread torch dùng cho
+    mỗi phép tính lấy từ EMBEDDING_NUM_THREADS.
+    """
+
+    def __init__(self, model_name: str, device: str = None, batch_size: int = None,
+                 num_workers: int = None, num_threads: int = None):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        num_threads = num_threads or config.EMBEDDING_NUM_THREADS
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
+        self.model_name = model_name
+        self.batch_size = batch_size or config.LOCAL_EMBEDDING_BATCH_SIZE
+        self.model = SentenceTransformer(model_name, device=device or config.EMBEDDING_DEVICE)
+        self.executor = ThreadPoolExecutor(
+            max_workers=num_workers or config.EMBEDDING_WORKERS,
+            thread_name_prefix="embedding"
+        )
+        logger.info(f"Loaded local embedding model {model_name}")
+
+    def _encode(self, texts):
+        return self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        ).astype(np.float32)
+
+    def embed_query(self, text: str):
+        return self.executor.submit(self._encode, [text]).result()[0]
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        futures = [
+            self.executor.submit(self._encode, texts[i:i + self.batch_size])
+            for i in range(0, len(texts), self.batch_size)
+        ]
+        return np.concatenate([future.result() for future in futures])
+
+    def embed_queries(self, texts):
+        return self.embed_documents(texts)
+
+
+EMBEDDING_PROVIDERS = {
+    "google": GoogleEmbeddingProvider,
+    "sentence-transformers": SentenceTransformerProvider,
+}
+
+
+def create_embedding_provider(provider_name: str, model_name: str) -> EmbeddingProvider:
+    provider_class = EMBEDDING_PROVIDERS.get(provider_name)
+    if provider_class is None:
+        raise ValueError(
+            f"Unknown embedding provider '{provider_name}', expected one of {list(EMBEDDING_PROVIDERS)}"
+        )
+    return provider_class(model_name)
@@ -0,0 +1,127 @@
+import os
+import mmap
+import uuid
+import hashlib
+import threading
+
+# Số byte mỗi lần đọc / ghi khi hash và copy file
+HASH_BLOCK_SIZE = 1024 * 1024
+# Số ký tự mỗi phần khi đọc lại text đã cache
+CACHE_READ_SIZE = 64 * 1024
+
+
+def file_sha256(path: str):
+    """sha256 của file trên đĩa, đọc qua mmap"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for start in range(0, len(data), HASH_BLOCK_SIZE):
+                    digest.update(data[start:start + HASH_BLOCK_SIZE])
+    return digest.hexdigest()
+
+
+def copy_and_hash(source, path: str, block_size: int = HASH_BLOCK_SIZE):
+    """Ghi file object source ra path theo từng khối và trả về (sha256, số byte)"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "wb") as f:
+        while True:
+            block = source.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+            f.write(block)
+            size += len(block)
+    return digest.hexdigest(), size
+
+
+class ExtractCache:
+    """
+    Cache trên đĩa của text tách từ file, key là (sha256 nội dung, định dạng, phiên bản bộ tách)
+    nên cùng bytes không bị parse PDF / DOCX lại khi upload lại hoặc ingest lại.
+    Text được ghi dần vào file tạm trong lúc tách và chỉ đổi tên thành file cache khi tách xong.
+    Khi tổng dung lượng vượt max_bytes, các file ít được dùng gần đây nhất bị xóa.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 0):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, "-".join(key) + ".txt")
+
+    def iter_text(self, key):
+        """Yield text đã cache theo từng phần, None nếu chưa có"""
+        path = self._path(key)
+        try:
+            f = open(path, "r", encoding="utf-8", errors="surrogatepass", newline="")
+        except FileNotFoundError:
+            return None
+        # mtime đánh dấu lần dùng gần nhất để dọn cache
+        os.utime(path)
+        return self._read(f)
+
+    @staticmethod
+    def _read(f):
+        with f:
+            while True:
+                text = f.read(CACHE_READ_SIZE)
+                if not text:
+                    return
+                yield text
+
+    def writer(self, key):
+        return ExtractCacheWriter(self, key)
+
+    def _commit(self, temp_path, key):
+        os.replace(temp_path, self._path(key))
+        if self.max_bytes:
+            self._prune()
+
+    def _prune(self):
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith(".txt"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+class ExtractCacheWriter:
+    """Ghi text của một file vào cache trong lúc tách; commit() khi tách xong, discard() nếu lỗi"""
+
+    def __init__(self, cache: ExtractCache, key):
+        self.cache = cache
+        self.key = key
+        self.temp_path = os.path.join(cache.cache_dir, f".{uuid.uuid4().hex}.tmp")
+        self.file = open(self.temp_path, "w", encoding="utf-8", errors="surrogatepass", newline="")
+
+    def write(self, text: str):
+        self.file.write(text)
+
+    def commit(self):
+        self.file.close()
+        self.cache._commit(self.temp_path, self.key)
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,256 @@
+import base64
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import numpy as np
+import config
+from ai.schemas import Document
+from ai.utils.hash_ring import HashRing
+from ai.utils.rank_fusion import reciprocal_rank_fusion
+
+logger = logging.getLogger("doc_retrieval_api.index_client")
+
+
+class ShardedIndexClient:
+    """
+    Cùng API với FAISSIndexManager nhưng gọi các index server (ai/index_server.py).
+    Mỗi chat nằm trọn trên một shard, chọn bằng consistent hashing chat_id; các lệnh không
+    có chat_id (xóa theo file / document id, search mọi chat) được gửi tới tất cả shard.
+
+    set_nodes / add_node / remove_node chuyển các chat đổi chủ sang shard mới (copy cả vector,
+    không embed lại). Trong lúc chuyển, search của chat đó đọc cả hai shard và lệnh xóa được
+    gửi tới cả hai, rồi chạy lại trên shard mới sau khi copy xong.
+
+    Vòng hash và trạng thái chuyển chỉ nằm trong process này, mỗi worker web có bản riêng dựng
+    từ INDEX_SERVER_NODES. Đổi danh sách node vì vậy do lệnh "python -m ai.rebalance_index"
+    làm, và phải chạy xong trước khi đổi INDEX_SERVER_NODES và khởi động lại web app.
+    """
+
+    def __init__(self, nodes, replicas: int = None, timeout: float = None):
+        self.timeout = timeout or config.INDEX_SERVER_TIMEOUT
+        self.ring = HashRing(nodes, replicas or config.INDEX_RING_REPLICAS)
+        self.clients = {node: self._create_client(node) for node in nodes}
+        self.executor = ThreadPoolExecutor(max_workers=max(4, len(nodes)), thread_name_prefix="index-client")
+        self.lock = threading.Lock()
+        # chat_id -> shard cũ, cho các chat đang được chuyển
+        self.migrating = {}
+        # chat_id -> lệnh xóa nhận được trong lúc chuyển chat
+        self.migration_deletes = {}
+
+    def _create_client(self, node: str):
+        return httpx.Client(base_url=node, timeout=self.timeout)
+
+    def _call(self, node: str, method: str, path: str, **kwargs):
+        response = self.clients[node].request(method, path, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    def _broadcast(self, method: str, path: str, **kwargs):
+        with self.lock:
+            nodes = list(self.ring.nodes)
+        futures = [self.executor.submit(self._call, node, method, path, **kwargs) for node in nodes]
+        return [future.result() for future in futures]
+
+    def _nodes_for_chat(self, chat_id: str):
+        """Shard đang giữ chat (cả shard cũ nếu chat đang được chuyển)"""
+        with self.lock:
+            nodes = [self.ring.get_node(chat_id)]
+            if chat_id in self.migrating:
+                nodes.append(self.migrating[chat_id])
+            return nodes
+
+    @staticmethod
+    def _parse_results(data):
+        return [(Document.from_dict(item["document"]), item["similarity"]) for item in data["results"]]
+
+    @staticmethod
+    def _merge_results(result_lists, top_k: int):
+        merged = {}
+        for results in result_lists:
+            for doc, similarity in results:
+                if doc.id not in merged or merged[doc.id][1] < similarity:
+                    merged[doc.id] = (doc, similarity)
+        return sorted(merged.values(), key=lambda item: item[1], reverse=True)[:top_k]
+
+    def load_from_disk(self):
+        """Mỗi index server tự nạp dữ liệu của nó"""
+
+    def add_document(self, document: Document):
+        return self.add_documents([document]) == 1
+
+    def add_documents(self, documents, batch_size: int = None, max_concurrency: int = None):
+        batches = {}
+        with self.lock:
+            for doc in documents:
+                batches.setdefault(self.ring.get_node(doc.chat_id or ""), []).append(doc.to_dict())
+
+        futures = [
+            self.executor.submit(self._call, node, "POST", "/documents", json={"documents": docs})
+            for node, docs in batches.items()
+        ]
+        return sum(future.result()["added"] for future in futures)
+
+    def _search_nodes(self, path: str, payload: dict, chat_id: str):
+        """Response của path trên các shard có thể giữ kết quả"""
+        if chat_id is None:
+            return self._broadcast("POST", path, json=payload)
+        nodes = self._nodes_for_chat(chat_id)
+        futures = [self.executor.submit(self._call, node, "POST", path, json=payload) for node in nodes]
+        return [future.result() for future in futures]
+
+    def search(self, query: str, chat_id: str = None, top_k: int = 3, threshold: float = 0.5):
+        payload = {"query": query, "chat_id": chat_id, "top_k": top_k, "threshold": threshold}
+        result_lists = [self._parse_results(data) for data in self._search_nodes("/search", payload, chat_id)]
+        if len(result_lists) == 1:
+            return result_lists[0]
+        # Nhiều shard: mỗi shard đã xếp hạng phần của nó, gộp lại theo similarity
+        return self._merge_results(result_lists, top_k)
+
+    def search_many(self, queries, chat_id: str = None, top_k: int = 3, threshold: float = 0.5,
+                    rrf_k: int = None):
+        payload = {"queries": list(queries), "chat_id": chat_id, "top_k": top_k, "threshold": threshold}
+        if chat_id is not None and len(self._nodes_for_chat(chat_id)) == 1:
+            # Chat nằm trọn trên một shard: shard đó gộp RRF luôn
+            return self._parse_results(self._search_nodes("/search_many", payload, chat_id)[0])
+
+        # Nhiều shard: hạng RRF của từng shard không so sánh được với nhau. Lấy danh sách
+        # của từng biến thể, gộp theo similarity giữa các shard, rồi mới gộp RRF
+        responses = self._search_nodes("/search_ranked", payload, chat_id)
+        shard_lists = [
+            [self._parse_results({"results": ranked}) for ranked in data["results"]] for data in responses
+        ]
+        variant_count = max((len(lists) for lists in shard_lists), default=0)
+        ranked_lists = [
+            self._merge_results([lists[i] for lists in shard_lists if i < len(lists)], top_k)
+            for i in range(variant_count)
+        ]
+        return reciprocal_rank_fusion(ranked_lists, top_k, rrf_k or config.RRF_K)
+
+    def get_embedding(self, text: str):
+        """Embedding của query do shard của chính câu query tính (mỗi shard có cache riêng)"""
+        with self.lock:
+            node = self.ring.get_node(text)
+        try:
+            data = self._call(node, "POST", "/embeddings/query", json={"query": text})
+        except httpx.HTTPError as e:
+            logger.error(f"Error generating embedding: {e}")
+            return None
+        return np.frombuffer(base64.b64decode(data["embedding"]), dtype=np.float32)
+
+    def _record_migration_delete(self, command):
+        with self.lock:
+            for deletes in self.migration_deletes.values():
+                deletes.append(command)
+
+    def delete_file(self, file_name: str):
+        self._record_migration_delete(("file", file_name))
+        return sum(data["deleted"] for data in self._broadcast("DELETE", "/files", params={"file_name": file_name}))
+
+    def delete_document(self, doc_id: str):
+        self._record_migration_delete(("document", doc_id))
+        return any(data["deleted"] for data in self._broadcast("DELETE", f"/documents/{doc_id}"))
+
+    def delete_chat_documents(self, chat_id: str):
+        self._record_migration_delete(("chat", chat_id))
+        return sum(
+            self._call(node, "DELETE", f"/chats/{chat_id}/documents")["deleted"]
+            for node in self._nodes_for_chat(chat_id)
+        )
+
+    def get_statistics(self, chat_id=None):
+        if chat_id is not None:
+            stats = [self._call(node, "GET", "/statistics", params={"chat_id": chat_id})
+                     for node in self._nodes_for_chat(chat_id)]
+        else:
+            stats = self._broadcast("GET", "/statistics")
+
+        file_types = {}
+        for data in stats:
+            for file_type, count in data["file_types"].items():
+                file_types[file_type] = file_types.get(file_type, 0) + count
+        return {
+            "document_count": sum(data["document_count"] for data in stats),
+            "file_types": file_types
+        }
+
+    def get_chat_documents(self, chat_id: str):
+        documents = {}
+        for node in reversed(self._nodes_for_chat(chat_id)):
+            for data in self._call(node, "GET", f"/chats/{chat_id}/documents")["documents"]:
+                documents[data["id"]] = Document.from_dict(data)
+        return documents
+
+    def set_nodes(self, nodes):
+        """
+        Đổi tập index server thành nodes và chuyển các chat đổi chủ trong một lượt, trả về
+        số chat đã chuyển. Chat đã nằm đúng shard không bị chuyển nên chạy lại là an toàn.
+        """
+        nodes = list(dict.fromkeys(nodes))
+        if not nodes:
+            raise ValueError("At least one index server is required")
+        with self.lock:
+            old_ring = self.ring.copy()
+            added = [node for node in nodes if node not in old_ring.nodes]
+            removed = [node for node in old_ring.nodes if node not in nodes]
+            for node in added:
+                self.clients[node] = self._create_client(node)
+                self.ring.add_node(node)
+            for node in removed:
+                self.ring.remove_node(node)
+        moved = self._rebalance(old_ring)
+        with self.lock:
+            for node in removed:
+                self.clients.pop(node).close()
+        return moved
+
+    def add_node(self, node: str):
+        """Thêm index server vào vòng hash và chuyển các chat nay thuộc về nó"""
+        return self.set_nodes(self.ring.nodes + [node])
+
+    def remove_node(self, node: str):
+        """Chuyển hết chat của node sang các shard còn lại rồi bỏ node khỏi vòng hash"""
+        return self.set_nodes([n for n in self.ring.nodes if n != node])
+
+    def _rebalance(self, old_ring: HashRing):
+        moved = 0
+        for node in old_ring.nodes:
+            for chat_id in self._call(node, "GET", "/chats")["chat_ids"]:
+                with self.lock:
+                    target = self.ring.get_node(chat_id)
+                if target != node:
+                    self._move_chat(chat_id, node, target)
+                    moved += 1
+        logger.info(f"Rebalanced {moved} chats across {len(self.ring.nodes)} index servers")
+        return moved
+
+    def _move_chat(self, chat_id: str, source: str, target: str):
+        # Ghi mới đã đi tới target theo vòng hash mới; search/xóa đọc cả hai shard tới khi xong
+        with self.lock:
+            self.migrating[chat_id] = source
+            self.migration_deletes[chat_id] = []
+        try:
+            # Vector được chuyển nguyên (base64 float32), shard mới không phải embed lại
+            data = self._call(source, "GET", f"/chats/{chat_id}/export")
+            self._call(target, "POST", "/documents/import", json=data)
+
+            # Lệnh xóa tới giữa lúc export và import có thể đã bị import ghi đè
+            with self.lock:
+                deletes = self.migration_deletes.pop(chat_id)
+            for kind, value in deletes:
+                if kind == "file":
+                    self._call(target, "DELETE", "/files", params={"file_name": value})
+                elif kind == "document":
+                    self._call(target, "DELETE", f"/documents/{value}")
+                elif value == chat_id:
+                    self._call(target, "DELETE", f"/chats/{chat_id}/documents")
+
+            self._call(source, "DELETE", f"/chats/{chat_id}/documents")
+        except httpx.HTTPStatusError as e:
+            # Chat đã bị xóa hết trên shard cũ trước khi kịp export
+            if e.response.status_code != 404:
+                raise
+        finally:
+            with self.lock:
+                self.migrating.pop(chat_id, None)
+                self.migration_deletes.pop(chat_id, None)
@@ -0,0 +1,231 @@
+import math
+import time
+import logging
+import numpy as np
+import faiss
+import config
+
+logger = logging.getLogger("doc_retrieval_api.index_factory")
+
+INDEX_TYPES = ("flat", "hnsw", "ivf", "ivfpq")
+CODECS = ("float32", "float16", "int8", "pq")
+
+
+def _largest_divisor(dimension: int, upper: int):
+    for m in range(min(upper, dimension), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+
+def _ivf_nlist(vector_count: int):
+    if config.IVF_NLIST:
+        return config.IVF_NLIST
+    # Faiss cần khoảng 39 vector train cho mỗi centroid
+    return max(1, min(int(4 * math.sqrt(vector_count)), vector_count // 39))
+
+
+def _scalar_quantizer_type(codec: str):
+    return {
+        "float16": faiss.ScalarQuantizer.QT_fp16,
+        "int8": faiss.ScalarQuantizer.QT_8bit,
+    }[codec]
+
+
+def _needs_training(codec: str):
+    return codec in ("int8", "pq")
+
+
+def target_index_spec(vector_count: int):
+    """(loại index, codec) một chat nên dùng với số vector hiện tại"""
+    index_type = "flat"
+    if config.INDEX_TYPE != "flat" and vector_count >= config.INDEX_PROMOTION_THRESHOLD:
+        index_type = config.INDEX_TYPE
+
+    # int8/PQ cần đủ vector để train, trước đó tạm lưu float16
+    codec = config.VECTOR_CODEC
+    if _needs_training(codec) and vector_count < config.VECTOR_CODEC_MIN_TRAIN:
+        codec = "float16"
+    if index_type == "ivfpq":
+        codec = "pq"
+    return index_type, codec
+
+
+def create_flat_index(dimension: int):
+    """Index rỗng cho chat mới, dùng codec không cần train"""
+    _, codec = target_index_spec(0)
+    return create_index("flat", dimension, codec=codec)
+
+
+def create_index(index_type: str, dimension: int, train_vectors: np.ndarray = None, codec: str = "float32"):
+    """
+    Tạo index (bọc trong IndexIDMap) theo loại và codec lưu vector:
+    float32 (nguyên bản), float16, int8 (scalar quantizer) hoặc pq (product quantizer).
+    IVF và codec int8/pq được train bằng train_vectors.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}', expected one of {INDEX_TYPES}")
+    if codec not in CODECS:
+        raise ValueError(f"Unknown vector codec '{codec}', expected one of {CODECS}")
+    if index_type == "ivfpq":
+        index_type, codec = "ivf", "pq"
+
+    pq_m = _largest_divisor(dimension, config.PQ_M)
+
+    if index_type == "flat":
+        if codec == "float32":
+            base = faiss.IndexFlatL2(dimension)
+        elif codec == "pq":
+            base = faiss.IndexPQ(dimension, pq_m, config.PQ_NBITS)
+        else:
+            base = faiss.IndexScalarQuantizer(dimension, _scalar_quantizer_type(codec))
+    elif index_type == "hnsw":
+        if codec == "float32":
+            base = faiss.IndexHNSWFlat(dimension, config.HNSW_M)
+        elif codec == "pq":
+            base = faiss.IndexHNSWPQ(dimension, pq_m, config.HNSW_M)
+        else:
+            base = faiss.IndexHNSWSQ(dimension, _scalar_quantizer_type(codec), config.HNSW_M)
+        base.hnsw.efConstruction = config.HNSW_EF_CONSTRUCTION
+    else:
+        nlist = _ivf_nlist(len(train_vectors) if train_vectors is not None else 0)
+        quantizer = faiss.IndexFlatL2(dimension)
+        if codec == "float32":
+            base = faiss.IndexIVFFlat(quantizer, dimension, nlist)
+        elif codec == "pq":
+            base = faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m, config.PQ_NBITS)
+        else:
+            base = faiss.IndexIVFScalarQuantizer(
+                quantizer, dimension, nlist, _scalar_quantizer_type(codec), faiss.METRIC_L2
+            )
+
+    if not base.is_trained:
+        if train_vectors is None or len(train_vectors) == 0:
+            raise ValueError(f"Index '{index_type}' with codec '{codec}' needs training vectors")
+        base.train(np.ascontiguousarray(train_vectors, dtype=np.float32))
+
+    index = faiss.IndexIDMap(base)
+    apply_search_params(index)
+    return index
+
+
+def index_kind(index):
+    base = faiss.downcast_index(index.index)
+    if isinstance(base, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(base, faiss.IndexIVFPQ):
+        return "ivfpq"
+    if isinstance(base, faiss.IndexIVF):
+        return "ivf"
+    return "flat"
+
+
+def index_codec(index):
+    base = faiss.downcast_index(index.index)
+    if isinstance(base, faiss.IndexHNSW):
+        base = faiss.downcast_index(base.storage)
+
+    if isinstance(base, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return "pq"
+    if isinstance(base, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        if base.sq.qtype == faiss.ScalarQuantizer.QT_fp16:
+            return "float16"
+        return "int8"
+    return "float32"
+
+
+def index_spec(index):
+    return index_kind(index), index_codec(index)
+
+
+def apply_search_params(index, ef_search: int = None, nprobe: int = None):
+    """Đặt tham số lúc search (không được lưu khi serialize nên cần gọi lại sau khi load)"""
+    base = faiss.downcast_index(index.index)
+    if isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efSearch = ef_search or config.HNSW_EF_SEARCH
+    elif isinstance(base, faiss.IndexIVF):
+        base.nprobe = min(nprobe or config.IVF_NPROBE, base.nlist)
+    return index
+
+
+def search_params(index, selector):
+    """
+    SearchParameters lọc id bằng selector, giữ efSearch / nprobe đang đặt trên index.
+    None nếu index không lọc được khi search (IndexPQ).
+    """
+    base = faiss.downcast_index(index.index)
+    if isinstance(base, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=base.hnsw.efSearch)
+    if isinstance(base, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=base.nprobe)
+    if isinstance(base, faiss.IndexPQ):
+        return None
+    return faiss.SearchParameters(sel=selector)
+
+
+def supports_remove_ids(index):
+    # Chỉ index flat (Flat/SQ/PQ) giữ vector theo đúng thứ tự id_map của IndexIDMap nên
+    # remove_ids dồn cả hai giống nhau. IVF xếp vector theo list (id_map bị dồn còn list thì
+    # không, id bị lệch), HNSW không hỗ trợ remove_ids: cả hai phải dựng lại từ vector gốc
+    return index_kind(index) == "flat"
+
+
+def build_index(vectors: np.ndarray, int_ids: np.ndarray, index_type: str = None, codec: str = None):
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    target_type, target_codec = target_index_spec(len(vectors))
+    index = create_index(
+        index_type or target_type, vectors.shape[1],
+        train_vectors=vectors, codec=codec or target_codec
+    )
+    index.add_with_ids(vectors, np.asarray(int_ids, dtype=np.int64))
+    return index
+
+
+def evaluate_recall(vectors: np.ndarray, queries: np.ndarray, top_k: int = 10, candidates=None):
+    """
+    So sánh recall@k và độ trễ của các cấu hình index với baseline flat.
+
+    candidates: list dict dạng {"index_type": "hnsw", "ef_search": 64},
+    {"index_type": "ivf", "nprobe": 8} hoặc {"index_type": "flat", "codec": "int8"};
+    mặc định thử các loại trong INDEX_TYPES với float32.
+    Trả về list dict, mỗi dict gồm recall, p50/p99 (ms), thời gian build (s)
+    và số byte index dùng cho mỗi vector.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    int_ids = np.arange(len(vectors), dtype=np.int64)
+    top_k = min(top_k, len(vectors))
+    candidates = candidates or [{"index_type": index_type} for index_type in INDEX_TYPES]
+
+    baseline = create_index("flat", vectors.shape[1], codec="float32")
+    baseline.add_with_ids(vectors, int_ids)
+    _, truth = baseline.search(queries, top_k)
+
+    results = []
+    for candidate in candidates:
+        start = time.perf_counter()
+        index = build_index(
+            vectors, int_ids, candidate["index_type"], candidate.get("codec", "float32")
+        )
+        build_seconds = time.perf_counter() - start
+        apply_search_params(index, candidate.get("ef_search"), candidate.get("nprobe"))
+
+        latencies = []
+        hits = 0
+        for i in range(len(queries)):
+            start = time.perf_counter()
+            _, found = index.search(queries[i:i + 1], top_k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            hits += len(set(found[0].tolist()) & set(truth[i].tolist()))
+
+        results.append({
+            **candidate,
+            "recall": hits / float(len(queries) * top_k),
+            "latency_p50_ms": float(np.percentile(latencies, 50)),
+            "latency_p99_ms": float(np.percentile(latencies, 99)),
+            "build_seconds": build_seconds,
+            "bytes_per_vector": faiss.serialize_index(index).size / float(index.ntotal)
+        })
+        logger.info(f"Evaluated {candidate}: {results[-1]}")
+
+    return results
@@ -1,268 +1,956 @@
 import os
-import json
+import time
+import threading
 import numpy as np
 import faiss
-import threading
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import config
 from ai.schemas import Document
-
-# Import Google Generative AI Embeddings
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
+from ai.services.index_store import IndexStore
+from ai.services import index_factory
+from ai.services.embedding_cache import EmbeddingCache
+from ai.services.embedding_providers import create_embedding_provider
+from ai.utils.rw_lock import ReadWriteLock
+from ai.utils.rank_fusion import reciprocal_rank_fusion
 
 logger = logging.getLogger("doc_retrieval_api.index_manager")
 
 
 class FAISSIndexManager:
-    def __init__(self,embedding_model_name , index_data_dir: str):
-        self.model = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
+    def __init__(self, embedding_model_name: str, index_data_dir: str, embedding_provider: str = None):
+        self.embedding_model = embedding_model_name
+        self.model = create_embedding_provider(
+            embedding_provider or config.EMBEDDING_PROVIDER, embedding_model_name
+        )
+        self.query_cache = EmbeddingCache(
+            max_size=config.QUERY_EMBEDDING_CACHE_SIZE,
+            ttl_seconds=config.QUERY_EMBEDDING_CACHE_TTL
+        )
 
         # Vì embedding dimension không có sẵn -> tạo khi có embedding đầu tiên
         self.embedding_dimension = None
         self.documents = {}
-        self.index = None
-        self.lock = threading.Lock()
+        # Mỗi chat_id có một index riêng (IndexIDMap), vector được gắn id số nguyên cố định
+        self.chat_indexes = {}
+        # int id đã xóa nhưng chưa compact khỏi index của từng chat
+        self.chat_tombstones = {}
+        # chat_id -> SearchParameters loại các tombstone khi search, dựng lại khi tombstone đổi
+        self.chat_search_params = {}
+        self.doc_int_ids = {}
+        self.int_id_to_doc = {}
+        # int id -> dòng vector trong store (nhiều document cùng nội dung dùng chung một dòng)
+        self.int_id_rows = {}
+        # Index phụ để tra theo chat / file mà không phải duyệt hết self.documents
+        self.chat_doc_ids = {}
+        self.source_doc_ids = {}
+        # Đếm số document theo file_type, tổng và theo từng chat (cho get_statistics)
+        self.file_type_counts = {}
+        self.chat_file_type_counts = {}
+        # Các chat có index thay đổi / bị xóa so với bản đã serialize trong snapshot
+        self.dirty_chats = set()
+        self.dropped_chats = set()
+        # File index đã nạp của từng chat; các chat đang đọc trực tiếp từ file mmap (chỉ đọc,
+        # dùng chung page cache giữa các worker) được copy vào RAM trước lần sửa đầu tiên
+        self.chat_index_files = {}
+        self.mapped_chats = set()
+        # chat_id -> (loại index, codec) của các chat chờ dựng lại (promote / compact index
+        # không remove_ids được); None là theo target_index_spec. Dựng ngoài lock, ở nền
+        self.pending_rebuilds = {}
+        # chat_id -> index flat nhỏ trong RAM chứa vector thêm sau khi index của chat được mmap
+        # từ snapshot, để mỗi worker không phải copy cả index mmap vào RAM khi có document mới.
+        # Search tìm trên cả hai; checkpoint ghi bản gộp và snapshot mới thay cả hai.
+        self.chat_delta_indexes = {}
+        self.chat_delta_ids = {}
+        self.rebuild_thread = None
+        self.rebuild_thread_lock = threading.Lock()
+        # Search/thống kê giữ read lock (chạy song song), áp thay đổi từ WAL/load giữ write lock.
+        # Không gọi API embedding hay ghi WAL khi đang giữ lock.
+        self.lock = ReadWriteLock()
         self.index_data_dir = index_data_dir
         self.ensure_data_dir()
+        self.store = IndexStore(
+            index_data_dir, self.embedding_model,
+            vector_dtype="float32" if config.VECTOR_CODEC == "float32" else "float16",
+            wal_sync=config.WAL_SYNC
+        )
+        self.checkpoint_lock = threading.Lock()
+        # Đọc WAL (có thể phải chờ khóa file khi process khác checkpoint) ngoài write lock;
+        # mutex này giữ cho các lô sự kiện được áp đúng thứ tự
+        self.refresh_lock = threading.Lock()
+        self.last_checkpoint = time.monotonic()
 
     def ensure_data_dir(self):
         if not os.path.exists(self.index_data_dir):
             os.makedirs(self.index_data_dir)
-            os.makedirs(os.path.join(self.index_data_dir, "documents"))
             logger.info(f"Created index data directory at {self.index_data_dir}")
 
     def get_embedding(self, text: str):
-        """Sinh embedding từ GoogleGenerativeAIEmbeddings"""
+        """Sinh embedding cho query bằng embedding provider, câu hỏi lặp lại lấy từ cache"""
+        cache_key = EmbeddingCache.make_key(text, self.embedding_model)
+        embedding = self.query_cache.get(cache_key)
+        if embedding is not None:
+            return embedding
+
         try:
-            embeddings = self.model.embed_query(text)
-            return np.array(embeddings, dtype=np.float32)
+            embedding = self.model.embed_query(text)
         except Exception as e:
             logger.error(f"Error generating embedding: {e}")
             return None
 
+        self.query_cache.put(cache_key, embedding)
+        return embedding
+
+    def get_query_embeddings(self, texts):
+        """Embed nhiều query: lấy từ cache nếu có, phần còn lại embed trong một lần gọi"""
+        cache_keys = [EmbeddingCache.make_key(text, self.embedding_model) for text in texts]
+        embeddings = [self.query_cache.get(key) for key in cache_keys]
+
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            try:
+                computed = self.model.embed_queries([texts[i] for i in missing])
+            except Exception as e:
+                logger.error(f"Error generating embeddings for {len(missing)} queries: {e}")
+                return None
+            for i, embedding in zip(missing, computed):
+                self.query_cache.put(cache_keys[i], embedding)
+                embeddings[i] = embedding
+
+        return np.array(embeddings, dtype=np.float32)
+
+    def get_embeddings(self, texts):
+        """Sinh embedding cho nhiều đoạn text trong một lần gọi embed_documents"""
+        try:
+            return self.model.embed_documents(texts)
+        except Exception as e:
+            logger.error(f"Error generating embeddings for batch of {len(texts)}: {e}")
+            return None
+
     def add_document(self, document: Document):
-        with self.lock:
+        self.refresh()
+        with self.lock.read():
             if document.id in self.documents:
                 return False
 
-            # Tạo embedding
-            embedding = self.get_embedding(document.content)
-            if embedding is None:
+        content_hash = self.store.content_hash(document.content)
+        vector_row = self.store.lookup_vector_rows([content_hash]).get(content_hash)
+        if vector_row is None:
+            # Tạo embedding (không đi qua cache của query)
+            embeddings = self.get_embeddings([document.content])
+            if embeddings is None:
                 return False
+            vector_row = self.store.add_vectors([content_hash], embeddings)[0]
+
+        # Ghi WAL ngoài lock để các upload song song fsync chung một lần
+        int_ids = self.store.save_documents([document], [vector_row])
+        self.refresh()
+        self._maybe_checkpoint()
+        with self.lock.read():
+            return int(int_ids[0]) in self.int_id_to_doc
+
+    def add_documents(self, documents, batch_size: int = None, max_concurrency: int = None):
+        """
+        Thêm nhiều document. Chunk có nội dung đã từng được embed (cùng model) dùng lại vector
+        trong store; phần còn lại được embed theo batch song song.
+        Mỗi batch document chỉ gọi index.add một lần.
+        """
+        batch_size = batch_size or config.EMBEDDING_BATCH_SIZE
+        max_concurrency = max_concurrency or config.EMBEDDING_MAX_CONCURRENCY
+
+        self.refresh()
+        with self.lock.read():
+            documents = [doc for doc in documents if doc.id not in self.documents]
+        if not documents:
+            return 0
+
+        content_hashes = [self.store.content_hash(doc.content) for doc in documents]
+        known_rows = self.store.lookup_vector_rows(content_hashes)
+
+        # Chỉ embed nội dung chưa có, mỗi nội dung một lần
+        missing = {}
+        for content_hash, doc in zip(content_hashes, documents):
+            if content_hash not in known_rows:
+                missing.setdefault(content_hash, doc.content)
+        missing_hashes = list(missing.keys())
+        embed_batches = [
+            missing_hashes[i:i + batch_size] for i in range(0, len(missing_hashes), batch_size)
+        ]
+
+        # Gọi API embedding ngoài lock để search vẫn chạy được trong lúc ingest
+        if embed_batches:
+            with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                futures = [
+                    executor.submit(self.get_embeddings, [missing[h] for h in hashes])
+                    for hashes in embed_batches
+                ]
+                for hashes, future in zip(embed_batches, futures):
+                    embeddings = future.result()
+                    if embeddings is None:
+                        continue
+                    known_rows.update(zip(hashes, self.store.add_vectors(hashes, embeddings)))
+
+        # Chunk embed lỗi thì bỏ qua
+        stored = [
+            (doc, known_rows[content_hash])
+            for doc, content_hash in zip(documents, content_hashes)
+            if content_hash in known_rows
+        ]
+        return self._save_stored(stored, batch_size)
+
+    def import_documents(self, documents, vectors: np.ndarray, batch_size: int = None):
+        """
+        Thêm document kèm vector đã có sẵn (ví dụ chuyển chat giữa các index server),
+        không gọi embedding provider. Document đã có được bỏ qua.
+        """
+        batch_size = batch_size or config.EMBEDDING_BATCH_SIZE
+        self.refresh()
+        with self.lock.read():
+            keep = [i for i, doc in enumerate(documents) if doc.id not in self.documents]
+        if not keep:
+            return 0
+
+        documents = [documents[i] for i in keep]
+        content_hashes = [self.store.content_hash(doc.content) for doc in documents]
+        vector_rows = self.store.add_vectors(content_hashes, np.asarray(vectors, dtype=np.float32)[keep])
+        return self._save_stored(list(zip(documents, vector_rows)), batch_size)
+
+    def _save_stored(self, stored, batch_size: int):
+        """Ghi các cặp (document, dòng vector) vào WAL, trả về số document được thêm"""
+        # Mỗi batch được ghi WAL rồi áp vào index ngay để search thấy dần trong lúc ingest
+        int_ids = []
+        for i in range(0, len(stored), batch_size):
+            batch_docs = [doc for doc, _ in stored[i:i + batch_size]]
+            batch_rows = [row for _, row in stored[i:i + batch_size]]
+            int_ids.extend(self.store.save_documents(batch_docs, batch_rows).tolist())
+            self.refresh()
+
+        self._maybe_checkpoint()
+        with self.lock.read():
+            return sum(1 for int_id in int_ids if int_id in self.int_id_to_doc)
+
+    def refresh(self):
+        """
+        Áp các thay đổi mới trong WAL vào index trong RAM: thay đổi do process này ghi
+        và do worker khác ghi vào cùng INDEX_DATA_DIR, theo đúng thứ tự trong log.
+        """
+        if not self.store.has_updates():
+            return
+        with self.refresh_lock:
+            events = self.store.poll()
+            if events:
+                with self.lock.write():
+                    self._apply_events(events)
+
+    def _apply_events(self, events):
+        """Gọi khi đang giữ write lock"""
+        for kind, data in events:
+            if kind == "documents":
+                self._apply_documents(data)
+            elif kind == "delete":
+                self._apply_deletes(data)
+            elif kind == "snapshot":
+                self._apply_snapshot(data)
+            elif kind == "reload":
+                # Trạng thái nạp lại đã gồm các sự kiện phía sau
+                self._load_state()
+                break
+
+    def _apply_documents(self, entries):
+        """Thêm document (int_id, vector_row, Document) đã có trong WAL vào index"""
+        new_entries = []
+        duplicate_ids = []
+        for int_id, vector_row, doc in entries:
+            if doc.id in self.documents:
+                duplicate_ids.append(int_id)
+            elif int_id not in self.int_id_to_doc:
+                new_entries.append((int(int_id), int(vector_row), doc))
+
+        # Document đã được thêm bởi request khác trong lúc ghi log
+        if duplicate_ids:
+            self.store.delete_documents(duplicate_ids)
+        if not new_entries:
+            return
 
-            document.embedding = embedding.tolist()
-
-            # Nếu chưa khởi tạo dimension, khởi tạo FAISS index
-            if self.embedding_dimension is None:
-                self.embedding_dimension = len(embedding)
-                self.index = faiss.IndexFlatL2(self.embedding_dimension)
-
-            # Thêm vào index
-            self.index.add(np.array([embedding], dtype=np.float32))
-
-            # Lưu document
-            self.documents[document.id] = document
+        if self.embedding_dimension is None:
+            self.embedding_dimension = self.store.dimension
+
+        int_ids = np.array([int_id for int_id, _, _ in new_entries], dtype=np.int64)
+        vectors = self._vectors_for_rows([vector_row for _, vector_row, _ in new_entries])
+
+        # Gom theo chat để mỗi index chỉ nhận một lần add
+        chat_batches = {}
+        for position, (int_id, vector_row, doc) in enumerate(new_entries):
+            self._register_document(doc, int_id, vector_row)
+            chat_batches.setdefault(doc.chat_id, []).append(position)
+
+        for chat_id, positions in chat_batches.items():
+            self._add_to_chat_index(chat_id, vectors[positions], int_ids[positions])
+            self._maybe_promote_chat_index(chat_id)
+
+    def _apply_deletes(self, int_ids):
+        affected_chats = set()
+        delta_removed = {}
+        for int_id in int_ids:
+            doc_id = self.int_id_to_doc.get(int(int_id))
+            if doc_id is None:
+                continue
+            chat_id, int_id = self._remove_document(doc_id)
+            affected_chats.add(chat_id)
+            if int_id in self.chat_delta_ids.get(chat_id, ()):
+                delta_removed.setdefault(chat_id, []).append(int_id)
+
+        # Vector trong index delta được xóa luôn (index flat nhỏ), không thành tombstone
+        for chat_id, removed in delta_removed.items():
+            self.chat_delta_ids[chat_id].difference_update(removed)
+            self.chat_delta_indexes[chat_id].remove_ids(np.array(removed, dtype=np.int64))
+            self.dirty_chats.add(chat_id)
+
+        for chat_id in affected_chats:
+            self._maybe_compact_chat_index(chat_id)
+
+    def _apply_snapshot(self, files):
+        """
+        Process khác (hoặc process này) vừa checkpoint: đổi index của các chat sang file mới
+        trong snapshot (mmap) để các worker lại dùng chung một bản
+        """
+        self.dropped_chats &= set(files)
+        for chat_id, path in files.items():
+            if self.chat_index_files.get(chat_id) == path or chat_id not in self.chat_doc_ids:
+                continue
+            try:
+                index = self.store.read_chat_index(path)
+            except Exception as e:
+                # File đã bị checkpoint sau thay thế, giữ index hiện tại
+                logger.warning(f"Could not map index file of chat {chat_id}: {e}")
+                continue
+            live_ids = {self.doc_int_ids[doc_id] for doc_id in self.chat_doc_ids[chat_id]}
+            self._install_saved_index(chat_id, index, live_ids, path)
+            # Index trong snapshot có thể đã được process khác dựng lại
+            self.pending_rebuilds.pop(chat_id, None)
+            self._maybe_promote_chat_index(chat_id)
+            self._maybe_compact_chat_index(chat_id)
+
+    def _install_saved_index(self, chat_id: str, index, live_ids: set, path: str = None):
+        """
+        Dùng index đã lưu cho chat: id không còn document là tombstone,
+        document chưa có trong index thì thêm từ ma trận vector
+        """
+        index_factory.apply_search_params(index)
+        indexed_ids = set(faiss.vector_to_array(index.id_map).tolist())
+        self.chat_indexes[chat_id] = index
+        self.chat_tombstones[chat_id] = indexed_ids - live_ids
+        self.chat_delta_indexes.pop(chat_id, None)
+        self.chat_delta_ids.pop(chat_id, None)
+        self.dirty_chats.discard(chat_id)
+        if path is not None:
+            self.chat_index_files[chat_id] = path
+            self.mapped_chats.add(chat_id)
+        else:
+            self.mapped_chats.discard(chat_id)
+
+        missing_ids = sorted(live_ids - indexed_ids)
+        if missing_ids:
+            missing_ids = np.array(missing_ids, dtype=np.int64)
+            self._add_to_chat_index(chat_id, self._vectors_for_int_ids(missing_ids), missing_ids)
+
+    def _register_document(self, doc: Document, int_id: int, vector_row: int):
+        self.documents[doc.id] = doc
+        self.doc_int_ids[doc.id] = int_id
+        self.int_id_to_doc[int_id] = doc.id
+        self.int_id_rows[int_id] = vector_row
+
+        self.chat_doc_ids.setdefault(doc.chat_id, set()).add(doc.id)
+        self.source_doc_ids.setdefault(doc.source, set()).add(doc.id)
+        file_type = doc.metadata.get("file_type", "unknown")
+        self._update_count(self.file_type_counts, file_type, 1)
+        self._update_count(self.chat_file_type_counts.setdefault(doc.chat_id, {}), file_type, 1)
+
+    @staticmethod
+    def _update_count(counts: dict, key, delta: int):
+        counts[key] = counts.get(key, 0) + delta
+        if counts[key] <= 0:
+            del counts[key]
+
+    @staticmethod
+    def _discard_from(mapping: dict, key, doc_id: str):
+        doc_ids = mapping.get(key)
+        if doc_ids is not None:
+            doc_ids.discard(doc_id)
+            if not doc_ids:
+                del mapping[key]
+
+    def _vectors_for_rows(self, vector_rows):
+        return self.store.get_vectors(vector_rows)
+
+    def _vectors_for_int_ids(self, int_ids):
+        return self._vectors_for_rows([self.int_id_rows[int(i)] for i in int_ids])
+
+    def _add_to_chat_index(self, chat_id: str, vectors, int_ids):
+        """
+        Thêm vector vào index của chat; chat đang dùng index mmap thì thêm vào index delta
+        thay vì copy index mmap vào RAM
+        """
+        if chat_id in self.mapped_chats:
+            index = self.chat_delta_indexes.get(chat_id)
+            if index is None:
+                index = index_factory.create_flat_index(self.embedding_dimension)
+                self.chat_delta_indexes[chat_id] = index
+                self.chat_delta_ids[chat_id] = set()
+            self.chat_delta_ids[chat_id].update(int_ids.tolist())
+        else:
+            index = self._get_or_create_chat_index(chat_id)
+        index.add_with_ids(vectors, int_ids)
+        self.dirty_chats.add(chat_id)
+
+    def _merged_chat_index(self, chat_id: str):
+        """Index của chat gồm cả index delta, để ghi snapshot; gọi khi đang giữ lock"""
+        index = self.chat_indexes.get(chat_id)
+        delta_ids = self.chat_delta_ids.get(chat_id)
+        if index is None or not delta_ids:
+            return index
+        merged = faiss.deserialize_index(faiss.serialize_index(index))
+        delta_ids = np.array(sorted(delta_ids), dtype=np.int64)
+        merged.add_with_ids(self._vectors_for_int_ids(delta_ids), delta_ids)
+        return merged
+
+    def _chat_vector_count(self, chat_id: str):
+        """Số vector còn sống của chat, tính cả index delta"""
+        index = self.chat_indexes[chat_id]
+        return index.ntotal - len(self.chat_tombstones[chat_id]) + len(self.chat_delta_ids.get(chat_id, ()))
+
+    def _get_or_create_chat_index(self, chat_id: str):
+        """Index có thể sửa của chat: tạo mới, hoặc copy vào RAM nếu đang đọc từ file mmap"""
+        index = self.chat_indexes.get(chat_id)
+        if index is None:
+            index = index_factory.create_flat_index(self.embedding_dimension)
+            self.chat_indexes[chat_id] = index
+            self.chat_tombstones[chat_id] = set()
+        elif chat_id in self.mapped_chats:
+            index = self._merged_chat_index(chat_id)
+            if index is self.chat_indexes[chat_id]:
+                index = faiss.deserialize_index(faiss.serialize_index(index))
+            index_factory.apply_search_params(index)
+            self.chat_indexes[chat_id] = index
+            self.chat_delta_indexes.pop(chat_id, None)
+            self.chat_delta_ids.pop(chat_id, None)
+            self.mapped_chats.discard(chat_id)
+        return index
+
+    def _chat_live_ids(self, chat_id: str):
+        index = self.chat_indexes[chat_id]
+        int_ids = faiss.vector_to_array(index.id_map)
+        tombstones = self.chat_tombstones[chat_id]
+        if tombstones:
+            int_ids = int_ids[~np.isin(int_ids, list(tombstones))]
+        delta_ids = self.chat_delta_ids.get(chat_id)
+        if delta_ids:
+            int_ids = np.concatenate([int_ids, np.fromiter(delta_ids, dtype=np.int64, count=len(delta_ids))])
+        return np.sort(int_ids)
+
+    def _schedule_rebuild(self, chat_id: str, index_type: str = None, codec: str = None):
+        """Đánh dấu chat cần dựng lại index; gọi khi đang giữ write lock, không dựng ngay"""
+        if index_type is None and codec is None and chat_id in self.pending_rebuilds:
+            # Đã chờ promote: lần dựng đó cũng bỏ các tombstone
+            return
+        self.pending_rebuilds[chat_id] = (index_type, codec)
+
+    def _rebuild_chat_index(self, chat_id: str):
+        """
+        Dựng lại index của chat từ ma trận vector trong store, bỏ luôn các tombstone.
+        Chụp id / vector dưới read lock, build (chậm: HNSW 100k vector mất cả phút) không giữ
+        lock nào, rồi chỉ giữ write lock lúc thay index: document thêm trong lúc build được
+        add vào index mới, document bị xóa thành tombstone. Trả về True nếu đã thay index.
+        """
+        with self.lock.read():
+            spec = self.pending_rebuilds.get(chat_id)
+            if spec is None or chat_id not in self.chat_indexes:
+                return False
+            int_ids = self._chat_live_ids(chat_id)
+            vectors = self._vectors_for_int_ids(int_ids) if len(int_ids) else None
 
-            # Lưu ra file
-            self._save_document(document)
+        new_index = None
+        if vectors is not None:
+            new_index = index_factory.build_index(vectors, int_ids, *spec)
 
-            return True
+        with self.lock.write():
+            if self.pending_rebuilds.get(chat_id) != spec:
+                # Chat bị xóa / nạp lại, hoặc đã nhận index dựng sẵn từ snapshot
+                return False
+            del self.pending_rebuilds[chat_id]
+            if new_index is None or chat_id not in self.chat_doc_ids:
+                return False
+            live_ids = {self.doc_int_ids[doc_id] for doc_id in self.chat_doc_ids[chat_id]}
+            self._install_saved_index(chat_id, new_index, live_ids)
+            self.dirty_chats.add(chat_id)
+            self._maybe_compact_chat_index(chat_id)
+        logger.info(f"Rebuilt index of chat {chat_id} as {index_factory.index_spec(new_index)}")
+        return True
+
+    def rebuild_pending_indexes(self, blocking: bool = True):
+        """
+        Dựng lại index của các chat đang chờ (promote / compact) rồi checkpoint để các worker
+        khác dùng luôn file index mới thay vì tự dựng lại. Chỉ một process làm việc này cùng
+        lúc; blocking=False thì bỏ qua (trả về 0) nếu thread / process khác đang dựng.
+        Trả về số chat đã dựng lại.
+        """
+        rebuild_lock = self.store.rebuild_lock
+        with rebuild_lock.exclusive() if blocking else rebuild_lock.try_exclusive() as acquired:
+            if acquired is False:
+                return 0
+            # Nhận index process khác vừa dựng (nếu có) trước khi tự dựng
+            self.refresh()
+            with self.lock.read():
+                chat_ids = list(self.pending_rebuilds)
+            rebuilt = sum(1 for chat_id in chat_ids if self._rebuild_chat_index(chat_id))
+            if rebuilt:
+                # Checkpoint trước khi nhả rebuild lock: process khác chờ khóa sẽ thấy snapshot mới
+                self.checkpoint()
+        return rebuilt
+
+    def _start_rebuild_thread(self):
+        """Dựng lại các index đang chờ trong thread nền để request ghi không phải đợi"""
+        with self.rebuild_thread_lock:
+            if not self.pending_rebuilds or (self.rebuild_thread and self.rebuild_thread.is_alive()):
+                return
+            self.rebuild_thread = threading.Thread(
+                target=self._rebuild_in_background, name="index-rebuild", daemon=True
+            )
+            self.rebuild_thread.start()
 
-    def _save_document(self, document: Document):
-        doc_data = {
-            "id": document.id,
-            "content": document.content,
-            "source": document.source,
-            "metadata": document.metadata,
-            "created_at": document.created_at,
-            "chat_id": document.chat_id,
-            "embedding": document.embedding  # Lưu luôn embedding
-        }
+    def _rebuild_in_background(self):
+        try:
+            self.rebuild_pending_indexes(blocking=False)
+        except Exception as e:
+            logger.error(f"Error rebuilding chat indexes: {e}")
+
+    def _maybe_promote_chat_index(self, chat_id: str):
+        """
+        Chuyển chat từ flat sang index ANN (config.INDEX_TYPE) khi vượt ngưỡng,
+        và sang codec nén (config.VECTOR_CODEC) khi đủ vector để train.
+        Chỉ nâng cấp, không hạ cấp khi chat nhỏ lại sau khi xóa.
+        """
+        index = self.chat_indexes[chat_id]
+        current_type, current_codec = index_factory.index_spec(index)
+        live_count = self._chat_vector_count(chat_id)
+        index_type, codec = index_factory.target_index_spec(live_count)
+
+        type_upgrade = current_type == "flat" and index_type != "flat"
+        codec_upgrade = codec != current_codec and (codec == config.VECTOR_CODEC or type_upgrade)
+        if not type_upgrade and not codec_upgrade:
+            return
 
-        path = os.path.join(self.index_data_dir, "documents", f"{document.id}.json")
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(doc_data, f, ensure_ascii=False, indent=2)
+        index_type = index_type if type_upgrade else current_type
+        if self.pending_rebuilds.get(chat_id) != (index_type, codec):
+            self._schedule_rebuild(chat_id, index_type, codec)
+            logger.info(f"Scheduled promotion of chat {chat_id} to {index_type}/{codec} ({live_count} vectors)")
+
+    def evaluate_chat_index(self, chat_id: str, top_k: int = 10, query_count: int = 100, candidates=None):
+        """
+        Đo recall@k / độ trễ của các cấu hình index trên vector của một chat so với flat.
+        Query là các vector lấy ngẫu nhiên từ chính chat đó.
+        """
+        self.refresh()
+        with self.lock.read():
+            if chat_id not in self.chat_indexes:
+                return []
+            int_ids = self._chat_live_ids(chat_id)
+            vectors = self._vectors_for_int_ids(int_ids)
+
+        rng = np.random.default_rng(0)
+        queries = vectors[rng.choice(len(vectors), min(query_count, len(vectors)), replace=False)]
+        return index_factory.evaluate_recall(vectors, queries, top_k, candidates)
+
+    def checkpoint(self):
+        """
+        Ghi snapshot: document/vector trong WAL và index của các chat đã thay đổi
+        (để lần khởi động sau không phải dựng lại), rồi xóa WAL.
+        Chỉ giữ read lock lúc serialize index; ghi file, fsync, sqlite và xoay WAL chạy ngoài
+        lock của manager nên search và refresh() không phải đợi phần I/O đó.
+        """
+        with self.checkpoint_lock:
+            self._checkpoint_outside_lock()
+        # Chuyển các chat vừa ghi sang file mmap
+        self.refresh()
+
+    def _serialize_changed_chats(self):
+        """Serialize index của các chat đã thay đổi rồi bỏ đánh dấu; gọi khi đang giữ lock"""
+        changed_chats = self.dirty_chats | self.dropped_chats
+        serialized = self.store.serialize_chat_indexes(
+            {chat_id: self._merged_chat_index(chat_id) for chat_id in changed_chats}
+        )
+        self.dirty_chats.clear()
+        self.dropped_chats.clear()
+        return serialized
+
+    def _write_checkpoint(self):
+        """Checkpoint ngay trong lock, gọi khi đang giữ write lock (lúc nạp từ đĩa)"""
+        self.store.checkpoint(self._serialize_changed_chats())
+        self.last_checkpoint = time.monotonic()
+
+    def _checkpoint_outside_lock(self):
+        """
+        Gọi khi giữ checkpoint_lock và không giữ lock của manager. Document thêm / xóa sau
+        lúc serialize vẫn vào snapshot qua WAL; khi nạp index từ snapshot chúng được thêm lại
+        hoặc thành tombstone (_install_saved_index).
+        """
+        self.refresh()
+        with self.lock.read():
+            serialized = self._serialize_changed_chats()
+        try:
+            self.store.checkpoint(serialized)
+        except Exception:
+            # Chưa ghi được: lần checkpoint sau ghi lại các chat này
+            with self.lock.write():
+                for chat_id in serialized:
+                    if chat_id in self.chat_indexes:
+                        self.dirty_chats.add(chat_id)
+                    else:
+                        self.dropped_chats.add(chat_id)
+            raise
+        self.last_checkpoint = time.monotonic()
+
+    def _maybe_checkpoint(self):
+        """
+        Checkpoint khi WAL đủ lớn hoặc đã lâu chưa checkpoint, và dựng lại ở nền các index
+        đang chờ; gọi ngoài lock
+        """
+        self._start_rebuild_thread()
+        wal_size = self.store.wal_size()
+        if wal_size == 0:
+            return
+        if (wal_size < config.WAL_CHECKPOINT_BYTES
+                and time.monotonic() - self.last_checkpoint < config.WAL_CHECKPOINT_INTERVAL):
+            return
+        # Đang có thread khác checkpoint thì thôi
+        if not self.checkpoint_lock.acquire(blocking=False):
+            return
+        try:
+            self._checkpoint_outside_lock()
+        finally:
+            self.checkpoint_lock.release()
+        self.refresh()
 
     def search(self, query: str, chat_id: str = None, top_k: int = 3, threshold: float = 0.5):
-        with self.lock:
-            if chat_id is not None:
-                filtered_docs = {
-                    doc_id: doc for doc_id, doc in self.documents.items() if doc.chat_id == chat_id
-                }
-
-            if len(filtered_docs) == 0:
+        self.refresh()
+        with self.lock.read():
+            if chat_id is not None and chat_id not in self.chat_indexes:
                 return []
-
-            # Tạo embedding cho query
-            query_embedding = self.get_embedding(query)
-            if query_embedding is None or self.index is None:
+            if not self.chat_indexes:
                 return []
 
-            # Tìm kiếm
-            distances, indices = self.index.search(
-                np.array([query_embedding], dtype=np.float32),
-                min(top_k * 3, len(self.documents))
-            )
-
-            results = []
-            doc_ids = list(self.documents.keys())
+        # Tạo embedding cho query, ngoài lock
+        query_embedding = self.get_embedding(query)
+        if query_embedding is None:
+            return []
+
+        query_vectors = np.array([query_embedding], dtype=np.float32)
+        with self.lock.read():
+            return self._search_vectors(query_vectors, chat_id, top_k, threshold)[0]
+
+    def search_many(self, queries, chat_id: str = None, top_k: int = 3, threshold: float = 0.5,
+                    rrf_k: int = None):
+        """
+        Tìm với nhiều biến thể của câu hỏi: embed tất cả trong một lần gọi, search một lần
+        với ma trận nhiều dòng, rồi gộp các danh sách kết quả bằng reciprocal-rank fusion.
+        Trả về list (doc, similarity) sắp theo điểm RRF; similarity là giá trị cao nhất
+        của document đó trên các biến thể.
+        """
+        ranked_lists = self.search_ranked(queries, chat_id, top_k, threshold)
+        return reciprocal_rank_fusion(ranked_lists, top_k, rrf_k or config.RRF_K)
+
+    def search_ranked(self, queries, chat_id: str = None, top_k: int = 3, threshold: float = 0.5):
+        """
+        Phần search của search_many, chưa gộp: một danh sách (doc, similarity) sắp theo
+        similarity cho mỗi biến thể (đã bỏ trùng / rỗng, giữ thứ tự). Dùng khi phải gộp
+        kết quả của nhiều shard trước khi tính RRF.
+        """
+        queries = list(dict.fromkeys(query.strip() for query in queries if query and query.strip()))
+        if not queries:
+            return []
+
+        self.refresh()
+        with self.lock.read():
+            if chat_id is not None and chat_id not in self.chat_indexes:
+                return []
+            if not self.chat_indexes:
+                return []
 
-            for i, idx in enumerate(indices[0]):
-                if idx < 0 or idx >= len(doc_ids):
+        query_vectors = self.get_query_embeddings(queries)
+        if query_vectors is None:
+            return []
+
+        with self.lock.read():
+            return self._search_vectors(query_vectors, chat_id, top_k, threshold)
+
+    def _search_vectors(self, query_vectors, chat_id, top_k, threshold):
+        """
+        Tìm trên index của chat (hoặc mọi chat nếu chat_id là None), mỗi index chỉ gọi
+        search một lần cho cả ma trận query. Trả về một danh sách kết quả cho mỗi query.
+        Gọi khi đang giữ read lock.
+        """
+        if chat_id is not None:
+            chat_ids = [chat_id] if chat_id in self.chat_indexes else []
+        else:
+            chat_ids = list(self.chat_indexes.keys())
+
+        results = [[] for _ in range(len(query_vectors))]
+
+        # Chỉ tìm trong index của các chat liên quan, không cần lọc lại theo chat_id
+        for cid in chat_ids:
+            index = self.chat_indexes[cid]
+            tombstones = self.chat_tombstones[cid]
+            k = min(top_k, index.ntotal)
+            if k > 0:
+                # Faiss bỏ qua các id đã xóa ngay khi search, k không tăng theo số tombstone
+                params = self._tombstone_search_params(cid, index, tombstones) if tombstones else None
+                if tombstones and params is None:
+                    # Index không lọc được id: lấy dư đúng bằng số vector đã xóa để bù
+                    k = min(top_k + len(tombstones), index.ntotal)
+                distances, ids = index.search(query_vectors, k, params=params)
+                self._collect_hits(results, distances, ids, tombstones, threshold)
+
+            # Vector thêm sau khi index được mmap (không có tombstone)
+            delta = self.chat_delta_indexes.get(cid)
+            if delta is not None and delta.ntotal:
+                distances, ids = delta.search(query_vectors, min(top_k, delta.ntotal))
+                self._collect_hits(results, distances, ids, (), threshold)
+
+        for row in range(len(results)):
+            results[row].sort(key=lambda item: item[1], reverse=True)
+            results[row] = results[row][:top_k]
+        return results
+
+    def _collect_hits(self, results, distances, ids, tombstones, threshold):
+        for row in range(len(results)):
+            for i, int_id in enumerate(ids[row]):
+                if int_id < 0 or int_id in tombstones:
                     continue
 
-                distance = distances[0][i]
+                distance = distances[row][i]
                 similarity = 1.0 / (1.0 + distance)
 
                 if similarity < threshold:
                     continue
 
-                doc_id = doc_ids[idx]
-                doc = self.documents[doc_id]
-
-                if chat_id is not None and doc.chat_id != chat_id:
-                    continue
-
-                results.append((doc, similarity))
-
-                if len(results) >= top_k:
-                    break
-
-            return results
+                results[row].append((self.documents[self.int_id_to_doc[int_id]], similarity))
+
+    def _tombstone_search_params(self, chat_id: str, index, tombstones: set):
+        """
+        SearchParameters loại các tombstone của chat (None nếu index không hỗ trợ), dùng lại
+        tới khi index hoặc tập tombstone đổi. Gọi khi đang giữ read lock: tombstone chỉ đổi
+        dưới write lock, và chỉ được thêm vào hoặc thay bằng tập mới.
+        """
+        cached = self.chat_search_params.get(chat_id)
+        if cached is not None and cached[0] is index and cached[1] is tombstones and cached[2] == len(tombstones):
+            return cached[3]
+
+        batch = faiss.IDSelectorBatch(np.fromiter(tombstones, dtype=np.int64, count=len(tombstones)))
+        selector = faiss.IDSelectorNot(batch)
+        params = index_factory.search_params(index, selector)
+        # Giữ batch / selector: SearchParameters chỉ giữ con trỏ tới chúng
+        self.chat_search_params[chat_id] = (index, tombstones, len(tombstones), params, batch, selector)
+        return params
+
+    def _remove_document(self, doc_id: str):
+        """Xóa document khỏi bộ nhớ và đánh dấu tombstone, chi phí O(1)"""
+        doc = self.documents.pop(doc_id)
+        int_id = self.doc_int_ids.pop(doc_id)
+        del self.int_id_to_doc[int_id]
+        del self.int_id_rows[int_id]
+
+        self._discard_from(self.chat_doc_ids, doc.chat_id, doc_id)
+        self._discard_from(self.source_doc_ids, doc.source, doc_id)
+        file_type = doc.metadata.get("file_type", "unknown")
+        self._update_count(self.file_type_counts, file_type, -1)
+        chat_counts = self.chat_file_type_counts.get(doc.chat_id, {})
+        self._update_count(chat_counts, file_type, -1)
+        if not chat_counts:
+            self.chat_file_type_counts.pop(doc.chat_id, None)
+        # Id trong index delta được xóa hẳn ở _apply_deletes
+        if doc.chat_id in self.chat_tombstones and int_id not in self.chat_delta_ids.get(doc.chat_id, ()):
+            self.chat_tombstones[doc.chat_id].add(int_id)
+        return doc.chat_id, int_id
+
+    def _maybe_compact_chat_index(self, chat_id: str):
+        """Chỉ compact khi số tombstone vượt ngưỡng, để mỗi lần xóa không phải sửa index"""
+        index = self.chat_indexes.get(chat_id)
+        if index is None:
+            return
 
-    def _rebuild_index(self):
-        if not self.documents:
-            self.index = None
-            self.embedding_dimension = None
+        tombstones = self.chat_tombstones[chat_id]
+        if self._chat_vector_count(chat_id) == 0:
+            self._drop_chat_index(chat_id)
             return
 
-        embeddings = []
-        for doc in self.documents.values():
-            if doc.embedding is not None:
-                embeddings.append(doc.embedding)
+        if len(tombstones) < index.ntotal * config.INDEX_COMPACTION_RATIO:
+            return
 
-        if not embeddings:
+        if not index_factory.supports_remove_ids(index):
+            # Dựng lại ở nền; tới lúc đó search bỏ qua tombstone bằng IDSelector
+            self._schedule_rebuild(chat_id)
             return
 
-        self.embedding_dimension = len(embeddings[0])
-        self.index = faiss.IndexFlatL2(self.embedding_dimension)
-        self.index.add(np.array(embeddings, dtype=np.float32))
+        index = self._get_or_create_chat_index(chat_id)
+        index.remove_ids(np.array(sorted(tombstones), dtype=np.int64))
+        # Tập mới (không clear) để SearchParameters đã dựng cho tập cũ không bị dùng lại
+        self.chat_tombstones[chat_id] = set()
+        self.dirty_chats.add(chat_id)
+        logger.info(f"Compacted index of chat {chat_id}, {index.ntotal} vectors left")
+
+    def _drop_chat_index(self, chat_id: str):
+        self.chat_indexes.pop(chat_id, None)
+        self.chat_tombstones.pop(chat_id, None)
+        self.chat_search_params.pop(chat_id, None)
+        self.pending_rebuilds.pop(chat_id, None)
+        self.chat_delta_indexes.pop(chat_id, None)
+        self.chat_delta_ids.pop(chat_id, None)
+        self.chat_index_files.pop(chat_id, None)
+        self.mapped_chats.discard(chat_id)
+        self.dirty_chats.discard(chat_id)
+        self.dropped_chats.add(chat_id)
 
     def delete_file(self, file_name: str):
-        with self.lock:
-            docs_to_delete = [
-                doc_id for doc_id, doc in self.documents.items()
-                if doc.source == file_name
-            ]
+        self.refresh()
+        with self.lock.read():
+            int_ids = [self.doc_int_ids[doc_id] for doc_id in self.source_doc_ids.get(file_name, ())]
 
-            if not docs_to_delete:
-                return 0
+        if not int_ids:
+            return 0
 
-            for doc_id in docs_to_delete:
-                del self.documents[doc_id]
-                doc_path = os.path.join(self.index_data_dir, "documents", f"{doc_id}.json")
-                if os.path.exists(doc_path):
-                    os.remove(doc_path)
-                    logger.info(f"Deleted document file: {doc_id}.json")
+        self.store.delete_documents(int_ids)
+        self.refresh()
+        logger.info(f"Deleted {len(int_ids)} documents with source '{file_name}'")
 
-            self._rebuild_index()
-
-            logger.info(f"Deleted {len(docs_to_delete)} documents with source '{file_name}'")
-            return len(docs_to_delete)
+        self._maybe_checkpoint()
+        return len(int_ids)
 
     def delete_document(self, doc_id: str):
-        with self.lock:
-            if doc_id not in self.documents:
-                return False
-
-            del self.documents[doc_id]
+        self.refresh()
+        with self.lock.read():
+            int_id = self.doc_int_ids.get(doc_id)
 
-            doc_path = os.path.join(self.index_data_dir, "documents", f"{doc_id}.json")
-            if os.path.exists(doc_path):
-                os.remove(doc_path)
+        if int_id is None:
+            return False
 
-            self._rebuild_index()
-            return True
+        self.store.delete_documents([int_id])
+        self.refresh()
+        self._maybe_checkpoint()
+        return True
 
     def delete_chat_documents(self, chat_id: str):
-        with self.lock:
-            docs_to_delete = [
-                doc_id for doc_id, doc in self.documents.items() if doc.chat_id == chat_id
-            ]
+        """Xóa mọi document của chat; index của chat bị bỏ khi không còn vector nào"""
+        self.refresh()
+        with self.lock.read():
+            int_ids = [self.doc_int_ids[doc_id] for doc_id in self.chat_doc_ids.get(chat_id, ())]
 
-            if not docs_to_delete:
-                return 0
-
-            for doc_id in docs_to_delete:
-                del self.documents[doc_id]
-                doc_path = os.path.join(self.index_data_dir, "documents", f"{doc_id}.json")
-                if os.path.exists(doc_path):
-                    os.remove(doc_path)
+        if not int_ids:
+            return 0
 
-            self._rebuild_index()
-            return len(docs_to_delete)
+        self.store.delete_documents(int_ids)
+        self.refresh()
+        self._maybe_checkpoint()
+        return len(int_ids)
 
     def load_from_disk(self):
-        with self.lock:
-            doc_dir = os.path.join(self.index_data_dir, "documents")
-            if not os.path.exists(doc_dir):
-                return
-
-            self.documents = {}
-
-            for filename in os.listdir(doc_dir):
-                if not filename.endswith('.json'):
-                    continue
-
-                try:
-                    path = os.path.join(doc_dir, filename)
-                    with open(path, 'r', encoding='utf-8') as f:
-                        doc_data = json.load(f)
-
-                    doc = Document(
-                        id=doc_data["id"],
-                        content=doc_data["content"],
-                        source=doc_data["source"],
-                        metadata=doc_data["metadata"],
-                        chat_id=doc_data.get("chat_id")
-                    )
-                    doc.created_at = doc_data.get("created_at", datetime.now().isoformat())
-
-                    # Đọc embedding đã lưu, tránh gọi API lại
-                    doc.embedding = doc_data.get("embedding")
-                    if doc.embedding is None:
-                        doc.embedding = self.get_embedding(doc.content).tolist()
-
-                    self.documents[doc.id] = doc
-
-                except Exception as e:
-                    logger.error(f"Error loading document {filename}: {str(e)}")
-
-            self._rebuild_index()
+        # Chuyển thư mục documents/*.json cũ (nếu có) sang định dạng nhị phân. Chỉ ghi vào WAL
+        # nên không cần lock; embed theo batch, không qua cache của query
+        self.store.migrate_legacy_documents(self.get_embeddings, config.EMBEDDING_BATCH_SIZE)
+        with self.refresh_lock, self.lock.write():
+            self._load_state()
+
+            # Gộp phần WAL vừa replay vào snapshot để lần khởi động sau không phải replay lại
+            # (write lock đã chặn mọi checkpoint khác của process này)
+            if self.dirty_chats or self.dropped_chats or self.store.has_pending_changes():
+                self._write_checkpoint()
+            self._apply_events(self.store.poll())
             logger.info(f"Loaded {len(self.documents)} documents from disk")
+        self._start_rebuild_thread()
+
+    def _load_state(self):
+        """Nạp lại toàn bộ document và index từ snapshot + WAL, gọi khi đang giữ write lock"""
+        self.documents = {}
+        self.doc_int_ids = {}
+        self.int_id_to_doc = {}
+        self.int_id_rows = {}
+        self.chat_doc_ids = {}
+        self.source_doc_ids = {}
+        self.file_type_counts = {}
+        self.chat_file_type_counts = {}
+        self.chat_indexes = {}
+        self.chat_tombstones = {}
+        self.chat_search_params = {}
+        self.chat_index_files = {}
+        self.mapped_chats = set()
+        self.pending_rebuilds = {}
+        self.chat_delta_indexes = {}
+        self.chat_delta_ids = {}
+        self.dirty_chats = set()
+        self.dropped_chats = set()
+
+        documents, saved_indexes, files = self.store.load_snapshot()
+        self.embedding_dimension = self.store.dimension
+
+        chat_int_ids = {}
+        for int_id, vector_row, doc in documents:
+            # Trùng id (hai request thêm cùng lúc trước checkpoint): giữ bản đầu
+            if doc.id in self.documents:
+                continue
+            self._register_document(doc, int_id, vector_row)
+            chat_int_ids.setdefault(doc.chat_id, []).append(int_id)
+
+        for chat_id, int_ids in chat_int_ids.items():
+            index = saved_indexes.pop(chat_id, None)
+
+            if index is not None:
+                self._install_saved_index(chat_id, index, set(int_ids), files.get(chat_id))
+            else:
+                int_ids = np.array(sorted(int_ids), dtype=np.int64)
+                self.chat_indexes[chat_id] = index_factory.build_index(
+                    self._vectors_for_int_ids(int_ids), int_ids
+                )
+                self.chat_tombstones[chat_id] = set()
+                self.dirty_chats.add(chat_id)
+
+            self._maybe_promote_chat_index(chat_id)
+
+        # Index của chat không còn document nào
+        self.dropped_chats.update(saved_indexes)
 
     def get_statistics(self, chat_id=None):
-        with self.lock:
-            filtered_docs = self.documents
-            if chat_id is not None:
-                filtered_docs = {
-                    doc_id: doc for doc_id, doc in self.documents.items()
-                    if doc.chat_id == chat_id
-                }
-
-            file_types = {}
-            for doc in filtered_docs.values():
-                file_type = doc.metadata.get("file_type", "unknown")
-                file_types[file_type] = file_types.get(file_type, 0) + 1
+        self.refresh()
+        with self.lock.read():
+            if chat_id is None:
+                document_count = len(self.documents)
+                file_types = self.file_type_counts
+            else:
+                document_count = len(self.chat_doc_ids.get(chat_id, ()))
+                file_types = self.chat_file_type_counts.get(chat_id, {})
 
             return {
-                "document_count": len(filtered_docs),
-                "file_types": file_types
+                "document_count": document_count,
+                "file_types": dict(file_types)
             }
 
+    def list_chats(self):
+        self.refresh()
+        with self.lock.read():
+            return sorted(chat_id for chat_id in self.chat_doc_ids if chat_id is not None)
+
+    def export_chat(self, chat_id: str):
+        """Document của chat và vector tương ứng (float32), để chuyển sang index khác"""
+        self.refresh()
+        with self.lock.read():
+            doc_ids = sorted(self.chat_doc_ids.get(chat_id, ()))
+            documents = [self.documents[doc_id] for doc_id in doc_ids]
+            if not documents:
+                return [], np.zeros((0, self.embedding_dimension or 0), dtype=np.float32)
+            vectors = self._vectors_for_int_ids([self.doc_int_ids[doc_id] for doc_id in doc_ids])
+        return documents, vectors
+
     def get_chat_documents(self, chat_id: str):
-        with self.lock:
+        self.refresh()
+        with self.lock.read():
             return {
-                doc_id: doc for doc_id, doc in self.documents.items()
-                if doc.chat_id == chat_id
+                doc_id: self.documents[doc_id] for doc_id in self.chat_doc_ids.get(chat_id, ())
             }
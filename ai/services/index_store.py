@@ -0,0 +1,674 @@
+import os
+import json
+import hashlib
+import uuid
+import sqlite3
+import threading
+import logging
+import numpy as np
+import faiss
+from datetime import datetime
+from ai.schemas import Document
+from ai.services.wal import WriteAheadLog
+from ai.utils.file_lock import FileLock
+
+logger = logging.getLogger("doc_retrieval_api.index_store")
+
+
+class IndexStore:
+    """
+    Lưu index xuống đĩa dạng nhị phân:
+    - vectors.f32: ma trận float32 (hoặc float16) liên tục, mỗi nội dung chunk chỉ có một dòng
+      (mmap khi đọc)
+    - metadata.db: sqlite chứa thông tin document, bảng hash nội dung -> dòng vector
+    - chat_indexes/: index FAISS của từng chat, đọc bằng mmap
+
+    Vector được đánh địa chỉ theo hash(model + nội dung chunk): cùng một file upload vào
+    nhiều chat thì các document (posting) trỏ chung một dòng, không phải embed lại.
+    Dòng vector và hash trong content_vectors không bao giờ bị thu hồi: xóa document chỉ bỏ
+    posting (upload lại cùng nội dung vẫn dùng lại dòng cũ). vectors.f32 vì vậy tăng theo số
+    nội dung chunk khác nhau từng được embed, không giảm khi xóa file: số dòng x dimension x
+    itemsize byte (vd. 1 triệu chunk 768 chiều float32 là khoảng 3 GB). Muốn lấy lại dung lượng
+    thì dừng app rồi chạy "python -m ai.compact_index --data-dir <INDEX_DATA_DIR>": chỉ giữ
+    các dòng còn document trỏ tới và đánh số lại vector_row.
+
+    Các file trên là snapshot. Mỗi thay đổi (vector mới, document thêm/xóa) chỉ được ghi
+    vào index.wal (group commit) và giữ trong bộ nhớ; checkpoint() ghi dồn chúng vào
+    snapshot rồi xoay log. Khi mở lại store chỉ replay phần log sau snapshot cuối.
+
+    Nhiều process (worker uvicorn) có thể mở chung một thư mục: ghi log giữ khóa file
+    exclusive, và mỗi process đọc tiếp các record do process khác ghi (poll()).
+    Snapshot được mmap nên các worker dùng chung một bản trong page cache.
+    """
+
+    VECTORS_FILE = "vectors.f32"
+    HEADER_FILE = "vectors.json"
+    METADATA_FILE = "metadata.db"
+    WAL_FILE = "index.wal"
+    REBUILD_LOCK_FILE = "rebuild.lock"
+    CHAT_INDEX_DIR = "chat_indexes"
+    LEGACY_DOCUMENTS_DIR = "documents"
+    # Model duy nhất được dùng trước khi có EMBEDDING_PROVIDER
+    LEGACY_EMBEDDING_MODEL = "models/embedding-001"
+
+    def __init__(self, data_dir: str, model_name: str, vector_dtype: str = "float32",
+                 wal_sync: bool = True):
+        self.data_dir = data_dir
+        self.model_name = model_name
+        # float32 hoặc float16; store đã có trên đĩa giữ nguyên dtype ghi trong header
+        self.dtype = np.dtype(vector_dtype)
+        self.vectors_path = os.path.join(data_dir, self.VECTORS_FILE)
+        self.header_path = os.path.join(data_dir, self.HEADER_FILE)
+        self.chat_index_dir = os.path.join(data_dir, self.CHAT_INDEX_DIR)
+        self.lock = threading.Lock()
+        self.dimension = None
+        # row_count gồm cả các dòng chỉ mới có trong WAL; snapshot_rows là số dòng trong vectors.f32
+        self.row_count = 0
+        self.snapshot_rows = 0
+        self._vectors = None
+        # hash nội dung -> dòng vector
+        self.content_rows = {}
+        self.next_int_id = 0
+        self.generation = 0
+        # Thay đổi sau snapshot cuối, chờ checkpoint
+        self._pending_vectors = None
+        self._pending_hashes = {}
+        self._pending_documents = {}
+        self._pending_deletes = set()
+        # Thay đổi (của process này hoặc process khác) chờ FAISSIndexManager áp vào index
+        self._events = []
+
+        os.makedirs(self.chat_index_dir, exist_ok=True)
+        self.conn = sqlite3.connect(
+            os.path.join(data_dir, self.METADATA_FILE),
+            check_same_thread=False
+        )
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (
+                int_id INTEGER PRIMARY KEY,
+                id TEXT UNIQUE NOT NULL,
+                chat_id TEXT,
+                source TEXT,
+                content TEXT,
+                metadata TEXT,
+                created_at TEXT,
+                vector_row INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS chat_indexes (
+                chat_id TEXT PRIMARY KEY,
+                data BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chat_index_files (
+                chat_id TEXT PRIMARY KEY,
+                file TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS content_vectors (
+                content_hash TEXT PRIMARY KEY,
+                vector_row INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS store_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+
+        self.wal = WriteAheadLog(os.path.join(data_dir, self.WAL_FILE), sync=wal_sync)
+        # Chỉ một process dựng lại index của chat (promote / compact), các process khác nhận
+        # index mới qua snapshot
+        self.rebuild_lock = FileLock(os.path.join(data_dir, self.REBUILD_LOCK_FILE))
+        self.wal.before_flush = self._catch_up
+        with self.wal.lock.exclusive():
+            self._load_header()
+            self._upgrade_schema()
+            self.replayed_records = self._load_snapshot_state()
+
+    def _get_meta(self, key: str, default=None):
+        row = self.conn.execute("SELECT value FROM store_meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key: str, value):
+        self.conn.execute("INSERT OR REPLACE INTO store_meta VALUES (?, ?)", (key, str(value)))
+
+    def _upgrade_schema(self):
+        """metadata.db cũ: int_id chính là dòng vector, chưa có bảng hash nội dung"""
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(documents)")]
+        if "vector_row" in columns:
+            return
+
+        with self.conn:
+            self.conn.execute("ALTER TABLE documents ADD COLUMN vector_row INTEGER")
+            self.conn.execute("UPDATE documents SET vector_row = int_id")
+            rows = self.conn.execute("SELECT content, vector_row FROM documents").fetchall()
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO content_vectors VALUES (?, ?)",
+                [(self.content_hash(content), vector_row) for content, vector_row in rows]
+            )
+            self._set_meta("next_int_id", self.row_count)
+        logger.info(f"Upgraded index metadata schema, {len(rows)} documents hashed")
+
+    def _load_snapshot_state(self):
+        """
+        Đọc trạng thái snapshot từ sqlite rồi replay WAL của generation hiện tại.
+        Gọi khi đang giữ khóa file (exclusive lúc khởi động, shared khi process khác đã
+        checkpoint nhiều lần trong lúc process này không đọc log). Trả về số record đã replay.
+        """
+        with self.lock:
+            self.content_rows = dict(self.conn.execute(
+                "SELECT content_hash, vector_row FROM content_vectors"
+            ).fetchall())
+            self.next_int_id = int(self._get_meta("next_int_id", 0))
+            self._reset_pending(int(self._get_meta("generation", 0)))
+            self._events = []
+
+        records = self.wal.open(self.generation)
+        self._apply_records(records)
+        if records:
+            logger.info(f"Replayed {len(records)} WAL records written after the last snapshot")
+        return len(records)
+
+    def content_hash(self, content: str):
+        return hashlib.sha256(f"{self.model_name}\0{content}".encode("utf-8")).hexdigest()
+
+    def lookup_vector_rows(self, content_hashes):
+        """Trả về dict hash -> dòng vector cho các nội dung đã được embed trước đó"""
+        with self.lock:
+            return {h: self.content_rows[h] for h in content_hashes if h in self.content_rows}
+
+    def _load_header(self):
+        if os.path.exists(self.header_path):
+            with open(self.header_path, "r", encoding="utf-8") as f:
+                header = json.load(f)
+            self.dimension = header["dimension"]
+            self.dtype = np.dtype(header.get("dtype", "float32"))
+
+            # Vector của model khác không so sánh được với nhau
+            stored_model = header.get("model", self.LEGACY_EMBEDDING_MODEL)
+            if stored_model != self.model_name:
+                raise ValueError(
+                    f"Index at {self.data_dir} was built with embedding model '{stored_model}', "
+                    f"not '{self.model_name}'. Use another INDEX_DATA_DIR or re-index the documents."
+                )
+
+        self.row_count = 0
+        if self.dimension and os.path.exists(self.vectors_path):
+            row_bytes = self.dimension * self.dtype.itemsize
+            file_rows = os.path.getsize(self.vectors_path) // row_bytes
+            # Các dòng sau row_count của snapshot cuối là checkpoint bị dừng giữa chừng
+            stored_rows = self._get_meta("row_count")
+            self.row_count = min(file_rows, int(stored_rows)) if stored_rows is not None else file_rows
+            if os.path.getsize(self.vectors_path) != self.row_count * row_bytes:
+                with open(self.vectors_path, "r+b") as f:
+                    f.truncate(self.row_count * row_bytes)
+
+    def _write_header(self):
+        with open(self.header_path, "w", encoding="utf-8") as f:
+            json.dump({"dimension": self.dimension, "dtype": self.dtype.name, "model": self.model_name}, f)
+
+    def _reserve_pending_rows(self, count: int):
+        """Cấp count dòng mới sau row_count, vector được giữ trong RAM tới lần checkpoint"""
+        needed = self.row_count + count - self.snapshot_rows
+        capacity = 0 if self._pending_vectors is None else len(self._pending_vectors)
+        if needed > capacity:
+            grown = np.zeros((max(needed, capacity * 2, 1024), self.dimension), dtype=self.dtype)
+            if capacity:
+                grown[:capacity] = self._pending_vectors
+            self._pending_vectors = grown
+        start = self.row_count
+        self.row_count += count
+        return start
+
+    def _reset_pending(self, generation: int):
+        """Bỏ các thay đổi đang chờ sau khi chúng đã nằm trong snapshot, gọi khi giữ self.lock"""
+        self.generation = generation
+        self.snapshot_rows = self.row_count
+        self._vectors = None
+        self._pending_vectors = None
+        self._pending_hashes = {}
+        self._pending_documents = {}
+        self._pending_deletes = set()
+
+    def _apply_records(self, records):
+        """Áp record WAL (của process này hoặc process khác) vào trạng thái trong RAM"""
+        with self.lock:
+            for header, payload in records:
+                op = header["op"]
+                if op == "vectors":
+                    self._apply_vectors(header["start_row"], header["hashes"], payload)
+                elif op == "documents":
+                    self._apply_documents(header["documents"])
+                elif op == "delete":
+                    self._apply_deletes(header["int_ids"])
+
+    def _apply_vectors(self, start_row, hashes, payload):
+        if self.dimension is None:
+            self.dimension = len(payload) // (len(hashes) * self.dtype.itemsize)
+            self._write_header()
+        vectors = np.frombuffer(payload, dtype=self.dtype).reshape(len(hashes), self.dimension)
+
+        if start_row + len(hashes) > self.row_count:
+            self._reserve_pending_rows(start_row + len(hashes) - self.row_count)
+        offset = start_row - self.snapshot_rows
+        self._pending_vectors[offset:offset + len(hashes)] = vectors
+        for i, content_hash in enumerate(hashes):
+            if content_hash not in self.content_rows:
+                self.content_rows[content_hash] = start_row + i
+                self._pending_hashes[content_hash] = start_row + i
+
+    def _apply_documents(self, records):
+        for record in records:
+            self._pending_documents[record["int_id"]] = record
+            self.next_int_id = max(self.next_int_id, record["int_id"] + 1)
+        self._events.append(("documents", [
+            (record["int_id"], record["vector_row"], self._document_from_record(record))
+            for record in records
+        ]))
+
+    def _apply_deletes(self, int_ids):
+        for int_id in int_ids:
+            # Document chưa vào snapshot thì chỉ cần bỏ khỏi phần chờ
+            if self._pending_documents.pop(int_id, None) is None:
+                self._pending_deletes.add(int_id)
+        self._events.append(("delete", list(int_ids)))
+
+    def _catch_up(self):
+        """
+        Đọc các record process khác đã ghi vào WAL, gọi khi đang giữ khóa file.
+        Nếu process khác đã checkpoint: đọc nốt log cũ, nhận snapshot mới và chuyển sang
+        log mới; lỡ nhiều hơn một checkpoint thì nạp lại toàn bộ từ snapshot.
+        """
+        records, rotated = self.wal.read_new()
+        self._apply_records(records)
+        if not rotated:
+            return
+
+        generation = int(self._get_meta("generation", 0))
+        if generation != self.generation + 1 or int(self._get_meta("row_count", 0)) != self.row_count:
+            logger.info(f"Index store is {generation - self.generation} checkpoints behind, reloading")
+            self._load_header()
+            self._load_snapshot_state()
+            with self.lock:
+                self._events.append(("reload", None))
+            return
+
+        with self.lock:
+            # Mọi thay đổi đang chờ đã nằm trong snapshot do process kia ghi
+            self._reset_pending(generation)
+            self._events.append(("snapshot", self._chat_index_files()))
+        self._apply_records(self.wal.reopen())
+
+    def has_updates(self):
+        """Kiểm tra nhanh, không khóa: có thay đổi nào chưa được poll() không"""
+        return bool(self._events) or self.wal.has_new_data()
+
+    def poll(self):
+        """
+        Đọc các thay đổi mới trong WAL và trả về danh sách sự kiện theo thứ tự:
+        ("documents", [(int_id, vector_row, Document)]), ("delete", [int_id]),
+        ("snapshot", {chat_id: file}) hoặc ("reload", None).
+        """
+        with self.wal.lock.shared():
+            self._catch_up()
+            with self.lock:
+                events, self._events = self._events, []
+        return events
+
+    def add_vectors(self, content_hashes, vectors: np.ndarray):
+        """
+        Ghi vector cho các hash chưa có vào WAL, trả về dòng vector cho từng hash.
+        Hash đã có (kể cả do upload song song hoặc worker khác ghi) dùng lại dòng cũ.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=self.dtype)
+
+        def build():
+            # Chạy trong thread leader, sau khi đã đọc hết record của process khác
+            with self.lock:
+                if self.dimension is None:
+                    self.dimension = vectors.shape[1]
+                    self._write_header()
+
+                new_hashes = {}
+                for position, content_hash in enumerate(content_hashes):
+                    if content_hash not in self.content_rows:
+                        new_hashes.setdefault(content_hash, position)
+
+                start_row = self.row_count
+                hashes = list(new_hashes)
+                payload = vectors[list(new_hashes.values())].tobytes()
+                if hashes:
+                    self._apply_vectors(start_row, hashes, payload)
+                rows = np.array([self.content_rows[h] for h in content_hashes], dtype=np.int64)
+            return {"op": "vectors", "start_row": start_row, "hashes": hashes}, payload, rows
+
+        return self.wal.append(build)
+
+    def _snapshot_vectors(self):
+        """Ma trận mmap các dòng trong snapshot, gọi khi đang giữ self.lock"""
+        if self.snapshot_rows == 0:
+            return None
+        if self._vectors is None:
+            self._vectors = np.memmap(
+                self.vectors_path, dtype=self.dtype, mode="r",
+                shape=(self.snapshot_rows, self.dimension)
+            )
+        return self._vectors
+
+    def get_vectors(self, vector_rows):
+        """Đọc các dòng vector (float32): dòng trong snapshot lấy từ mmap, dòng mới từ RAM"""
+        rows = np.asarray(vector_rows, dtype=np.int64)
+        with self.lock:
+            result = np.empty((len(rows), self.dimension), dtype=np.float32)
+            in_snapshot = rows < self.snapshot_rows
+            if in_snapshot.any():
+                result[in_snapshot] = self._snapshot_vectors()[rows[in_snapshot]]
+            if not in_snapshot.all():
+                result[~in_snapshot] = self._pending_vectors[rows[~in_snapshot] - self.snapshot_rows]
+            return result
+
+    @staticmethod
+    def _document_record(doc, int_id, vector_row):
+        return {
+            "int_id": int(int_id), "vector_row": int(vector_row), "id": doc.id,
+            "chat_id": doc.chat_id, "source": doc.source, "content": doc.content,
+            "metadata": doc.metadata, "created_at": doc.created_at
+        }
+
+    @staticmethod
+    def _document_from_record(record):
+        doc = Document(
+            id=record["id"],
+            content=record["content"],
+            source=record["source"],
+            metadata=record["metadata"],
+            chat_id=record["chat_id"]
+        )
+        doc.created_at = record["created_at"]
+        return doc
+
+    def save_documents(self, documents, vector_rows):
+        """
+        Ghi document vào WAL, trả về int id đã cấp cho chúng. Int id không bao giờ được
+        dùng lại (id đã xóa có thể còn trong index đã serialize).
+        """
+        def build():
+            with self.lock:
+                int_ids = np.arange(self.next_int_id, self.next_int_id + len(documents), dtype=np.int64)
+                records = [
+                    self._document_record(doc, int_id, vector_row)
+                    for doc, int_id, vector_row in zip(documents, int_ids, vector_rows)
+                ]
+                self._apply_documents(records)
+            return {"op": "documents", "documents": records}, b"", int_ids
+
+        return self.wal.append(build)
+
+    def delete_documents(self, int_ids):
+        int_ids = [int(i) for i in int_ids]
+
+        def build():
+            with self.lock:
+                self._apply_deletes(int_ids)
+            return {"op": "delete", "int_ids": int_ids}, b"", None
+
+        self.wal.append(build)
+
+    def has_pending_changes(self):
+        with self.lock:
+            return bool(
+                self.row_count > self.snapshot_rows or self._pending_documents or self._pending_deletes
+            )
+
+    def wal_size(self):
+        return self.wal.size()
+
+    def _chat_index_files(self):
+        return {
+            chat_id: os.path.join(self.chat_index_dir, file)
+            for chat_id, file in self.conn.execute("SELECT chat_id, file FROM chat_index_files")
+        }
+
+    @staticmethod
+    def chat_index_file_name(chat_id: str, generation: int):
+        """Tên file index của chat trong chat_indexes/; mỗi generation một file mới"""
+        key = hashlib.sha1(chat_id.encode("utf-8")).hexdigest()[:16]
+        return f"{key}-{generation}.faiss"
+
+    @staticmethod
+    def serialize_chat_indexes(chat_indexes: dict):
+        """chat_id -> index (None nghĩa là xóa) thành chat_id -> bytes để truyền cho checkpoint()"""
+        return {
+            chat_id: None if index is None else faiss.serialize_index(index)
+            for chat_id, index in chat_indexes.items()
+        }
+
+    def checkpoint(self, serialized: dict):
+        """
+        Ghi snapshot: ghi index của các chat thay đổi (serialized: chat_id -> bytes từ
+        serialize_chat_indexes, None nghĩa là xóa) ra file riêng, nối vector mới vào
+        vectors.f32 (fsync), rồi trong một transaction sqlite ghi document thêm/xóa và
+        generation mới; sau đó xoay WAL. File index được ghi và fsync trước khi khóa WAL để
+        các process khác không phải chờ phần đó.
+        Dừng giữa chừng thì lần mở sau bỏ phần vector thừa và replay lại WAL cũ.
+        Các process khác nhận snapshot mới qua sự kiện "snapshot" của poll().
+        """
+        # Mỗi checkpoint ghi file mới: process khác vẫn đang mmap file cũ
+        written = {}
+        try:
+            for chat_id, data in serialized.items():
+                if data is None:
+                    continue
+                path = os.path.join(self.chat_index_dir, f"{uuid.uuid4().hex}.tmp")
+                with open(path, "wb") as f:
+                    f.write(data.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                written[chat_id] = path
+
+            with self.wal.lock.exclusive():
+                self._catch_up()
+                with self.lock:
+                    generation = self.generation + 1
+                    new_rows = self.row_count - self.snapshot_rows
+                    if new_rows:
+                        row_bytes = self.dimension * self.dtype.itemsize
+                        with open(self.vectors_path, "ab") as f:
+                            f.truncate(self.snapshot_rows * row_bytes)
+                            f.write(self._pending_vectors[:new_rows].tobytes())
+                            f.flush()
+                            os.fsync(f.fileno())
+
+                    new_files = {}
+                    for chat_id, path in written.items():
+                        new_files[chat_id] = self.chat_index_file_name(chat_id, generation)
+                        os.replace(path, os.path.join(self.chat_index_dir, new_files[chat_id]))
+                    written = {}
+
+                    old_files = self._chat_index_files()
+                    with self.conn:
+                        self.conn.executemany(
+                            "INSERT OR REPLACE INTO content_vectors VALUES (?, ?)",
+                            list(self._pending_hashes.items())
+                        )
+                        self.conn.executemany(
+                            "DELETE FROM documents WHERE int_id = ?", [(i,) for i in self._pending_deletes]
+                        )
+                        # Trùng id document (hai request thêm cùng lúc): giữ bản được ghi trước
+                        self.conn.executemany(
+                            "INSERT OR IGNORE INTO documents VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            [
+                                (
+                                    r["int_id"], r["id"], r["chat_id"], r["source"], r["content"],
+                                    json.dumps(r["metadata"], ensure_ascii=False), r["created_at"],
+                                    r["vector_row"]
+                                )
+                                for r in self._pending_documents.values()
+                            ]
+                        )
+                        for chat_id in serialized:
+                            self.conn.execute("DELETE FROM chat_indexes WHERE chat_id = ?", (chat_id,))
+                            if chat_id in new_files:
+                                self.conn.execute(
+                                    "INSERT OR REPLACE INTO chat_index_files VALUES (?, ?)",
+                                    (chat_id, new_files[chat_id])
+                                )
+                            else:
+                                self.conn.execute(
+                                    "DELETE FROM chat_index_files WHERE chat_id = ?", (chat_id,)
+                                )
+                        self._set_meta("row_count", self.row_count)
+                        self._set_meta("next_int_id", self.next_int_id)
+                        self._set_meta("generation", generation)
+
+                    self.wal.rotate(generation)
+                    for chat_id in serialized:
+                        if chat_id in old_files and os.path.exists(old_files[chat_id]):
+                            os.remove(old_files[chat_id])
+
+                    self._reset_pending(generation)
+                    self._events.append(("snapshot", self._chat_index_files()))
+        finally:
+            # Checkpoint lỗi giữa chừng: bỏ các file index chưa được dùng
+            for path in written.values():
+                if os.path.exists(path):
+                    os.remove(path)
+
+        logger.info(
+            f"Checkpointed index store: {new_rows} new vectors, {len(serialized)} chat indexes"
+        )
+
+    def _load_documents(self):
+        cursor = self.conn.execute(
+            "SELECT int_id, vector_row, id, chat_id, source, content, metadata, created_at"
+            " FROM documents"
+        )
+        results = []
+        for int_id, vector_row, doc_id, chat_id, source, content, metadata, created_at in cursor:
+            if int_id in self._pending_deletes or int_id in self._pending_documents:
+                continue
+            doc = Document(
+                id=doc_id,
+                content=content,
+                source=source,
+                metadata=json.loads(metadata),
+                chat_id=chat_id
+            )
+            doc.created_at = created_at
+            results.append((int_id, vector_row, doc))
+
+        for record in self._pending_documents.values():
+            results.append(
+                (record["int_id"], record["vector_row"], self._document_from_record(record))
+            )
+        return results
+
+    @staticmethod
+    def read_chat_index(path: str):
+        """Đọc index bằng mmap: các process đọc cùng file dùng chung page cache, index chỉ đọc"""
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+
+    def _load_chat_indexes(self):
+        indexes = {}
+        # Index lưu dạng BLOB trong sqlite (trước khi có chat_indexes/) được đọc vào RAM
+        for chat_id, data in self.conn.execute("SELECT chat_id, data FROM chat_indexes").fetchall():
+            try:
+                indexes[chat_id] = faiss.deserialize_index(np.frombuffer(data, dtype=np.uint8))
+            except Exception as e:
+                logger.error(f"Error loading serialized index of chat {chat_id}: {e}")
+
+        files = self._chat_index_files()
+        for chat_id, path in files.items():
+            try:
+                indexes[chat_id] = self.read_chat_index(path)
+            except Exception as e:
+                logger.error(f"Error loading index file of chat {chat_id}: {e}")
+        return indexes, files
+
+    def load_snapshot(self):
+        """
+        Trả về (documents, indexes, files) nhất quán với nhau: documents là list
+        (int_id, vector_row, Document), indexes là chat_id -> index đã lưu, files là
+        chat_id -> file index (mmap). Các sự kiện chưa poll() đã nằm trong kết quả nên bị bỏ.
+        """
+        with self.wal.lock.shared():
+            self._catch_up()
+            with self.lock:
+                documents = self._load_documents()
+                indexes, files = self._load_chat_indexes()
+                self._events = []
+        return documents, indexes, files
+
+    def migrate_legacy_documents(self, embed_batch_fn, batch_size: int = 64):
+        """
+        Chuyển thư mục documents/*.json cũ sang định dạng nhị phân, chạy một lần.
+        Document không dùng lại được embedding cũ được embed theo batch bằng embed_batch_fn
+        (list text -> list vector hoặc None nếu lỗi), mỗi nội dung một lần.
+        """
+        doc_dir = os.path.join(self.data_dir, self.LEGACY_DOCUMENTS_DIR)
+        migrating_dir = doc_dir + ".migrating"
+        # Đổi tên trước để khi nhiều worker cùng khởi động chỉ một worker chuyển đổi
+        try:
+            os.rename(doc_dir, migrating_dir)
+        except OSError:
+            return 0
+
+        documents = []
+        vectors = {}
+        for filename in os.listdir(migrating_dir):
+            if not filename.endswith('.json'):
+                continue
+
+            try:
+                with open(os.path.join(migrating_dir, filename), 'r', encoding='utf-8') as f:
+                    doc_data = json.load(f)
+
+                doc = Document(
+                    id=doc_data["id"],
+                    content=doc_data["content"],
+                    source=doc_data["source"],
+                    metadata=doc_data["metadata"],
+                    chat_id=doc_data.get("chat_id")
+                )
+                doc.created_at = doc_data.get("created_at", datetime.now().isoformat())
+
+                # Embedding trong file JSON cũ là của model Google, chỉ dùng lại khi cùng model
+                content_hash = self.content_hash(doc.content)
+                if self.model_name == self.LEGACY_EMBEDDING_MODEL and doc_data.get("embedding") is not None:
+                    vectors[content_hash] = doc_data["embedding"]
+                documents.append((doc, content_hash))
+            except Exception as e:
+                logger.error(f"Error migrating document {filename}: {str(e)}")
+
+        vector_rows = self.lookup_vector_rows([content_hash for _, content_hash in documents])
+        if vectors:
+            hashes = list(vectors)
+            vector_rows.update(zip(hashes, self.add_vectors(hashes, np.array(list(vectors.values()), dtype=np.float32))))
+
+        # Nội dung chưa có vector: embed theo batch như add_documents
+        missing = {}
+        for doc, content_hash in documents:
+            if content_hash not in vector_rows:
+                missing.setdefault(content_hash, doc.content)
+        missing_hashes = list(missing)
+        for start in range(0, len(missing_hashes), batch_size):
+            hashes = missing_hashes[start:start + batch_size]
+            embeddings = embed_batch_fn([missing[h] for h in hashes])
+            if embeddings is None:
+                continue
+            vector_rows.update(zip(hashes, self.add_vectors(hashes, np.array(embeddings, dtype=np.float32))))
+
+        # Document embed lỗi thì bỏ qua
+        documents = [(doc, content_hash) for doc, content_hash in documents if content_hash in vector_rows]
+        if documents:
+            self.save_documents(
+                [doc for doc, _ in documents],
+                np.array([vector_rows[content_hash] for _, content_hash in documents], dtype=np.int64)
+            )
+
+        os.rename(migrating_dir, doc_dir + ".migrated")
+        logger.info(f"Migrated {len(documents)} JSON documents to binary index store")
+        return len(documents)
+
+    def close(self):
+        with self.lock:
+            self.wal.close()
+            self.rebuild_lock.close()
+            self.conn.close()
@@ -0,0 +1,110 @@
+import time
+import queue
+import logging
+import threading
+import config
+
+logger = logging.getLogger("doc_retrieval_api.ingest_queue")
+
+
+class IngestQueueFull(Exception):
+    """Hàng đợi ingest đã đầy, client nên thử lại sau"""
+
+
+class IngestJob:
+    """Trạng thái một lần ingest file: queued -> running -> done / failed"""
+
+    def __init__(self, job_id: str):
+        self.id = job_id
+        self.status = "queued"
+        self.chunks_embedded = 0
+        # Chưa biết tổng số chunk cho tới khi tách text xong (file được chunk dần)
+        self.chunks_total = None
+        self.error = None
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def update_progress(self, chunks_embedded: int, chunks_total: int = None):
+        self.chunks_embedded = chunks_embedded
+        if chunks_total is not None:
+            self.chunks_total = chunks_total
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "chunks_embedded": self.chunks_embedded,
+            "chunks_total": self.chunks_total,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+
+class IngestQueue:
+    """
+    Hàng đợi có giới hạn cho việc ingest file ở nền: upload trả về job id ngay, một số
+    worker thread cố định tách text / embed / ghi index, nên số file được xử lý đồng thời
+    (và số request embedding) không tăng theo số upload.
+    Job đã xong được giữ job_ttl giây để client hỏi trạng thái.
+    """
+
+    def __init__(self, workers: int = None, max_pending: int = None, job_ttl: float = None):
+        self.workers = workers or config.INGEST_WORKERS
+        self.job_ttl = config.INGEST_JOB_TTL if job_ttl is None else job_ttl
+        self.pending = queue.Queue(maxsize=max_pending or config.INGEST_QUEUE_SIZE)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def _start_workers(self):
+        # Worker được tạo ở job đầu tiên, không tạo thread lúc import module
+        if self.threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"ingest-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _prune(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.finished_at is not None and now - job.finished_at > self.job_ttl]:
+            del self.jobs[job_id]
+
+    def submit(self, job_id: str, func, *args):
+        """Đưa func(job, *args) vào hàng đợi; báo IngestQueueFull nếu hàng đợi đầy"""
+        job = IngestJob(job_id)
+        with self.lock:
+            self._prune()
+            self._start_workers()
+            try:
+                self.pending.put_nowait((job, func, args))
+            except queue.Full:
+                raise IngestQueueFull(f"Ingest queue is full ({self.pending.maxsize} pending jobs)")
+            self.jobs[job_id] = job
+        return job
+
+    def get(self, job_id: str):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _worker(self):
+        while True:
+            job, func, args = self.pending.get()
+            job.status = "running"
+            job.started_at = time.time()
+            try:
+                job.result = func(job, *args)
+                job.status = "done"
+            except Exception as e:
+                # HTTPException mang thông báo trong detail
+                job.error = getattr(e, "detail", None) or str(e)
+                job.status = "failed"
+                logger.error(f"Ingest job {job.id} failed: {job.error}")
+            finally:
+                job.finished_at = time.time()
+                self.pending.task_done()
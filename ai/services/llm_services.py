@@ -1,10 +1,21 @@
 import logging
+import re
+import asyncio
 from langchain_google_genai import ChatGoogleGenerativeAI
 import json
+import config
 logger = logging.getLogger("doc_retrieval_api.llm_service")
 
 class LLMService:
-    def __init__(self, model_name, temperature=0, max_tokens=5000, timeout=30, max_retries=3):
+    """
+    Các thao tác của route (tiền tố a) là async, gọi ainvoke để không chặn event loop; chúng
+    giới hạn số lời gọi LLM đồng thời bằng semaphore và mỗi lời gọi (kể cả thời gian chờ
+    semaphore) có deadline, quá hạn thì báo asyncio.TimeoutError.
+    create_description_short_for_file là bản đồng bộ, chạy trong worker ingest.
+    """
+
+    def __init__(self, model_name, temperature=0, max_tokens=5000, timeout=30, max_retries=3,
+                 max_concurrency=None, deadline=None):
         self.llm = ChatGoogleGenerativeAI(
             model=model_name,
             temperature=temperature,
@@ -12,15 +23,62 @@ class LLMService:
             timeout=timeout,
             max_retries=max_retries
         )
-    
-    def generate_answer(self, query, retrieved_docs):
-        """Generate an answer based on the query and retrieved documents"""
+        self.deadline = deadline or config.LLM_DEADLINE
+        self.semaphore = asyncio.Semaphore(max_concurrency or config.LLM_MAX_CONCURRENCY)
+
+    async def _ainvoke(self, prompt, deadline=None):
+        async def call():
+            async with self.semaphore:
+                return await self.llm.ainvoke(prompt)
+        return await asyncio.wait_for(call(), timeout=deadline or self.deadline)
+
+    async def agenerate_answer(self, query, retrieved_docs, deadline=None, raise_errors=False):
+        """raise_errors: báo lỗi cho nơi gọi thay vì trả về thông báo lỗi như một câu trả lời"""
+        try:
+            response = await self._ainvoke(self._answer_prompt(query, retrieved_docs), deadline)
+            return response.content
+        except Exception as e:
+            if raise_errors:
+                raise
+            return self.answer_error(e)
+
+    @staticmethod
+    def answer_error(error: Exception):
+        """Ghi log và trả về thông báo lỗi dùng làm câu trả lời"""
+        if isinstance(error, asyncio.TimeoutError):
+            logger.error("Error generating answer: LLM deadline exceeded")
+            return "Xảy ra lỗi khi tạo câu trả lời: hết thời gian chờ LLM"
+        logger.error(f"Error generating answer: {str(error)}")
+        return f"Xảy ra lỗi khi tạo câu trả lời: {str(error)}"
+
+    async def astream_answer(self, query, retrieved_docs, deadline=None):
+        """
+        Yield từng phần câu trả lời ngay khi LLM sinh ra. Giữ một lượt của semaphore tới khi
+        stream xong; deadline tính cho cả stream, quá hạn thì báo asyncio.TimeoutError.
+        """
+        loop = asyncio.get_running_loop()
+        end = loop.time() + (deadline or self.deadline)
+        await asyncio.wait_for(self.semaphore.acquire(), timeout=end - loop.time())
+        stream = self.llm.astream(self._answer_prompt(query, retrieved_docs))
         try:
-            # Create context from documents
-            context = "\n\n".join([f"Đoạn {i+1}: {doc.content}" for i, (doc, _) in enumerate(retrieved_docs)])
-            
-            # Create prompt
-            prompt = f"""Câu hỏi: {query}
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(stream.__anext__(), timeout=max(0, end - loop.time()))
+                except StopAsyncIteration:
+                    return
+                if chunk.content:
+                    yield chunk.content
+        finally:
+            self.semaphore.release()
+            await stream.aclose()
+
+    @staticmethod
+    def _answer_prompt(query, retrieved_docs):
+        # Create context from documents
+        context = "\n\n".join([f"Đoạn {i+1}: {doc.content}" for i, (doc, _) in enumerate(retrieved_docs)])
+
+        # Create prompt
+        return f"""Câu hỏi: {query}
 
                 Thông tin liên quan:
                 {context}
@@ -28,101 +86,128 @@ class LLMService:
                 Hãy trả lời câu hỏi trên dựa trên thông tin đã cung cấp. Nếu không có đủ thông tin để trả lời, hãy nói rõ rằng bạn không thể tìm thấy câu trả lời trong tài liệu. Trả lời cần trung thực, chính xác và dựa trên các thông tin được cung cấp.
 
                 Trả lời:"""
-            
-            # Call LLM
-            response = self.llm.invoke(prompt)
-            answer = response.content
-            
-            return answer
-        except Exception as e:
-            logger.error(f"Error generating answer: {str(e)}")
-            return f"Xảy ra lỗi khi tạo câu trả lời: {str(e)}"
-        
-        
-    def create_question_template(self, chat_all_information: dict):
+
+    @staticmethod
+    def latest_query(chat_all_information: dict):
+        """Câu hỏi cuối cùng của người dùng"""
+        messages = chat_all_information["messages"]
+        user_messages = [msg for msg in messages if msg.get("role") == "user"]
+        return user_messages[-1].get("content", "").strip()
+
+    @staticmethod
+    def _conversation_text(chat_all_information: dict):
+        """Tóm tắt phần trước (nếu có) và các tin nhắn gần nhất, trừ câu hỏi cuối cùng"""
+        conversation_text = ""
+        summary = chat_all_information.get("summary")
+        if summary:
+            conversation_text += f"Tóm tắt phần trước của cuộc trò chuyện: {summary}\n\nCác tin nhắn gần nhất:\n"
+        for msg in chat_all_information["messages"][:-1]:
+            role: str = msg.get("role", "unknown")
+            content = msg.get("content", "").strip()
+            conversation_text += f"{role.upper()}: {content}\n"
+        return conversation_text
+
+    @staticmethod
+    def _files_text(chat_all_information: dict):
+        files_text = ""
+        for idx, file in enumerate(chat_all_information.get("files", [])):
+            files_text += f"File {idx+1}: {file.get('file_name', '')}. Mô tả: {file.get('description', '')}\n"
+        return files_text
+
+    async def acreate_query_variants(self, chat_all_information: dict, variant_count: int = 3, deadline=None):
         """
-        Đọc toàn bộ thông tin cuộc hội thoại và dùng LLM để viết lại câu hỏi cuối cùng của người dùng.
-        
+        Viết lại câu hỏi cuối cùng của người dùng thành nhiều biến thể để search cùng lúc.
+
         Tham số:
-        chat_all_information: dict chứa thông tin về cuộc trò chuyện (messages)
-        
+        chat_all_information: dict chứa thông tin về cuộc trò chuyện (summary, messages, files)
+        variant_count: số biến thể cần tạo
+
         Trả về:
-        str: Câu hỏi được LLM viết lại, đầy đủ ý nghĩa và rõ ràng, giới hạn 10 - 70 từ.
+        list[str]: các câu hỏi viết lại, phần tử đầu là câu hỏi chính dùng để trả lời.
         """
-        messages = chat_all_information["messages"]
-        user_messages = [msg for msg in messages if msg.get("role") == "user"]
-        latest_query = user_messages[-1].get("content", "").strip()
-
+        latest_query = self.latest_query(chat_all_information)
         try:
-            if not chat_all_information or "messages" not in chat_all_information:
-                return "Không có dữ liệu cuộc trò chuyện để tạo câu hỏi."
-
-            # messages = chat_all_information["messages"]
-
-            # Tìm câu hỏi cuối cùng của người dùng
-
-            # Xây dựng nội dung toàn bộ hội thoại
-            conversation_text = ""
-            for idx, msg in enumerate(messages[:-1]):
-                role:str = msg.get("role", "unknown").capitalize()
-                content = msg.get("content", "").strip()
-                conversation_text += f"{role.upper()}: {content}\n"
-
-            files_text = ""
-            if "files" in chat_all_information:
-                files = chat_all_information["files"]
-                for idx, file in enumerate(files):
-                    file_name = file.get("file_name", "")
-                    description = file.get("description", "")
-                    files_text += f"File {idx+1}: {file_name}. Mô tả: {description}\n"
-
-            # Tạo prompt chi tiết cho LLM
-            prompt = (
-                "Bạn là một chuyên gia ngôn ngữ. Bạn được cung cấp toàn bộ cuộc trò chuyện giữa một người dùng và một hệ thống AI.\n"
-                "Dưới đây là toàn bộ cuộc hội thoại giữa User và AI.\n\n"
-                "-------------------\n"
-                f"{conversation_text}\n\n"
-                f"Câu hỏi cuối cùng của người dùng: {latest_query}\n\n"
-                "-------------------\n\n"
-                "Dưới đây là toàn bộ các file được cung cấp trong đoạn chat và mô tả của chúng.\n"
-                "-------------------\n"
-                f"{files_text}"
-                "-------------------\n\n"
-
-                "Nhiệm vụ của bạn:\n"
-                "- Đọc kỹ toàn bộ nội dung cuộc trò chuyện.\n"
-                "- Viết lại câu hỏi cuối cùng của người dùng một cách đầy đủ, rõ ràng, dễ hiểu.\n"
-                "- Đảm bảo câu hỏi mới vẫn giữ nguyên ý nghĩa câu hỏi gốc.\n"
-                "- Câu hỏi viết lại nên tối ưu cho hệ thống tìm kiếm embedding.\n"
-                "- Yêu cầu độ dài câu hỏi từ 10 đến 70 từ.\n\n"
-                "- Ưu tiên viết lại câu hỏi với ngôn ngữ của tài liệu liên quan. \n\n"
-                "Câu hỏi viết lại là:"
+            response = await self._ainvoke(
+                self._query_variants_prompt(chat_all_information, latest_query, variant_count), deadline
             )
-            print("PROMPT: ---\n\n")
-            print(prompt)
-
-            # Gọi LLM để sinh câu hỏi
-            response = self.llm.invoke(prompt)
-            rewritten_question = response.content.strip()
-            print(rewritten_question)
-            print("END  ---\n\n")
-
-            # Kiểm tra độ dài câu hỏi (phòng trường hợp LLM không tuân thủ)
-            # word_count = len(rewritten_question.split())
-            # if word_count < 10:
-            #     rewritten_question += " Xin cung cấp thêm chi tiết để làm rõ ý định của người dùng."
-            # elif word_count > 70:
-            #     rewritten_question = " ".join(rewritten_question.split()[:70])
-
-            return rewritten_question
-
+            return self._parse_variants(response.content, variant_count) or [latest_query]
         except Exception as e:
-            logger.error(f"Lỗi trong create_question_template: {str(e)}")
-            return latest_query
+            logger.error(f"Lỗi trong acreate_query_variants: {str(e) or type(e).__name__}")
+            return [latest_query]
+
+    def _query_variants_prompt(self, chat_all_information: dict, latest_query: str, variant_count: int):
+        return (
+            "Bạn là một chuyên gia ngôn ngữ. Bạn được cung cấp toàn bộ cuộc trò chuyện giữa một người dùng và một hệ thống AI.\n"
+            "-------------------\n"
+            f"{self._conversation_text(chat_all_information)}\n\n"
+            f"Câu hỏi cuối cùng của người dùng: {latest_query}\n\n"
+            "-------------------\n\n"
+            "Dưới đây là toàn bộ các file được cung cấp trong đoạn chat và mô tả của chúng.\n"
+            "-------------------\n"
+            f"{self._files_text(chat_all_information)}"
+            "-------------------\n\n"
+
+            "Nhiệm vụ của bạn:\n"
+            f"- Viết lại câu hỏi cuối cùng của người dùng thành {variant_count} câu hỏi khác nhau.\n"
+            "- Câu đầu tiên là câu hỏi viết lại đầy đủ, rõ ràng, giữ nguyên ý nghĩa câu hỏi gốc.\n"
+            "- Các câu sau diễn đạt cùng nhu cầu thông tin theo cách khác (từ đồng nghĩa, góc nhìn khác, từ khóa cụ thể hơn).\n"
+            "- Mỗi câu hỏi tối ưu cho hệ thống tìm kiếm embedding, dài từ 10 đến 70 từ.\n"
+            "- Ưu tiên viết với ngôn ngữ của tài liệu liên quan.\n"
+            "- Mỗi câu hỏi nằm trên một dòng, không đánh số, không giải thích thêm.\n\n"
+            "Các câu hỏi viết lại là:"
+        )
+
+    @staticmethod
+    def _parse_variants(content: str, variant_count: int):
+        variants = []
+        for line in content.splitlines():
+            # Bỏ số thứ tự / gạch đầu dòng nếu LLM vẫn thêm vào
+            line = re.sub(r'^\s*(?:[-*•]|\d+[.)])\s*', '', line).strip()
+            if line and line not in variants:
+                variants.append(line)
+        return variants[:variant_count]
+
+    async def asummarize_conversation(self, summary: str, messages, max_words: int = None, deadline=None):
+        """
+        Gộp các tin nhắn (cũ trước) vào tóm tắt hiện có của cuộc trò chuyện, trả về tóm tắt mới.
+        Lỗi của LLM được raise cho nơi gọi (tóm tắt cũ được giữ nguyên).
+        """
+        response = await self._ainvoke(
+            self._summary_prompt(summary, messages, max_words or config.CHAT_SUMMARY_MAX_WORDS), deadline
+        )
+        return response.content.strip()
 
+    @staticmethod
+    def _summary_prompt(summary: str, messages, max_words: int):
+        messages_text = "".join(
+            f"{msg.get('role', 'unknown').upper()}: {msg.get('content', '').strip()}\n" for msg in messages
+        )
+        return (
+            "Bạn đang ghi nhớ một cuộc trò chuyện giữa người dùng và một hệ thống AI trả lời dựa trên tài liệu.\n"
+            "Tóm tắt hiện có của cuộc trò chuyện:\n"
+            "-------------------\n"
+            f"{summary or '(chưa có)'}\n"
+            "-------------------\n\n"
+            "Các tin nhắn tiếp theo:\n"
+            "-------------------\n"
+            f"{messages_text}"
+            "-------------------\n\n"
+
+            "Nhiệm vụ của bạn:\n"
+            "- Viết lại tóm tắt, gộp nội dung của các tin nhắn tiếp theo vào tóm tắt hiện có.\n"
+            "- Giữ lại các chủ đề, thực thể, tên tài liệu và câu hỏi quan trọng để hiểu các câu hỏi sau.\n"
+            f"- Tóm tắt không dài quá {max_words} từ, viết bằng ngôn ngữ của cuộc trò chuyện.\n"
+            "- Chỉ trả về nội dung tóm tắt, không giải thích thêm.\n\n"
+            "Tóm tắt mới là:"
+        )
 
     def create_description_short_for_file(self, first_content_of_file, last_content_of_file):
-        prompt = f"""
+        response = self.llm.invoke(self._description_prompt(first_content_of_file, last_content_of_file))
+        return response.content
+
+    @staticmethod
+    def _description_prompt(first_content_of_file, last_content_of_file):
+        return f"""
             Tôi sẽ cung cấp cho bạn đoạn đầu tiên và đoạn cuối cùng của một tài liệu.
             Dựa trên phần giới thiệu này, hãy mô tả rõ ràng nội dung chính và mục đích của toàn bộ tài liệu.
             Hãy nêu ra ngôn ngữ của tài liệu, mô tả cần ngắn gọn, dễ hiểu, đầy đủ thông tin và không dài quá 100 từ.
@@ -131,10 +216,3 @@ class LLMService:
             Nội dung đoạn cuối cùng của tài liệu như sau:
                 {last_content_of_file}
             """
-
-        response = self.llm.invoke(prompt)
-        return response.content
-
-        pass
-
-    
\ No newline at end of file
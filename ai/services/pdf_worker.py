@@ -0,0 +1,27 @@
+"""
+Hàm chạy trong process của pool tách PDF (xem text_processor.get_pdf_pool). Module chỉ import
+thư viện chuẩn và PyPDF2, không import config hay app, để process forkserver / spawn khởi
+động nhanh và không nạp model, index, kết nối DB.
+"""
+import os
+import mmap
+import PyPDF2
+
+# PdfReader của file đang được đọc trong process worker, dùng lại giữa các khoảng trang
+_worker_reader = None
+
+
+def extract_pdf_pages(path, start, stop):
+    """Text của các trang [start, stop) của file PDF"""
+    global _worker_reader
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if _worker_reader is None or _worker_reader[0] != key:
+        if _worker_reader is not None:
+            _worker_reader[2].close()
+        # PdfReader đọc thẳng từ mmap, các trang chỉ được nạp vào bộ nhớ khi cần
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _worker_reader = (key, PyPDF2.PdfReader(data), data)
+    pages = _worker_reader[1].pages
+    return [(pages[i].extract_text() or "") + "\n" for i in range(start, stop)]
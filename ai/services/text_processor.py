@@ -1,118 +1,503 @@
+import os
 import re
+import mmap
+import codecs
 import logging
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import PyPDF2
 import docx
 from io import BytesIO
+from contextlib import contextmanager
+import config
+from ai.services.extract_cache import ExtractCache, file_sha256
+from ai.services.pdf_worker import extract_pdf_pages
 
 logger = logging.getLogger("doc_retrieval_api.text_processor")
 
+# Số byte đọc mỗi lần từ file TXT
+TEXT_BLOCK_SIZE = 64 * 1024
+
+# Tăng khi cách tách text thay đổi để text cũ trong cache không được dùng lại
+EXTRACTOR_VERSION = "1"
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+_extract_cache = None
+_extract_cache_lock = threading.Lock()
+
+
+def get_extract_cache():
+    """Cache text đã tách (None nếu EXTRACT_CACHE_DIR trống), tạo ở lần dùng đầu tiên"""
+    global _extract_cache
+    if not config.EXTRACT_CACHE_DIR:
+        return None
+    with _extract_cache_lock:
+        if _extract_cache is None:
+            _extract_cache = ExtractCache(config.EXTRACT_CACHE_DIR, config.EXTRACT_CACHE_MAX_BYTES)
+        return _extract_cache
+
+
+def extractor_version(file_extension):
+    """Phiên bản bộ tách của một định dạng, là một phần key của cache"""
+    if file_extension == 'pdf':
+        return f"{EXTRACTOR_VERSION}.pypdf{PyPDF2.__version__}"
+    return EXTRACTOR_VERSION
+
+
+@contextmanager
+def open_mmap(path):
+    """File trên đĩa dạng mmap chỉ đọc (file rỗng không mmap được nên dùng BytesIO rỗng)"""
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            yield BytesIO()
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+
+def pdf_worker_count():
+    return config.PDF_EXTRACT_WORKERS or os.cpu_count() or 1
+
+
+def get_pdf_pool():
+    """Process pool tách text PDF, tạo ở lần dùng đầu tiên"""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # Không dùng fork: process web có nhiều thread (event loop, ingest, FAISS), fork giữa
+            # lúc một thread khác giữ lock thì process con có thể bị treo. forkserver chỉ nạp sẵn
+            # pdf_worker (không import app) rồi fork các worker từ process sạch đó
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(["ai.services.pdf_worker"])
+            else:
+                context = multiprocessing.get_context("spawn")
+            _pdf_pool = ProcessPoolExecutor(max_workers=pdf_worker_count(), mp_context=context)
+        return _pdf_pool
+
+
+def _iter_pdf_parallel(path, pages_per_task):
+    with open_mmap(path) as data:
+        page_count = len(PyPDF2.PdfReader(data).pages)
+
+    pool = get_pdf_pool()
+    ranges = deque(
+        (start, min(start + pages_per_task, page_count))
+        for start in range(0, page_count, pages_per_task)
+    )
+    max_pending = 2 * pdf_worker_count()
+    pending = deque()
+    try:
+        while ranges or pending:
+            while ranges and len(pending) < max_pending:
+                pending.append(pool.submit(extract_pdf_pages, path, *ranges.popleft()))
+            yield from pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _iter_file_pieces(path, file_extension):
+    """Text của file trên đĩa theo từng phần; khác TextProcessor.iter_*, lỗi được raise"""
+    if file_extension == 'pdf':
+        yield from _iter_pdf_parallel(path, config.PDF_PAGES_PER_TASK)
+    elif file_extension == 'docx':
+        # zipfile đọc từng phần của file theo offset, không cần mmap
+        for para in docx.Document(path).paragraphs:
+            yield para.text + "\n"
+    elif file_extension == 'txt':
+        with open_mmap(path) as data:
+            yield from TextProcessor.iter_text_from_txt(data)
+
+
+WORD = re.compile(r'\S+')
+# Dấu kết thúc câu: . ! ? ngay trước khoảng trắng
+SENTENCE_END = re.compile(r'[.!?](?=\s)')
+# Ước lượng token khi không có tokenizer của model: mỗi cụm chữ/số hoặc dấu câu là một token
+TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]')
+
+CHUNK_UNITS = ("chars", "tokens")
+
+_token_counter = None
+_token_counter_lock = threading.Lock()
+
+
+def get_token_counter():
+    """
+    Hàm đếm số token của một đoạn text. Dùng tokenizer của EMBEDDING_MODEL_NAME nếu cài
+    transformers, không thì ước lượng theo TOKEN_PATTERN.
+    """
+    global _token_counter
+    with _token_counter_lock:
+        if _token_counter is None:
+            try:
+                from transformers import AutoTokenizer
+
+                tokenizer = AutoTokenizer.from_pretrained(config.EMBEDDING_MODEL_NAME)
+
+                def count(text):
+                    return len(tokenizer.tokenize(text))
+            except Exception as e:
+                logger.warning(f"Tokenizer for {config.EMBEDDING_MODEL_NAME} unavailable, estimating tokens: {e}")
+
+                def count(text):
+                    return len(TOKEN_PATTERN.findall(text))
+            _token_counter = count
+        return _token_counter
+
+
+def _normalize(text):
+    """Gộp khoảng trắng thành một dấu cách, bỏ khoảng trắng hai đầu (str.split nhanh hơn regex)"""
+    return " ".join(text.split())
+
+
+def _char_length(text):
+    """Số ký tự sau khi gộp khoảng trắng"""
+    return len(_normalize(text))
+
+
+class TextChunk:
+    """Một chunk: text (khoảng trắng đã chuẩn hóa), vị trí [start, end) trong text gốc và kích thước"""
+
+    def __init__(self, text, start, end, size):
+        self.text = text
+        self.start = start
+        self.end = end
+        self.size = size
+
+
+class TextChunker:
+    """
+    Chia text thành chunk trong một lần duyệt, nhận text theo từng phần (trang PDF, đoạn DOCX,
+    khối TXT). Câu được gom vào chunk tới khi đủ chunk_size; câu dài hơn chunk_size được xếp
+    theo từ. Chunk kế tiếp bắt đầu bằng các từ cuối của chunk trước (tối đa overlap).
+
+    chunk_size và overlap tính bằng ký tự (unit="chars") hoặc token (unit="tokens").
+    Chunk đang gom chỉ là vị trí [start, end) trong text gốc cộng kích thước, text của chunk
+    được cắt ra một lần khi hoàn chỉnh. Bộ nhớ chỉ giữ phần text từ đầu chunk đang gom.
+    """
+
+    def __init__(self, chunk_size=500, overlap=100, unit="chars", token_counter=None):
+        if unit not in CHUNK_UNITS:
+            raise ValueError(f"Unknown chunk unit '{unit}', expected one of {CHUNK_UNITS}")
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.unit = unit
+        if unit == "tokens":
+            self._measure = self._measure_word = token_counter or get_token_counter()
+            self._gap = 0
+        else:
+            self._measure = _char_length
+            # Một từ không có khoảng trắng
+            self._measure_word = len
+            self._gap = 1
+        # Số ký tự đã nhận (kích thước text gốc)
+        self.text_length = 0
+        # Phần text gốc còn cần, bắt đầu ở vị trí self._base
+        self._window = ""
+        self._base = 0
+        # Vị trí đã xử lý tới (hết câu / từ cuối cùng đã thêm vào chunk)
+        self._scanned = 0
+        # Chunk đang gom: [start, end), kích thước; _fresh: có phần chưa nằm trong chunk trước
+        self._start = None
+        self._end = None
+        self._size = 0
+        self._fresh = False
+        # Các từ overlap (start, end, size) ở đầu chunk vừa bắt đầu, có thể bỏ bớt để đủ chỗ
+        self._tail = []
+        # Câu đang dở đã dài hơn chunk_size và đang được xếp theo từ
+        self._long = False
+        # Chunk đã hoàn chỉnh, chưa trả cho người gọi
+        self._ready = []
+
+    def feed(self, text):
+        """Nhận thêm text, trả về list các chunk đã hoàn chỉnh"""
+        self.text_length += len(text)
+        self._window += text
+        self._scan(final=False)
+        return self._take_ready()
+
+    def finish(self):
+        """Trả về list các chunk còn lại khi đã hết text"""
+        self._scan(final=True)
+        if self._fresh:
+            self._emit()
+        self._start = self._end = None
+        self._size = 0
+        self._tail = []
+        self._long = False
+        self._window = ""
+        self._base = self._scanned = self.text_length
+        return self._take_ready()
+
+    def chunks(self, pieces):
+        """Generator: chunk của cả chuỗi phần text"""
+        for piece in pieces:
+            yield from self.feed(piece)
+        yield from self.finish()
+
+    def _take_ready(self):
+        ready = self._ready
+        self._ready = []
+        return ready
+
+    def _scan(self, final):
+        window = self._window
+        base = self._base
+        for match in SENTENCE_END.finditer(window, self._scanned - base):
+            self._add_sentence(self._scanned, base + match.end())
+            self._scanned = base + match.end()
+
+        rest = window[self._scanned - base:]
+        if final:
+            if rest.strip():
+                self._add_sentence(self._scanned, self.text_length)
+            self._scanned = self.text_length
+        elif self._long or self._measure(rest.strip()) > self.chunk_size:
+            # Câu chưa hết nhưng đã dài hơn chunk_size: xếp ngay các từ đã đủ,
+            # từ chạm cuối phần text hiện có có thể còn tiếp ở phần sau
+            self._long = True
+            for match in WORD.finditer(window, self._scanned - base):
+                if match.end() == len(window):
+                    break
+                self._add_span(base + match.start(), base + match.end(), self._measure_word(match.group()))
+                self._scanned = base + match.end()
+
+        # Bỏ phần text đầu không còn cần (chỉ khi được từ một nửa window để tổng chi phí vẫn tuyến tính)
+        keep = self._start if self._start is not None else self._scanned
+        if (keep - base) * 2 >= len(window):
+            self._window = window[keep - base:]
+            self._base = keep
+
+    def _add_sentence(self, start, end):
+        """Thêm câu trong [start, end) (có thể kèm khoảng trắng ở đầu)"""
+        text = self._window[start - self._base:end - self._base]
+        stripped = text.strip()
+        if not self._long:
+            size = self._measure(stripped)
+            if size <= self.chunk_size:
+                offset = len(text) - len(text.lstrip())
+                self._add_span(start + offset, start + offset + len(stripped), size)
+                return
+
+        # Câu dài (hoặc phần cuối của câu dài): xếp theo từ
+        self._long = False
+        for match in WORD.finditer(text):
+            self._add_span(start + match.start(), start + match.end(), self._measure_word(match.group()))
+
+    def _add_span(self, start, end, size):
+        if self._start is not None and self._size + self._gap + size > self.chunk_size:
+            if self._fresh:
+                self._emit()
+            # Bỏ bớt các từ overlap ở đầu chunk mới cho tới khi đủ chỗ
+            while self._tail and not self._fits(size):
+                self._tail.pop(0)
+                self._set_tail()
+
+        if self._start is None:
+            self._start = start
+            self._size = size
+        else:
+            self._size += self._gap + size
+        self._end = end
+        self._fresh = True
+        self._tail = []
+
+    def _fits(self, size):
+        if self._start is None:
+            return True
+        return self._size + self._gap + size <= self.chunk_size
+
+    def _set_tail(self):
+        """Chunk mới chỉ gồm các từ overlap trong self._tail"""
+        if self._tail:
+            self._start = self._tail[0][0]
+            self._end = self._tail[-1][1]
+            self._size = sum(size for _, _, size in self._tail) + self._gap * (len(self._tail) - 1)
+        else:
+            self._start = self._end = None
+            self._size = 0
+
+    def _emit(self):
+        """Cắt text của chunk đang gom, giữ lại các từ cuối làm overlap cho chunk sau"""
+        start, end = self._start, self._end
+        self._ready.append(TextChunk(
+            _normalize(self._window[start - self._base:end - self._base]),
+            start, end, self._size
+        ))
+        self._tail = self._overlap_words(start, end)
+        self._set_tail()
+        self._fresh = False
+
+    def _overlap_words(self, start, end):
+        """Các từ cuối của [start, end) có tổng kích thước không quá overlap (không lấy cả chunk)"""
+        if self.overlap <= 0:
+            return []
+        # Chỉ tách từ ở đoạn cuối chunk (một token thường dài vài ký tự), nới rộng nếu chưa đủ
+        span = (4 if self.unit == "tokens" else 1) * self.overlap + 32
+        while True:
+            low = max(start, end - span)
+            region = self._window[low - self._base:end - self._base]
+            # Từ đầu tiên là từ đầu chunk hoặc có thể bị cắt giữa chừng, không dùng làm overlap
+            words = region.split()[1:]
+
+            sizes = []
+            total = 0
+            for word in reversed(words):
+                size = self._measure_word(word)
+                total += size + (self._gap if sizes else 0)
+                if total > self.overlap:
+                    break
+                sizes.append(size)
+            else:
+                if low > start:
+                    span *= 2
+                    continue
+
+            # Vị trí các từ: tìm ngược từ cuối, giữa hai từ chỉ có khoảng trắng
+            tail = []
+            position = len(region)
+            for word, size in zip(reversed(words), sizes):
+                position = region.rfind(word, 0, position)
+                tail.append((low + position, low + position + len(word), size))
+            tail.reverse()
+            return tail
+
+
 class TextProcessor:
+    @staticmethod
+    def iter_text_from_pdf(file):
+        """
+        Yield text từng trang của file PDF (đường dẫn hoặc file object).
+        Lỗi tách được raise tiếp (không nuốt) để file dở dang không bị index như file đầy đủ.
+        """
+        reader = PyPDF2.PdfReader(file)
+        for page in reader.pages:
+            yield (page.extract_text() or "") + "\n"
+
+    @staticmethod
+    def iter_text_from_pdf_parallel(path, pages_per_task=None):
+        """
+        Yield text từng trang của file PDF (đường dẫn) đúng thứ tự, các khoảng trang được
+        tách song song trong process pool nên không chiếm GIL của process web.
+        Chỉ giữ tối đa 2 task cho mỗi worker đang chạy để bộ nhớ không tăng theo số trang.
+        """
+        yield from _iter_pdf_parallel(path, pages_per_task or config.PDF_PAGES_PER_TASK)
+
+    @staticmethod
+    def iter_text_from_docx(file):
+        """Yield text từng đoạn của file DOCX (đường dẫn hoặc file object), lỗi tách được raise tiếp"""
+        doc = docx.Document(file)
+        for para in doc.paragraphs:
+            yield para.text + "\n"
+
+    @staticmethod
+    def iter_text_from_txt(file, block_size=TEXT_BLOCK_SIZE):
+        """Yield text của file TXT (file object nhị phân) theo từng khối, UTF-8 hoặc latin-1"""
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        while True:
+            block = file.read(block_size)
+            final = not block
+            pending = decoder.getstate()[0]
+            try:
+                text = decoder.decode(block, final=final)
+            except UnicodeDecodeError:
+                # Không phải UTF-8: phần còn lại đọc bằng latin-1 (luôn decode được)
+                decoder = codecs.getincrementaldecoder("latin-1")()
+                text = decoder.decode(pending + block, final=final)
+            if text:
+                yield text
+            if final:
+                return
+
+    @staticmethod
+    def iter_text(file, file_extension):
+        """Yield text của file theo từng phần (trang / đoạn / khối) dựa trên định dạng"""
+        if file_extension.lower() == 'pdf':
+            return TextProcessor.iter_text_from_pdf(file)
+        elif file_extension.lower() == 'docx':
+            return TextProcessor.iter_text_from_docx(file)
+        elif file_extension.lower() == 'txt':
+            return TextProcessor.iter_text_from_txt(file)
+        else:
+            return iter(())
+
+    @staticmethod
+    def iter_file_text(path, file_extension, content_hash=None):
+        """
+        Yield text của file trên đĩa theo từng phần, PDF được tách trong process pool.
+        Text đã tách được cache theo sha256 nội dung (content_hash, tính từ file nếu không
+        truyền vào), nên cùng bytes chỉ bị parse một lần.
+        Lỗi tách (kể cả sau khi đã yield vài trang) được raise cho caller để dọn các chunk
+        đã index và đánh dấu file lỗi.
+        """
+        file_extension = file_extension.lower()
+        if file_extension not in ('pdf', 'docx', 'txt'):
+            return
+        cache = get_extract_cache()
+        if cache is None:
+            yield from _iter_file_pieces(path, file_extension)
+            return
+
+        key = (content_hash or file_sha256(path), file_extension, extractor_version(file_extension))
+        cached = cache.iter_text(key)
+        if cached is not None:
+            logger.info(f"Extracted text cache hit for {os.path.basename(path)}")
+            yield from cached
+            return
+
+        writer = cache.writer(key)
+        completed = False
+        try:
+            for piece in _iter_file_pieces(path, file_extension):
+                writer.write(piece)
+                yield piece
+            completed = True
+        finally:
+            # Chỉ cache text của file được tách trọn vẹn
+            if completed:
+                writer.commit()
+            else:
+                writer.discard()
+
     @staticmethod
     def extract_text_from_pdf(file_content):
         """Extract text from PDF file"""
         try:
-            reader = PyPDF2.PdfReader(BytesIO(file_content))
-            text = ""
-            for page in reader.pages:
-                text += page.extract_text() + "\n"
-            return text
+            return "".join(TextProcessor.iter_text_from_pdf(BytesIO(file_content)))
         except Exception as e:
             logger.error(f"Error extracting PDF: {str(e)}")
             return ""
-            
+
     @staticmethod
     def extract_text_from_docx(file_content):
         """Extract text from DOCX file"""
         try:
-            doc = docx.Document(BytesIO(file_content))
-            text = ""
-            for para in doc.paragraphs:
-                text += para.text + "\n"
-            return text
+            return "".join(TextProcessor.iter_text_from_docx(BytesIO(file_content)))
         except Exception as e:
             logger.error(f"Error extracting DOCX: {str(e)}")
             return ""
-    
+
     @staticmethod
     def extract_text_from_txt(file_content):
         """Extract text from TXT file"""
-        try:
-            return file_content.decode("utf-8")
-        except UnicodeDecodeError:
-            try:
-                return file_content.decode("latin-1")
-            except:
-                return ""
-    
+        return "".join(TextProcessor.iter_text_from_txt(BytesIO(file_content)))
+
     @staticmethod
     def extract_text(file_content, file_extension):
         """Extract text from file based on format"""
-        if file_extension.lower() == 'pdf':
-            return TextProcessor.extract_text_from_pdf(file_content)
-        elif file_extension.lower() == 'docx':
-            return TextProcessor.extract_text_from_docx(file_content)
-        elif file_extension.lower() == 'txt':
-            return TextProcessor.extract_text_from_txt(file_content)
-        else:
+        try:
+            return "".join(TextProcessor.iter_text(BytesIO(file_content), file_extension))
+        except Exception as e:
+            logger.error(f"Error extracting {file_extension.upper()}: {str(e)}")
             return ""
-    
+
     @staticmethod
-    def chunk_text(text, chunk_size=500, overlap=100):
+    def chunk_text(text, chunk_size=500, overlap=100, unit="chars"):
         """Split text into chunks of appropriate size"""
         if not text:
             return []
-            
-        # Process newlines and whitespace
-        text = re.sub(r'\s+', ' ', text)
-        
-        # Split into sentences
-        sentences = re.split(r'(?<=[.!?])\s+', text)
-        
-        chunks = []
-        current_chunk = ""
-        
-        for sentence in sentences:
-            # If sentence is longer than chunk_size, need to split further
-            if len(sentence) > chunk_size:
-                # Handle long sentences by splitting by words
-                words = sentence.split()
-                temp_chunk = ""
-                
-                for word in words:
-                    if len(temp_chunk) + len(word) + 1 <= chunk_size:
-                        temp_chunk += " " + word if temp_chunk else word
-                    else:
-                        chunks.append(temp_chunk)
-                        temp_chunk = word
-                
-                if temp_chunk:
-                    current_chunk += " " + temp_chunk if current_chunk else temp_chunk
-            else:
-                # Handle short sentences
-                if len(current_chunk) + len(sentence) + 1 <= chunk_size:
-                    current_chunk += " " + sentence if current_chunk else sentence
-                else:
-                    chunks.append(current_chunk)
-                    current_chunk = sentence
-        
-        # Add final chunk
-        if current_chunk:
-            chunks.append(current_chunk)
-        
-        # Create chunks with overlap
-        result_chunks = []
-        for i in range(len(chunks)):
-            chunk = chunks[i]
-            
-            # Add overlap from next chunk if available
-            if i < len(chunks) - 1 and len(chunk) < chunk_size:
-                next_chunk = chunks[i+1]
-                words_to_add = next_chunk.split()[:overlap]
-                overlap_text = " ".join(words_to_add)
-                
-                if len(chunk) + len(overlap_text) + 1 <= chunk_size:
-                    chunk += " " + overlap_text
-            
-            result_chunks.append(chunk)
-        
-        return result_chunks
\ No newline at end of file
+        return [chunk.text for chunk in TextChunker(chunk_size, overlap, unit).chunks([text])]
@@ -0,0 +1,228 @@
+import os
+import json
+import struct
+import zlib
+import threading
+import logging
+from ai.utils.file_lock import FileLock
+
+logger = logging.getLogger("doc_retrieval_api.wal")
+
+# Mỗi record: header_len, payload_len, crc32(header + payload), rồi header JSON và payload nhị phân
+RECORD_HEADER = struct.Struct("<IIi")
+
+
+class _PendingAppend:
+    def __init__(self, build):
+        self.build = build
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+class WriteAheadLog:
+    """
+    Log append-only cho các thay đổi của index, dùng chung giữa các process.
+
+    - Mỗi file log bắt đầu bằng record "begin" ghi generation; checkpoint tạo file mới với
+      generation kế tiếp (rename nguyên tử), nên process khác nhận ra log đã được xoay.
+    - Group commit: nhiều thread append cùng lúc chỉ tốn một lần write + fsync. Thread leader
+      giữ khóa file exclusive, gọi before_flush (để đọc record của process khác trước),
+      rồi chạy hàm build của từng thread đang chờ để tạo record.
+    """
+
+    def __init__(self, path: str, sync: bool = True):
+        self.path = path
+        self.sync = sync
+        self.lock = FileLock(path + ".lock")
+        self.generation = None
+        self.before_flush = None
+        self._file = None
+        self._inode = None
+        # Vị trí đã đọc / ghi tới trong file hiện tại
+        self._offset = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._queue = []
+        self._flushing = False
+
+    @staticmethod
+    def _encode(header: dict, payload: bytes = b""):
+        header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        crc = zlib.crc32(header_bytes + payload)
+        # struct "i" là số có dấu
+        if crc >= 2 ** 31:
+            crc -= 2 ** 32
+        return RECORD_HEADER.pack(len(header_bytes), len(payload), crc) + header_bytes + payload
+
+    @staticmethod
+    def _decode(data: bytes, offset: int):
+        """Trả về (records, offset sau record đầy đủ cuối cùng)"""
+        records = []
+        while offset + RECORD_HEADER.size <= len(data):
+            header_len, payload_len, crc = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            end = start + header_len + payload_len
+            if end > len(data) or zlib.crc32(data[start:end]) != crc & 0xffffffff:
+                break
+            header = json.loads(data[start:start + header_len].decode("utf-8"))
+            records.append((header, data[start + header_len:end]))
+            offset = end
+        return records, offset
+
+    def _open_current(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, "a+b")
+        self._inode = os.fstat(self._file.fileno()).st_ino
+        self._offset = 0
+
+    def _read_new(self):
+        self._file.seek(self._offset)
+        records, end = self._decode(self._file.read(), 0)
+        self._offset += end
+        return records
+
+    def _create(self, generation: int):
+        """Thay file log bằng file rỗng của generation mới"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self._encode({"op": "begin", "generation": generation}))
+            f.flush()
+            if self.sync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._open_current()
+        self._read_new()
+        self.generation = generation
+
+    def open(self, generation: int):
+        """
+        Mở log khi khởi động, gọi khi đang giữ lock.exclusive(). Trả về các record sau snapshot
+        của generation này. Log của generation cũ (checkpoint dừng sau khi đã ghi snapshot)
+        bị bỏ; record cuối bị ghi dở (crash giữa chừng) được cắt khỏi file.
+        """
+        if not os.path.exists(self.path):
+            self._create(generation)
+            return []
+
+        self._open_current()
+        self._file.seek(0)
+        data = self._file.read()
+        records, valid_size = self._decode(data, 0)
+
+        # Log ghi trước khi có record begin thuộc generation 0
+        log_generation = 0
+        if records and records[0][0]["op"] == "begin":
+            log_generation = records.pop(0)[0]["generation"]
+        if log_generation != generation:
+            logger.info(f"Discarding WAL of generation {log_generation}, snapshot is {generation}")
+            self._create(generation)
+            return []
+
+        if valid_size < len(data):
+            logger.warning(f"Truncating {len(data) - valid_size} bytes of torn WAL tail in {self.path}")
+            self._file.truncate(valid_size)
+        self._offset = valid_size
+        self.generation = generation
+        return records
+
+    def has_new_data(self):
+        """Kiểm tra nhanh (không khóa) xem process khác đã ghi thêm hoặc xoay log chưa"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return stat.st_ino != self._inode or stat.st_size != self._offset
+
+    def read_new(self):
+        """
+        Đọc record mới do process khác ghi, gọi khi đang giữ khóa file.
+        Trả về (records, rotated): rotated là True nếu log đã được thay bằng generation mới,
+        khi đó records là phần còn lại của file cũ và cần gọi reopen().
+        """
+        records = self._read_new()
+        try:
+            rotated = os.stat(self.path).st_ino != self._inode
+        except FileNotFoundError:
+            rotated = False
+        return records, rotated
+
+    def reopen(self):
+        """Chuyển sang file log mới sau khi process khác checkpoint, trả về các record của nó"""
+        self._open_current()
+        records = self._read_new()
+        if records and records[0][0]["op"] == "begin":
+            self.generation = records.pop(0)[0]["generation"]
+        return records
+
+    def rotate(self, generation: int):
+        """Gọi sau khi snapshot đã chứa mọi record, khi đang giữ lock.exclusive()"""
+        self._create(generation)
+
+    def append(self, build):
+        """
+        Ghi một record và chỉ trả về khi record đã nằm trên đĩa.
+        build() được gọi trong thread leader khi đang giữ khóa file, trả về
+        (header, payload, result); append trả về result.
+        """
+        pending = _PendingAppend(build)
+        with self._cond:
+            self._queue.append(pending)
+
+            while not pending.done:
+                if self._flushing:
+                    self._cond.wait()
+                    continue
+
+                # Thread này làm leader: ghi mọi record đang chờ trong một lần
+                self._flushing = True
+                batch, self._queue = self._queue, []
+                self._cond.release()
+                try:
+                    self._flush(batch)
+                finally:
+                    self._cond.acquire()
+                    self._flushing = False
+                    for item in batch:
+                        item.done = True
+                    self._cond.notify_all()
+
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _flush(self, batch):
+        with self.lock.exclusive():
+            try:
+                if self.before_flush is not None:
+                    self.before_flush()
+
+                chunks = []
+                for item in batch:
+                    try:
+                        header, payload, item.result = item.build()
+                        chunks.append(self._encode(header, payload))
+                    except Exception as e:
+                        item.error = e
+
+                if chunks:
+                    data = b"".join(chunks)
+                    self._file.write(data)
+                    self._file.flush()
+                    if self.sync:
+                        os.fsync(self._file.fileno())
+                    self._offset += len(data)
+            except Exception as e:
+                logger.error(f"Error writing WAL batch of {len(batch)} records: {e}")
+                for item in batch:
+                    item.error = item.error or e
+
+    def size(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def close(self):
+        with self._cond:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self.lock.close()
@@ -0,0 +1,62 @@
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: chỉ khóa được trong một process
+    fcntl = None
+
+
+class FileLock:
+    """
+    Khóa giữa các process (flock) trên một file, dùng khi nhiều worker uvicorn mở chung
+    một thư mục dữ liệu. flock gắn với file descriptor chứ không với thread, nên các thread
+    trong cùng process còn phải đi qua một mutex.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._mutex = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    @contextmanager
+    def _locked(self, mode):
+        with self._mutex:
+            if fcntl is not None:
+                fcntl.flock(self._fd, mode)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @contextmanager
+    def try_exclusive(self):
+        """Như exclusive() nhưng không chờ: yield False nếu thread / process khác đang giữ khóa"""
+        if not self._mutex.acquire(blocking=False):
+            yield False
+            return
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    yield False
+                    return
+            try:
+                yield True
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._mutex.release()
+
+    def shared(self):
+        return self._locked(fcntl.LOCK_SH if fcntl else None)
+
+    def exclusive(self):
+        return self._locked(fcntl.LOCK_EX if fcntl else None)
+
+    def close(self):
+        os.close(self._fd)
@@ -0,0 +1,49 @@
+import bisect
+import hashlib
+
+
+class HashRing:
+    """
+    Consistent hashing: mỗi node có `replicas` điểm ảo trên vòng, key thuộc về node của điểm
+    đầu tiên theo chiều kim đồng hồ. Thêm/bớt một node chỉ làm đổi chủ khoảng 1/N số key.
+    """
+
+    def __init__(self, nodes=(), replicas: int = 100):
+        self.replicas = replicas
+        self._points = []
+        self._owners = {}
+        self.nodes = []
+        for node in nodes:
+            self.add_node(node)
+
+    @staticmethod
+    def _hash(key: str):
+        return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+    def add_node(self, node: str):
+        if node in self.nodes:
+            return
+        self.nodes.append(node)
+        for i in range(self.replicas):
+            point = self._hash(f"{node}#{i}")
+            self._owners[point] = node
+            bisect.insort(self._points, point)
+
+    def remove_node(self, node: str):
+        if node not in self.nodes:
+            return
+        self.nodes.remove(node)
+        for i in range(self.replicas):
+            point = self._hash(f"{node}#{i}")
+            if self._owners.get(point) == node:
+                del self._owners[point]
+                self._points.remove(point)
+
+    def get_node(self, key: str):
+        if not self._points:
+            raise ValueError("Hash ring has no nodes")
+        position = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[self._points[position]]
+
+    def copy(self):
+        return HashRing(self.nodes, self.replicas)
@@ -11,6 +11,12 @@ def setup_logging():
     loggers = [
         "doc_retrieval_api",
         "doc_retrieval_api.index_manager",
+        "doc_retrieval_api.index_store",
+        "doc_retrieval_api.wal",
+        "doc_retrieval_api.index_client",
+        "doc_retrieval_api.ingest_queue",
+        "doc_retrieval_api.index_factory",
+        "doc_retrieval_api.embedding_providers",
         "doc_retrieval_api.llm_service",
         "doc_retrieval_api.text_processor"
     ]
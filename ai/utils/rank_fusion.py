@@ -0,0 +1,18 @@
+def reciprocal_rank_fusion(ranked_lists, top_k: int, rrf_k: int):
+    """
+    Gộp các danh sách (doc, similarity) đã xếp hạng (một danh sách cho mỗi biến thể câu hỏi)
+    bằng reciprocal-rank fusion. Trả về list (doc, similarity) sắp theo điểm RRF; similarity
+    là giá trị cao nhất của document đó trên các danh sách.
+    """
+    fused = {}
+    for ranked in ranked_lists:
+        for rank, (doc, similarity) in enumerate(ranked):
+            score, best_similarity, _ = fused.get(doc.id, (0.0, 0.0, doc))
+            fused[doc.id] = (
+                score + 1.0 / (rrf_k + rank + 1),
+                max(best_similarity, similarity),
+                doc
+            )
+
+    results = sorted(fused.values(), key=lambda item: item[0], reverse=True)
+    return [(doc, similarity) for _, similarity, doc in results[:top_k]]
@@ -1,7 +1,7 @@
 from fastapi import FastAPI, UploadFile, Form, APIRouter, Depends, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, Column, String, Text, DateTime, ForeignKey, SmallInteger, JSON
+from sqlalchemy import create_engine, text, Column, String, Text, DateTime, ForeignKey, SmallInteger, JSON
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship, Session
 from uuid import uuid4
@@ -20,6 +20,10 @@ class Chat(Base):
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
     name = Column(Text, nullable=False)
+    # Tóm tắt các tin nhắn tới summary_until (created_at của tin nhắn cuối đã tóm tắt),
+    # các tin nhắn sau đó được đưa nguyên văn vào prompt
+    summary = Column(Text, default="")
+    summary_until = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
     messages = relationship("Message", back_populates="chat", cascade="all, delete")
@@ -45,6 +49,8 @@ class File(Base):
     file_name = Column(Text, nullable=False)
     description = Column(Text, default="")
     embedding_infor = Column(JSON, default={})
+    # processing: đang ingest ở nền, ready: các chunk đã search được, failed: ingest lỗi
+    status = Column(String(20), default="ready")
     created_at = Column(DateTime, default=datetime.utcnow)
 
     chat = relationship("Chat", back_populates="files")
@@ -60,3 +66,9 @@ class Vote(Base):
     message = relationship("Message", back_populates="votes")
 
 Base.metadata.create_all(bind=engine)
+
+# create_all không thêm cột cho bảng đã có; file cũ đều đã ingest xong nên mặc định "ready"
+with engine.begin() as connection:
+    connection.execute(text("ALTER TABLE file ADD COLUMN IF NOT EXISTS status VARCHAR(20) DEFAULT 'ready'"))
+    connection.execute(text("ALTER TABLE chat ADD COLUMN IF NOT EXISTS summary TEXT DEFAULT ''"))
+    connection.execute(text("ALTER TABLE chat ADD COLUMN IF NOT EXISTS summary_until TIMESTAMP"))
@@ -1,16 +1,25 @@
-from fastapi import APIRouter, Depends, HTTPException, Form, UploadFile
+from fastapi import APIRouter, Depends, HTTPException, Form, UploadFile, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from sqlalchemy.orm import Session, sessionmaker
 from sqlalchemy import create_engine
 from be.models import Chat, Message, File, Vote, engine
-import shutil, os
+import shutil, os, json, logging, socket
+import config
 from sqlalchemy.ext.declarative import declarative_base
 from be.schemas import *
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 router = APIRouter()
 import uuid
 from ai.schemas import *
-from ai.ai_init import index_manager
+from ai.ai_init import index_manager, ingest_queue, answer_cache
+from ai.services.ingest_queue import IngestQueueFull
+from ai.services.extract_cache import copy_and_hash
 import ai.handle_all as ai_handle_all
+
+logger = logging.getLogger("doc_retrieval_api.routes")
 # Dependency
 def get_db():
     db = SessionLocal()
@@ -22,8 +31,212 @@ def get_db():
 UPLOAD_FOLDER = "uploaded_files"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Trạng thái file -> trạng thái job, khi job không còn trong bộ nhớ của process này
+FILE_JOB_STATUS = {"processing": "running", "ready": "done", "failed": "failed"}
+
+# Process đang ingest file (ghi vào embedding_infor lúc upload). Job chỉ nằm trong bộ nhớ,
+# process chết / khởi động lại thì file processing của nó không bao giờ xong
+INGEST_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+INTERRUPTED_ERROR = "Ingestion was interrupted by a server restart, please upload the file again"
+
+
+def _ingest_owner_alive(owner):
+    """False nếu process đã ghi File processing không còn chạy (chỉ biết được trên cùng máy)"""
+    host, _, pid = (owner or "").rpartition(":")
+    if not host:
+        # File từ trước khi có owner: đã processing từ lần chạy trước
+        return False
+    if host != socket.gethostname():
+        return True
+    if int(pid) == os.getpid():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def recover_interrupted_uploads():
+    """
+    Gọi lúc khởi động: File processing của process đã chết được đánh dấu failed và các chunk
+    đã vào index (trong WAL) bị xóa, để chúng không còn search được
+    """
+    db = SessionLocal()
+    try:
+        interrupted = [
+            db_file for db_file in db.query(File).filter(File.status == "processing").all()
+            if not _ingest_owner_alive((db_file.embedding_infor or {}).get("ingest_owner"))
+        ]
+        for db_file in interrupted:
+            file_name_save = (db_file.embedding_infor or {}).get("file_name")
+            if file_name_save:
+                index_manager.delete_file(file_name_save)
+            db_file.status = "failed"
+            db_file.embedding_infor = {"file_name": file_name_save, "error": INTERRUPTED_ERROR}
+        db.commit()
+    finally:
+        db.close()
+    if interrupted:
+        logger.warning(f"Marked {len(interrupted)} interrupted uploads as failed")
+    return len(interrupted)
+
+
+def _update_file(file_id: str, status: str, **fields):
+    """Cập nhật File từ worker ingest (session riêng); trả về False nếu file đã bị xóa"""
+    db = SessionLocal()
+    try:
+        db_file = db.query(File).filter(File.id == file_id).first()
+        if not db_file:
+            return False
+        db_file.status = status
+        for name, value in fields.items():
+            setattr(db_file, name, value)
+        db.commit()
+        return True
+    finally:
+        db.close()
+
+
+def ingest_uploaded_file(job, file_id: str, file_name_save: str, chat_id: str, content_hash: str = None):
+    """Chạy trong worker của ingest_queue: ingest file rồi mới đánh dấu File là ready"""
+    try:
+        embedding_infor, description = ai_handle_all.ingest_file(
+            file_name_save, chat_id=chat_id, progress=job.update_progress, content_hash=content_hash
+        )
+    except Exception as e:
+        _update_file(file_id, "failed", embedding_infor={
+            "file_name": file_name_save,
+            "error": getattr(e, "detail", None) or str(e)
+        })
+        # Lỗi sau khi các chunk đã vào index (vd. tạo mô tả file): file lỗi không được còn
+        # trong kết quả tìm kiếm
+        index_manager.delete_file(file_name_save)
+        raise
+
+    embedding_infor["content_hash"] = content_hash
+    if not _update_file(file_id, "ready", description=description, embedding_infor=embedding_infor):
+        # File bị xóa trong lúc ingest: bỏ các chunk vừa thêm
+        index_manager.delete_file(file_name_save)
+        raise RuntimeError("File was deleted during ingestion")
+    # Chat có thêm file: câu trả lời cũ có thể đã khác
+    answer_cache.invalidate_chat(chat_id)
+    return embedding_infor
+
+
+def _chat_information(db: Session, chat: Chat):
+    """
+    Tóm tắt hội thoại, CHAT_HISTORY_WINDOW tin nhắn gần nhất và các file đã ingest xong của chat,
+    dạng dict cho LLM. Kích thước không tăng theo độ dài cuộc trò chuyện.
+    """
+    messages = (
+        db.query(Message).filter(Message.chat_id == chat.id)
+        .order_by(Message.created_at.desc()).limit(config.CHAT_HISTORY_WINDOW).all()
+    )[::-1]
+    # Chỉ các file đã ingest xong
+    files = db.query(File).filter(File.chat_id == chat.id, File.status == "ready").all()
+    return {
+        "id": chat.id,
+        "name": chat.name,
+        "summary": chat.summary or "",
+        "messages": [
+            {
+                "content": message.content,
+                "role": message.role,
+            } for message in messages
+        ],
+        "files": [
+            {
+                "id": str(file.id),
+                "file_name": file.file_name,
+                "description": file.description,
+            } for file in files
+        ]
+    }
+
+
+def _pending_summary(chat_id: str):
+    """
+    Tóm tắt hiện tại, mốc summary_until và tối đa CHAT_SUMMARY_BATCH tin nhắn chưa tóm tắt
+    đã ra khỏi cửa sổ tin nhắn gần nhất (cũ trước)
+    """
+    db = SessionLocal()
+    try:
+        chat = db.query(Chat).filter(Chat.id == chat_id).first()
+        if not chat:
+            return None
+        query = db.query(Message).filter(Message.chat_id == chat.id)
+        if chat.summary_until is not None:
+            query = query.filter(Message.created_at > chat.summary_until)
+        messages = (
+            query.order_by(Message.created_at)
+            .limit(config.CHAT_SUMMARY_BATCH + config.CHAT_HISTORY_WINDOW).all()
+        )
+        # Các tin nhắn trong cửa sổ vẫn được đưa nguyên văn vào prompt
+        messages = messages[:max(0, len(messages) - config.CHAT_HISTORY_WINDOW)]
+        return chat.summary or "", chat.summary_until, [
+            {"role": message.role, "content": message.content, "created_at": message.created_at}
+            for message in messages
+        ]
+    finally:
+        db.close()
+
+
+def _save_summary(chat_id: str, summary_until, summary: str, new_summary_until):
+    """Lưu tóm tắt mới nếu chưa có lần cập nhật khác chen vào (so sánh summary_until)"""
+    db = SessionLocal()
+    try:
+        query = db.query(Chat).filter(Chat.id == chat_id)
+        if summary_until is None:
+            query = query.filter(Chat.summary_until.is_(None))
+        else:
+            query = query.filter(Chat.summary_until == summary_until)
+        updated = query.update(
+            {Chat.summary: summary, Chat.summary_until: new_summary_until}, synchronize_session=False
+        )
+        db.commit()
+        return updated > 0
+    finally:
+        db.close()
+
+
+async def update_chat_summary(chat_id: str):
+    """Chạy nền sau mỗi lượt trả lời: gộp các tin nhắn đã ra khỏi cửa sổ vào tóm tắt của chat"""
+    try:
+        pending = await run_in_threadpool(_pending_summary, chat_id)
+        if not pending or not pending[2]:
+            return
+        summary, summary_until, messages = pending
+        new_summary = await ai_handle_all.llm_service.asummarize_conversation(summary, messages)
+        if not await run_in_threadpool(_save_summary, chat_id, summary_until, new_summary,
+                                       messages[-1]["created_at"]):
+            logger.info(f"Summary of chat {chat_id} was updated concurrently, skipped")
+    except Exception as e:
+        logger.error(f"Error updating summary of chat {chat_id}: {str(e) or type(e).__name__}")
+
+
+def _sse(event: str, data):
+    """Một server-sent event, data dạng JSON trên một dòng"""
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data), ensure_ascii=False)}\n\n"
+
+
+def _save_message(chat_id, content: str, role: str):
+    db = SessionLocal()
+    try:
+        message = Message(chat_id=chat_id, content=content, role=role)
+        db.add(message)
+        db.commit()
+        db.refresh(message)
+        return message.id
+    finally:
+        db.close()
+
 # APIs
 def create_routes_be():
+    recover_interrupted_uploads()
+
     @router.get("/chats")
     def get_chats(db: Session = Depends(get_db)):
         chats = db.query(Chat).order_by(Chat.created_at.desc()).all()
@@ -50,7 +263,7 @@ def create_routes_be():
         return chat
 
     @router.post("/messages")
-    async def post_message( messageCreate : MessageCreate, db: Session = Depends(get_db)):
+    async def post_message( messageCreate : MessageCreate, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
         chat_id, content, role = messageCreate.chat_id, messageCreate.content, "user"
         chat = db.query(Chat).filter(Chat.id == chat_id).first()
         if not chat:
@@ -64,34 +277,7 @@ def create_routes_be():
         
         # Bot reply simulation
         if role == "user":
-            # Get all chat information
-            messages = db.query(Message).filter(Message.chat_id == chat_id).order_by(Message.created_at).all()
-            files = db.query(File).filter(File.chat_id == chat_id).all()
-            
-            # Convert SQLAlchemy objects to dictionaries
-            chat_dict = {
-                    "id": chat.id,
-                    "name": chat.name,  # Assuming these fields exist
-                    # "created_at": chat.created_at,
-                    # Add other chat fields as needed
-                    "messages": [
-                        {
-                            "content": message.content,
-                            # "created_at": message.created_at,
-                            "role": message.role,
-                        } for message in messages
-                    ],
-                    "files": [
-                        {
-                            "file_name": file.file_name,
-                            "description": file.description,
-                            # Add other file fields
-                        } for file in files
-                    ]
-                }   
-            
-            # End of conversion  
-
+            chat_dict = _chat_information(db, chat)
 
             bot_reply_content = (await ai_handle_all.query_documents_handler(chat_all_infor= chat_dict, chat_id=chat_id))["answer"]
             if bot_reply_content:
@@ -99,9 +285,53 @@ def create_routes_be():
             # bot_reply = Message(chat_id=chat_id, content=f"Bot trả lời cho: '{content}'", role="ai")
             db.add(bot_reply)
             db.commit()
+            # Tóm tắt hội thoại được cập nhật sau khi đã trả response
+            background_tasks.add_task(update_chat_summary, chat_id)
 
         return {"status": "success"}
 
+    @router.post("/messages/stream")
+    async def post_message_stream(messageCreate: MessageCreate, db: Session = Depends(get_db)):
+        """
+        Như /messages nhưng trả về câu trả lời dạng server-sent events trong lúc LLM sinh:
+        "retrieved" (câu hỏi viết lại, các đoạn tìm được), nhiều "token", rồi "done" (id tin
+        nhắn AI đã lưu) hoặc "error". Tin nhắn AI chỉ được lưu khi stream kết thúc bình thường.
+        """
+        chat_id, content = messageCreate.chat_id, messageCreate.content
+        chat = db.query(Chat).filter(Chat.id == chat_id).first()
+        if not chat:
+            raise HTTPException(status_code=404, detail="Chat not found")
+
+        message = Message(chat_id=chat_id, content=content, role="user")
+        db.add(message)
+        db.commit()
+        chat_dict = _chat_information(db, chat)
+
+        async def events():
+            answer = []
+            try:
+                async for event, data in ai_handle_all.stream_query_documents_handler(
+                    chat_all_infor=chat_dict, chat_id=chat_id
+                ):
+                    if event == "token":
+                        answer.append(data["content"])
+                    yield _sse(event, data)
+            except Exception as e:
+                logger.error(f"Error streaming answer: {str(e) or type(e).__name__}")
+                yield _sse("error", {"detail": f"Error processing query: {str(e) or type(e).__name__}"})
+                return
+
+            message_id = await run_in_threadpool(_save_message, chat_id, "".join(answer), "ai")
+            yield _sse("done", {"message_id": message_id})
+
+        return StreamingResponse(events(), media_type="text/event-stream", background=BackgroundTask(
+            update_chat_summary, chat_id
+        ), headers={
+            "Cache-Control": "no-cache",
+            # Không để proxy (nginx) gom cả response lại rồi mới gửi
+            "X-Accel-Buffering": "no"
+        })
+
     @router.post("/upload")
     async def upload_file(chat_id: str = Form(...), file: UploadFile = None, db: Session = Depends(get_db)):
         file_extension = os.path.splitext(file.filename)[1]
@@ -109,20 +339,58 @@ def create_routes_be():
         if not chat:
             raise HTTPException(status_code=404, detail="Chat not found")
         file_id = str(uuid.uuid4())
-        save_path = os.path.join(UPLOAD_FOLDER, file_id + file_extension)
+        file_name_save = file_id + file_extension
+        save_path = os.path.join(UPLOAD_FOLDER, file_name_save)
 
-        with open(save_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # Hash nội dung trong lúc ghi file, dùng làm key cache text đã tách
+        content_hash, _ = await run_in_threadpool(copy_and_hash, file.file, save_path)
 
-        embedding_infor, description = await ai_handle_all.upload_document_handler(file_id+ file_extension, chat_id=chat_id)
-        
-        db_file = File(id = file_id, chat_id=chat_id, file_name=file.filename , description=description, embedding_infor=embedding_infor)
-        
+        # File được ghi ngay với trạng thái processing (embedding_infor có file_name để xóa được
+        # trong lúc ingest), worker ingest đổi sang ready khi các chunk đã search được
+        db_file = File(id=file_id, chat_id=chat_id, file_name=file.filename, status="processing",
+                       embedding_infor={"file_name": file_name_save, "ingest_owner": INGEST_OWNER})
         db.add(db_file)
         db.commit()
-        db.refresh(db_file)
 
-        return {"file_name": db_file.file_name, "embedding_infor": embedding_infor}
+        try:
+            job = ingest_queue.submit(
+                file_id, ingest_uploaded_file, file_id, file_name_save, chat_id, content_hash
+            )
+        except IngestQueueFull as e:
+            db.delete(db_file)
+            db.commit()
+            os.remove(save_path)
+            raise HTTPException(status_code=503, detail=str(e))
+
+        return {"file_id": file_id, "file_name": file.filename, "job_id": job.id, "status": job.status}
+
+    @router.get("/jobs/{job_id}")
+    def get_job(job_id: str, db: Session = Depends(get_db)):
+        job = ingest_queue.get(job_id)
+        if job:
+            return job.to_dict()
+
+        # Job của process khác (nhiều worker) hoặc đã hết hạn: đọc trạng thái từ File
+        try:
+            uuid.UUID(job_id)
+        except ValueError:
+            raise HTTPException(status_code=404, detail="Job not found")
+        db_file = db.query(File).filter(File.id == job_id).first()
+        if not db_file:
+            raise HTTPException(status_code=404, detail="Job not found")
+        embedding_infor = db_file.embedding_infor or {}
+        status = FILE_JOB_STATUS.get(db_file.status, db_file.status)
+        error = embedding_infor.get("error")
+        # Process đang ingest đã chết, chưa có worker nào khởi động lại để đánh dấu failed
+        if db_file.status == "processing" and not _ingest_owner_alive(embedding_infor.get("ingest_owner")):
+            status, error = "failed", INTERRUPTED_ERROR
+        return {
+            "job_id": job_id,
+            "status": status,
+            "chunks_embedded": embedding_infor.get("chunks_added"),
+            "chunks_total": embedding_infor.get("total_chunks"),
+            "error": error
+        }
 
     @router.delete("/files/{file_id}")
     def delete_file(file_id:str, db: Session = Depends(get_db)):
@@ -136,11 +404,16 @@ def create_routes_be():
             os.remove(file_path)
         
         index_manager.delete_file(file_name=file_name)
+        answer_cache.invalidate_chat(str(db_file.chat_id))
 
         db.delete(db_file)
         db.commit()
         return {"deleted": db_file.file_name}
 
+    @router.get("/cache/stats")
+    def get_cache_stats():
+        return {"answer_cache": answer_cache.stats()}
+
     @router.post("/vote")
     def vote_message(message_id: str, type: int, db: Session = Depends(get_db)):
         if type not in (-1, 1):
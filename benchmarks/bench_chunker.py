@@ -0,0 +1,139 @@
+"""
+So tốc độ chia chunk của TextChunker (theo ký tự và theo token) với cách chia cũ
+(ghép chuỗi + overlap bằng split từng chunk).
+
+Chạy từ thư mục gốc của repo:
+    python -m benchmarks.bench_chunker --sizes-mb 1,4,16 --output bench_chunker.json
+"""
+import re
+import time
+import json
+import argparse
+import numpy as np
+from ai.services.text_processor import TextChunker
+
+
+def legacy_chunk_text(text, chunk_size=500, overlap=100):
+    """Bản TextProcessor.chunk_text trước TextChunker, giữ lại để so sánh"""
+    if not text:
+        return []
+
+    text = re.sub(r'\s+', ' ', text)
+    sentences = re.split(r'(?<=[.!?])\s+', text)
+
+    chunks = []
+    current_chunk = ""
+
+    for sentence in sentences:
+        if len(sentence) > chunk_size:
+            words = sentence.split()
+            temp_chunk = ""
+
+            for word in words:
+                if len(temp_chunk) + len(word) + 1 <= chunk_size:
+                    temp_chunk += " " + word if temp_chunk else word
+                else:
+                    chunks.append(temp_chunk)
+                    temp_chunk = word
+
+            if temp_chunk:
+                current_chunk += " " + temp_chunk if current_chunk else temp_chunk
+        else:
+            if len(current_chunk) + len(sentence) + 1 <= chunk_size:
+                current_chunk += " " + sentence if current_chunk else sentence
+            else:
+                chunks.append(current_chunk)
+                current_chunk = sentence
+
+    if current_chunk:
+        chunks.append(current_chunk)
+
+    result_chunks = []
+    for i in range(len(chunks)):
+        chunk = chunks[i]
+        if i < len(chunks) - 1 and len(chunk) < chunk_size:
+            next_chunk = chunks[i + 1]
+            overlap_text = " ".join(next_chunk.split()[:overlap])
+            if len(chunk) + len(overlap_text) + 1 <= chunk_size:
+                chunk += " " + overlap_text
+        result_chunks.append(chunk)
+
+    return result_chunks
+
+
+def synthetic_text(size_bytes: int, seed: int = 0):
+    """Text giống tài liệu: từ có độ dài khác nhau, câu 5-40 từ, xuống dòng theo đoạn"""
+    rng = np.random.default_rng(seed)
+    vocabulary = [
+        "".join(chr(c) for c in rng.integers(97, 123, length))
+        for length in rng.integers(1, 12, 5000)
+    ]
+    parts = []
+    size = 0
+    while size < size_bytes:
+        words = [vocabulary[i] for i in rng.integers(0, len(vocabulary), rng.integers(5, 40))]
+        sentence = " ".join(words) + rng.choice([".", ".", ".", "!", "?"])
+        sentence += "\n\n" if rng.random() < 0.1 else " "
+        parts.append(sentence)
+        size += len(sentence)
+    return "".join(parts)
+
+
+def run(name, func, text, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        chunks = func(text)
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    return {
+        "chunker": name,
+        "chunks": len(chunks),
+        "best_s": round(best, 4),
+        "mb_per_s": round(len(text) / 2 ** 20 / best, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes-mb", default="1,4,16")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--overlap", type=int, default=100)
+    parser.add_argument("--token-chunk-size", type=int, default=200)
+    parser.add_argument("--token-overlap", type=int, default=40)
+    parser.add_argument("--piece-size", type=int, default=4096,
+                        help="Kích thước mỗi phần đưa vào TextChunker (giống một trang PDF)")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", help="Ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    def pieces(text):
+        return (text[i:i + args.piece_size] for i in range(0, len(text), args.piece_size))
+
+    chunkers = {
+        "legacy": lambda text: legacy_chunk_text(text, args.chunk_size, args.overlap),
+        "chars": lambda text: list(TextChunker(args.chunk_size, args.overlap).chunks(pieces(text))),
+        "tokens": lambda text: list(
+            TextChunker(args.token_chunk_size, args.token_overlap, unit="tokens").chunks(pieces(text))
+        ),
+    }
+
+    results = []
+    print(f"{'size MB':>8} {'chunker':<8} {'chunks':>8} {'best s':>8} {'MB/s':>8}")
+    for size_mb in [float(value) for value in args.sizes_mb.split(",") if value]:
+        text = synthetic_text(int(size_mb * 2 ** 20))
+        for name, func in chunkers.items():
+            result = {"size_mb": size_mb, **run(name, func, text, args.repeats)}
+            results.append(result)
+            print(
+                f"{size_mb:>8} {name:<8} {result['chunks']:>8} {result['best_s']:>8.3f} "
+                f"{result['mb_per_s']:>8.2f}"
+            )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""
+Đo FAISSIndexManager trên corpus giả lập: throughput, độ trễ p50/p99 của add_document,
+search, delete_file, load_from_disk và bộ nhớ (RSS) theo số chunk / số chat.
+
+Chạy từ thư mục gốc của repo, lưu JSON để so sánh giữa các commit:
+    python -m benchmarks.bench_index_manager --chunks 10000,100000 --chats 1,100,10000 \
+        --output bench_index_manager.json
+"""
+import os
+import time
+import json
+import shutil
+import zlib
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+import config
+from ai.schemas import Document
+from ai.services.embedding_providers import EmbeddingProvider, EMBEDDING_PROVIDERS
+from ai.services.index_manager import FAISSIndexManager
+
+
+class FakeEmbeddingProvider(EmbeddingProvider):
+    """
+    Embedding xác định theo nội dung, không cần model: crc32 của text chọn một tâm cụm và
+    một vector nhiễu trong bảng cố định, nên cùng text luôn ra cùng vector.
+    """
+
+    model_name = "fake"
+
+    def __init__(self, model_name: str = "fake", dimension: int = 384, clusters: int = 200, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.dimension = dimension
+        self.centers = rng.standard_normal((clusters, dimension)).astype(np.float32)
+        self.noise = 0.35 * rng.standard_normal((4096, dimension)).astype(np.float32)
+
+    def embed_documents(self, texts):
+        hashes = np.array([zlib.crc32(text.encode("utf-8")) for text in texts], dtype=np.int64)
+        vectors = self.centers[hashes % len(self.centers)] + self.noise[(hashes // len(self.centers)) % len(self.noise)]
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors
+
+    def embed_query(self, text: str):
+        return self.embed_documents([text])[0]
+
+    def embed_queries(self, texts):
+        return self.embed_documents(texts)
+
+
+# Đăng ký ở mức module để process con (spawn) cũng tạo được provider này
+EMBEDDING_PROVIDERS["fake"] = FakeEmbeddingProvider
+
+
+def synthetic_documents(start: int, stop: int, chats: int, chunks_per_file: int):
+    """Chunk i thuộc chat i % chats; mỗi file của một chat có chunks_per_file chunk"""
+    documents = []
+    for i in range(start, stop):
+        chat = i % chats
+        file_name = f"chat{chat}_file{(i // chats) // chunks_per_file}.txt"
+        documents.append(Document(
+            id=f"doc-{i}",
+            content=f"chat {chat} chunk {i} synthetic content for benchmarking",
+            source=file_name,
+            metadata={"file_type": "txt", "chunk_index": i},
+            chat_id=f"chat{chat}"
+        ))
+    return documents
+
+
+def current_rss_mb():
+    """RSS hiện tại (Linux /proc), nơi khác trả về RSS đỉnh từ getrusage"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def peak_rss_mb():
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summarize(latencies, total_seconds: float = None, items: int = None):
+    """Gom số đo của một thao tác: throughput (item/s) và độ trễ mỗi lần gọi (ms)"""
+    latencies = np.asarray(latencies, dtype=np.float64)
+    total_seconds = float(latencies.sum()) if total_seconds is None else total_seconds
+    items = len(latencies) if items is None else items
+    return {
+        "calls": int(len(latencies)),
+        "items": int(items),
+        "total_s": round(total_seconds, 4),
+        "throughput_per_s": round(items / total_seconds, 2) if total_seconds > 0 else None,
+        "latency_p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 3) if len(latencies) else None,
+        "latency_p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 3) if len(latencies) else None,
+    }
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def create_manager(data_dir: str):
+    return FAISSIndexManager(embedding_model_name="fake", index_data_dir=data_dir, embedding_provider="fake")
+
+
+def run_case(chunks: int, chats: int, args: dict):
+    """Chạy một cấu hình trong process riêng (để RSS đỉnh không lẫn giữa các cấu hình)"""
+    config.WAL_SYNC = args["wal_sync"]
+    rng = np.random.default_rng(args["seed"])
+    data_dir = tempfile.mkdtemp(prefix="bench_index_", dir=args["data_dir"])
+    result = {"chunks": chunks, "chats": chats, "rss_start_mb": round(current_rss_mb(), 1)}
+    try:
+        manager = create_manager(data_dir)
+        manager.load_from_disk()
+
+        # Nạp corpus theo lô bằng add_documents (đường ingest thật của upload)
+        ingest_latencies = []
+        ingest_start = time.perf_counter()
+        for start in range(0, chunks, args["ingest_batch"]):
+            documents = synthetic_documents(start, min(start + args["ingest_batch"], chunks),
+                                            chats, args["chunks_per_file"])
+            elapsed, _ = timed(manager.add_documents, documents)
+            ingest_latencies.append(elapsed)
+        result["add_documents"] = summarize(ingest_latencies, time.perf_counter() - ingest_start, chunks)
+        result["rss_after_ingest_mb"] = round(current_rss_mb(), 1)
+
+        # add_document từng chunk một (một lần ghi WAL mỗi lần gọi)
+        latencies = []
+        for i in range(chunks, chunks + args["add_samples"]):
+            document = synthetic_documents(i, i + 1, chats, args["chunks_per_file"])[0]
+            latencies.append(timed(manager.add_document, document)[0])
+        result["add_document"] = summarize(latencies)
+
+        # Search trong một chat ngẫu nhiên và trên mọi chat; query khác nhau để không trúng cache
+        latencies = []
+        for i in range(args["search_samples"]):
+            chat_id = f"chat{rng.integers(chats)}"
+            latencies.append(timed(manager.search, f"query {i} for {chat_id}", chat_id, args["top_k"], 0.0)[0])
+        result["search"] = summarize(latencies)
+
+        latencies = []
+        for i in range(args["global_search_samples"]):
+            latencies.append(timed(manager.search, f"global query {i}", None, args["top_k"], 0.0)[0])
+        result["search_all_chats"] = summarize(latencies)
+
+        # Xóa các file ngẫu nhiên đang có
+        file_names = sorted({doc.source for doc in manager.documents.values()})
+        picked = rng.choice(len(file_names), size=min(args["delete_samples"], len(file_names)), replace=False)
+        latencies, deleted = [], 0
+        for index in picked:
+            elapsed, count = timed(manager.delete_file, file_names[index])
+            latencies.append(elapsed)
+            deleted += count
+        result["delete_file"] = summarize(latencies, items=deleted)
+
+        manager.checkpoint()
+        result["document_count"] = manager.get_statistics()["document_count"]
+        manager.store.close()
+        del manager
+
+        # Khởi động lại từ snapshot trên đĩa
+        latencies = []
+        for _ in range(args["load_samples"]):
+            manager = create_manager(data_dir)
+            latencies.append(timed(manager.load_from_disk)[0])
+            manager.store.close()
+        result["load_from_disk"] = summarize(latencies, items=result["document_count"] * len(latencies))
+        result["rss_after_load_mb"] = round(current_rss_mb(), 1)
+        result["rss_peak_mb"] = round(peak_rss_mb(), 1)
+        result["disk_mb"] = round(sum(
+            os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(data_dir) for name in names
+        ) / 2 ** 20, 1)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_counts(value: str):
+    return [int(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chunks", type=parse_counts, default=[10000, 100000, 1000000])
+    parser.add_argument("--chats", type=parse_counts, default=[1, 100, 10000])
+    parser.add_argument("--chunks-per-file", type=int, default=50)
+    parser.add_argument("--ingest-batch", type=int, default=1000)
+    parser.add_argument("--add-samples", type=int, default=200)
+    parser.add_argument("--search-samples", type=int, default=500)
+    parser.add_argument("--global-search-samples", type=int, default=50)
+    parser.add_argument("--delete-samples", type=int, default=50)
+    parser.add_argument("--load-samples", type=int, default=3)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-wal-sync", dest="wal_sync", action="store_false",
+                        help="Tắt fsync WAL (đo CPU, bỏ qua tốc độ đĩa)")
+    parser.add_argument("--data-dir", help="Thư mục đặt index tạm (mặc định thư mục tạm của hệ thống)")
+    parser.add_argument("--output", help="Ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    results = []
+    # Mỗi cấu hình chạy trong một process spawn mới
+    context = multiprocessing.get_context("spawn")
+    for chunks in args.chunks:
+        for chats in args.chats:
+            if chats > chunks:
+                continue
+            with context.Pool(1) as pool:
+                result = pool.apply(run_case, (chunks, chats, vars(args)))
+            results.append(result)
+            print(
+                f"chunks={chunks:<8} chats={chats:<6} "
+                f"ingest={result['add_documents']['throughput_per_s']:>9}/s "
+                f"add p50/p99={result['add_document']['latency_p50_ms']}/{result['add_document']['latency_p99_ms']}ms "
+                f"search p50/p99={result['search']['latency_p50_ms']}/{result['search']['latency_p99_ms']}ms "
+                f"delete p50={result['delete_file']['latency_p50_ms']}ms "
+                f"load={result['load_from_disk']['latency_p50_ms']}ms "
+                f"rss peak={result['rss_peak_mb']}MB",
+                flush=True
+            )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "commit": git_commit(),
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "config": {
+                    "index_type": config.INDEX_TYPE,
+                    "index_promotion_threshold": config.INDEX_PROMOTION_THRESHOLD,
+                    "vector_codec": config.VECTOR_CODEC,
+                },
+                "args": vars(args),
+                "results": results
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Đo recall và bộ nhớ của các codec lưu vector (config.VECTOR_CODEC) so với float32.
+
+Chạy từ thư mục gốc của repo:
+    python -m benchmarks.bench_vector_codecs --count 50000 --dimension 768
+"""
+import argparse
+import json
+import numpy as np
+from ai.services import index_factory
+
+
+def synthetic_embeddings(count: int, dimension: int, clusters: int, seed: int = 0):
+    """Vector chuẩn hóa, gom cụm giống embedding thật hơn là nhiễu đều"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimension)).astype(np.float32)
+    labels = rng.integers(0, clusters, count)
+    vectors = centers[labels] + 0.35 * rng.standard_normal((count, dimension)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--dimension", type=int, default=768)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--index-type", default="flat", choices=index_factory.INDEX_TYPES)
+    parser.add_argument("--output", help="Ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    vectors = synthetic_embeddings(args.count, args.dimension, args.clusters)
+    queries = synthetic_embeddings(args.queries, args.dimension, args.clusters, seed=1)
+    # Trước đây: Python list float trong Document.embedding (~32 byte mỗi phần tử) + bản float32 trong FAISS
+    python_list_bytes = args.dimension * 32 + 56
+
+    results = index_factory.evaluate_recall(
+        vectors, queries, args.top_k,
+        candidates=[
+            {"index_type": args.index_type, "codec": codec} for codec in index_factory.CODECS
+        ]
+    )
+
+    print(f"{'codec':<8} {'recall@' + str(args.top_k):>10} {'p50 ms':>8} {'p99 ms':>8} {'bytes/vec':>10}")
+    print(f"{'list+f32':<8} {'':>10} {'':>8} {'':>8} {python_list_bytes + args.dimension * 4:>10}")
+    for result in results:
+        print(
+            f"{result['codec']:<8} {result['recall']:>10.4f} {result['latency_p50_ms']:>8.3f} "
+            f"{result['latency_p99_ms']:>8.3f} {result['bytes_per_vector']:>10.1f}"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Kiểm tra compaction của FAISSIndexManager với từng loại index: sau khi xóa đủ file để
+compaction chạy, mọi document còn lại phải nằm trong top k khi search bằng chính nội dung của nó,
+cả trước lẫn sau khi index được dựng lại ở nền.
+
+Chạy từ thư mục gốc của repo (thoát với mã lỗi nếu có loại index làm mất document):
+    python -m benchmarks.check_index_compaction --docs 1000 --files 20 --delete 6
+"""
+import sys
+import shutil
+import argparse
+import tempfile
+import config
+from benchmarks.bench_index_manager import create_manager, synthetic_documents
+from ai.services import index_factory
+
+
+def check(index_type: str, args):
+    config.INDEX_TYPE = index_type
+    config.INDEX_PROMOTION_THRESHOLD = args.promotion
+    config.VECTOR_CODEC = "float32"
+    config.WAL_SYNC = False
+    data_dir = tempfile.mkdtemp(prefix="check_compaction_")
+    try:
+        manager = create_manager(data_dir)
+        manager.load_from_disk()
+        manager.add_documents(synthetic_documents(0, args.docs, 1, args.docs // args.files))
+        # Promote chạy ở nền, chờ xong để kiểm tra đúng loại index
+        manager.rebuild_pending_indexes()
+        kind = index_factory.index_kind(manager.chat_indexes["chat0"])
+
+        file_names = sorted({doc.source for doc in manager.documents.values()})
+        for file_name in file_names[:args.delete]:
+            manager.delete_file(file_name)
+
+        survivors = sorted(manager.documents.values(), key=lambda doc: doc.id)[:args.samples]
+
+        def hits():
+            return [
+                any(doc.id == hit.id for hit, _ in manager.search(doc.content, "chat0", args.top_k, 0.0))
+                for doc in survivors
+            ]
+
+        # Trước khi dựng lại: tombstone được lọc khi search; sau: index không còn tombstone
+        before = hits()
+        manager.rebuild_pending_indexes()
+        found = sum(a and b for a, b in zip(before, hits()))
+        manager.store.close()
+        return kind, found, len(survivors)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--docs", type=int, default=1000)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--delete", type=int, default=6)
+    # PQ (ivfpq) cần ít nhất 2^PQ_NBITS vector để train
+    parser.add_argument("--promotion", type=int, default=300)
+    parser.add_argument("--samples", type=int, default=100)
+    # pq nén có mất mát nên document chưa chắc đứng đầu; id lệch thì không có trong top k
+    parser.add_argument("--top-k", type=int, default=10)
+    args = parser.parse_args()
+
+    failed = False
+    for index_type in index_factory.INDEX_TYPES:
+        kind, found, total = check(index_type, args)
+        print(f"{index_type:<6} (index {kind:<5}) found {found}/{total}")
+        failed = failed or found < total
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
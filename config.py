@@ -6,8 +6,64 @@ API_PORT = 3002
 API_RELOAD = True
 
 # Index settings
+# "sentence-transformers": chạy EMBEDDING_MODEL_NAME trên CPU, không cần mạng.
+# "google": gọi API Google, khi đó EMBEDDING_MODEL_NAME = "models/embedding-001".
+# Đổi model thì phải dùng INDEX_DATA_DIR mới (vector của hai model không trộn được).
+EMBEDDING_PROVIDER = "sentence-transformers"
 EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_DEVICE = "cpu"
+EMBEDDING_NUM_THREADS = os.cpu_count()
+EMBEDDING_WORKERS = 2
+LOCAL_EMBEDDING_BATCH_SIZE = 64
 INDEX_DATA_DIR = "index_data"
+# Compact index của một chat khi số vector đã xóa vượt tỉ lệ này. Trước đó search bỏ qua các
+# vector đã xóa bằng IDSelector của faiss nên chi phí search không tăng theo số vector đã xóa
+INDEX_COMPACTION_RATIO = 0.2
+# Loại index ANN cho mỗi chat: "flat" (brute force), "hnsw", "ivf" hoặc "ivfpq".
+# Chat bắt đầu bằng flat và được chuyển sang INDEX_TYPE khi đạt INDEX_PROMOTION_THRESHOLD vector.
+# Việc dựng lại (promote, compact index không phải flat) chạy ở nền trong một process duy nhất,
+# search vẫn dùng index cũ cho tới khi có index mới.
+# Dùng FAISSIndexManager.evaluate_chat_index để so recall/độ trễ với flat trước khi đổi tham số.
+INDEX_TYPE = "hnsw"
+INDEX_PROMOTION_THRESHOLD = 20000
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+IVF_NLIST = None  # None -> tự chọn theo số vector (~4 * sqrt(n))
+IVF_NPROBE = 16
+# Cách lưu vector trong index: "float32", "float16", "int8" (scalar quantizer) hoặc "pq".
+# int8/pq cần VECTOR_CODEC_MIN_TRAIN vector để train, trước đó chat dùng float16.
+# Chạy benchmarks/bench_vector_codecs.py để xem recall bị mất với từng codec.
+VECTOR_CODEC = "float16"
+VECTOR_CODEC_MIN_TRAIN = 2000
+# Product quantizer (codec "pq" và index "ivfpq"): số sub-vector và số bit mỗi code
+PQ_M = 16
+PQ_NBITS = 8
+# Cache embedding của câu hỏi (LRU + TTL tính bằng giây)
+QUERY_EMBEDDING_CACHE_SIZE = 2048
+QUERY_EMBEDDING_CACHE_TTL = 3600
+# Số chunk trong một lần gọi embed_documents và số batch được gọi song song
+EMBEDDING_BATCH_SIZE = 100
+EMBEDDING_MAX_CONCURRENCY = 4
+# Thay đổi của index được ghi vào write-ahead log (fsync theo nhóm nếu WAL_SYNC),
+# snapshot (metadata.db + vectors.f32) được cập nhật khi log vượt WAL_CHECKPOINT_BYTES
+# hoặc sau WAL_CHECKPOINT_INTERVAL giây.
+# Nhiều worker (uvicorn main:app --workers N) dùng chung INDEX_DATA_DIR: thay đổi của worker
+# này được worker khác đọc từ WAL. Index trong snapshot được mmap (các worker dùng chung page
+# cache); vector thêm sau snapshot nằm trong một index flat nhỏ riêng của từng worker, index
+# mmap chỉ bị copy vào RAM khi cần sửa (compact index flat) hoặc gộp lúc checkpoint.
+WAL_SYNC = True
+WAL_CHECKPOINT_BYTES = 64 * 1024 * 1024
+WAL_CHECKPOINT_INTERVAL = 300
+
+# Index server: để trống thì web app dùng index trong process. Nếu có, mỗi node là một
+# "python -m ai.index_server --port ... --data-dir ..." và chat được chia theo consistent hashing.
+# Ví dụ INDEX_SERVER_NODES=http://127.0.0.1:8101,http://127.0.0.1:8102
+# Danh sách chỉ được đọc lúc khởi động: khi thêm / bớt node, chạy "python -m ai.rebalance_index
+# --old ... --new ..." cho xong rồi mới đổi biến này và khởi động lại web app.
+INDEX_SERVER_NODES = [node for node in os.getenv("INDEX_SERVER_NODES", "").split(",") if node]
+INDEX_RING_REPLICAS = 100
+INDEX_SERVER_TIMEOUT = 30
 
 # LLM settings
 LLM_MODEL_NAME = "gemini-2.0-flash"
@@ -15,10 +71,53 @@ LLM_TEMPERATURE = 0
 LLM_MAX_TOKENS = 5000
 LLM_TIMEOUT = 30
 LLM_MAX_RETRIES = 3
+# Số lời gọi LLM async đồng thời tối đa mỗi process và deadline (giây) của mỗi lời gọi,
+# tính cả thời gian chờ lượt và các lần retry
+LLM_MAX_CONCURRENCY = 8
+LLM_DEADLINE = 60
+
+# Cache câu trả lời theo chat: câu hỏi đã viết lại (theo ngữ cảnh hội thoại) có embedding cosine
+# >= ANSWER_CACHE_THRESHOLD với câu đã trả lời trên cùng tập file được trả lời lại ngay, bỏ qua
+# bước tìm kiếm và sinh câu trả lời. Tối đa ANSWER_CACHE_SIZE câu (0 là tắt cache),
+# ANSWER_CACHE_PER_CHAT câu mỗi chat, mỗi câu sống ANSWER_CACHE_TTL giây.
+ANSWER_CACHE_SIZE = 2048
+ANSWER_CACHE_PER_CHAT = 32
+ANSWER_CACHE_THRESHOLD = 0.95
+ANSWER_CACHE_TTL = 24 * 3600
+
+# Bộ nhớ hội thoại: prompt viết lại câu hỏi chỉ gồm CHAT_HISTORY_WINDOW tin nhắn gần nhất và
+# tóm tắt của phần trước đó. Sau mỗi lượt, tối đa CHAT_SUMMARY_BATCH tin nhắn đã ra khỏi cửa sổ
+# được gộp vào tóm tắt ở nền (tóm tắt dài tối đa khoảng CHAT_SUMMARY_MAX_WORDS từ).
+CHAT_HISTORY_WINDOW = 6
+CHAT_SUMMARY_BATCH = 20
+CHAT_SUMMARY_MAX_WORDS = 200
+
+# Retrieval settings
+# Số câu hỏi viết lại được search cùng lúc, kết quả gộp bằng reciprocal-rank fusion
+QUERY_VARIANT_COUNT = 3
+RRF_K = 60
 
 # Text processing settings
+# Đơn vị của chunk size / overlap: "chars" hoặc "tokens" (tokenizer của EMBEDDING_MODEL_NAME nếu
+# cài transformers, không thì ước lượng theo từ và dấu câu). Với "tokens" nên giữ chunk size
+# dưới giới hạn input của model embedding, ví dụ 200 / 40 cho all-MiniLM-L6-v2.
+CHUNK_UNIT = "chars"
 DEFAULT_CHUNK_SIZE = 500
 DEFAULT_OVERLAP = 100
+# Upload được chunk dần và gửi vào index mỗi UPLOAD_CHUNK_BATCH chunk
+UPLOAD_CHUNK_BATCH = EMBEDDING_BATCH_SIZE * EMBEDDING_MAX_CONCURRENCY
+# Text PDF được tách trong process pool (None -> số CPU), mỗi task một khoảng trang
+PDF_EXTRACT_WORKERS = None
+PDF_PAGES_PER_TASK = 8
+# Text tách từ file được cache trên đĩa theo sha256 nội dung (để trống thì tắt cache);
+# khi vượt EXTRACT_CACHE_MAX_BYTES thì xóa text ít được dùng gần đây nhất (0 là không giới hạn)
+EXTRACT_CACHE_DIR = os.getenv("EXTRACT_CACHE_DIR", "extract_cache")
+EXTRACT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+# Upload trả về job id ngay, file được ingest ở nền bởi INGEST_WORKERS thread;
+# tối đa INGEST_QUEUE_SIZE file chờ (quá thì /upload trả 503), trạng thái job giữ INGEST_JOB_TTL giây
+INGEST_WORKERS = 2
+INGEST_QUEUE_SIZE = 100
+INGEST_JOB_TTL = 3600
 
 # Supported file types
 SUPPORTED_EXTENSIONS = ['.txt', '.pdf', '.docx']
@@ -1,20 +1,30 @@
-# from ai.handle_all import create_routes
-from be.routes import create_routes_be
 from fastapi import FastAPI
 import uvicorn
 from fastapi.middleware.cors import CORSMiddleware
 
 
-app  = FastAPI()
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins="*",               # Các domain được phép
-    allow_credentials=True,
-    allow_methods=["*"],                 # GET, POST, PUT, DELETE...
-    allow_headers=["*"],                 # Authorization, Content-Type...
-)
-# app.include_router(create_routes())
-app.include_router(create_routes_be(), prefix="/api")
+def create_app():
+    # Import trong hàm: be.routes nạp model, index và kết nối DB
+    # from ai.handle_all import create_routes
+    from be.routes import create_routes_be
+
+    app = FastAPI()
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins="*",               # Các domain được phép
+        allow_credentials=True,
+        allow_methods=["*"],                 # GET, POST, PUT, DELETE...
+        allow_headers=["*"],                 # Authorization, Content-Type...
+    )
+    # app.include_router(create_routes())
+    app.include_router(create_routes_be(), prefix="/api")
+    return app
+
+
+# Process của multiprocessing chạy bằng spawn / forkserver (pool tách PDF) import lại file này
+# với tên __mp_main__, không được tạo lại cả app trong các process đó
+if __name__ != "__mp_main__":
+    app = create_app()
 
 if __name__ == "__main__":
-    uvicorn.run(app)
\ No newline at end of file
+    uvicorn.run(app)